@@ -0,0 +1,122 @@
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULE = 'src.lambda_handler'
+DEFAULT_RUNS = 5
+# Importing the handler took about 270 ms before heavy dependencies were
+# made lazy, and takes about 45 ms without them
+DEFAULT_BUDGET_MS = 100.0
+# Dependencies that must only load on the code paths that use them
+DEFERRED_PACKAGES = ('boto3', 'botocore', 'requests', 'urllib3', 'bs4')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(output: str) -> List[Dict]:
+    """
+    Parses the report written to stderr by python -X importtime.
+
+    Returns:
+        List[Dict]: One entry per imported module, with its 'module'
+        name and its 'self_us' and 'cumulative_us' import times.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split(
+            '|')
+        imports.append({
+            'module': module.strip(),
+            'self_us': int(self_us),
+            'cumulative_us': int(cumulative_us),
+        })
+    return imports
+
+
+def _import_once(module: str) -> List[Dict]:
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=_ROOT, capture_output=True, text=True, check=True)
+    return parse_importtime(completed.stderr)
+
+
+def measure_import(module: str = DEFAULT_MODULE,
+                   runs: int = DEFAULT_RUNS) -> Dict:
+    """
+    Imports a module in fresh interpreters and measures how long it takes.
+
+    Args:
+        module (str, optional): The module to import.
+        Defaults to DEFAULT_MODULE, the Lambda handler.
+        runs (int, optional): The number of interpreters started.
+        Defaults to DEFAULT_RUNS.
+
+    Returns:
+        Dict: The median 'cumulative_ms' import time of the module, the
+        'deferred_packages_loaded' by the import, and the 'slowest'
+        modules of the last run by their own import time.
+    """
+    cumulative_ms = []
+    for _ in range(runs):
+        imports = _import_once(module)
+        [target] = [entry for entry in imports if entry['module'] == module]
+        cumulative_ms.append(target['cumulative_us'] / 1000)
+    loaded = {entry['module'].split('.')[0] for entry in imports}
+    slowest = sorted(imports, key=lambda entry: entry['self_us'],
+                     reverse=True)[:10]
+    return {
+        'module': module,
+        'runs': runs,
+        'cumulative_ms': round(statistics.median(cumulative_ms), 3),
+        'deferred_packages_loaded': sorted(
+            loaded.intersection(DEFERRED_PACKAGES)),
+        'slowest': [{'module': entry['module'],
+                     'self_ms': round(entry['self_us'] / 1000, 3)}
+                    for entry in slowest],
+    }
+
+
+def check_budget(result: Dict,
+                 budget_ms: float = DEFAULT_BUDGET_MS) -> List[str]:
+    """
+    Returns a message for each way the import exceeds its budget:
+    taking longer than budget_ms, or loading a deferred package.
+    """
+    violations = []
+    if result['cumulative_ms'] > budget_ms:
+        violations.append(
+            f"Importing {result['module']} took "
+            f"{result['cumulative_ms']:.1f} ms, above the "
+            f"{budget_ms:.1f} ms budget")
+    for package in result['deferred_packages_loaded']:
+        violations.append(
+            f"Importing {result['module']} loaded {package}, "
+            f"which should only load when it is used")
+    return violations
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Measure the cold start import time of the Lambda '
+                    'handler with python -X importtime.')
+    parser.add_argument('--module', default=DEFAULT_MODULE)
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    result = measure_import(args.module, args.runs)
+    print(json.dumps(result, indent=4))
+    violations = check_budget(result, args.budget_ms)
+    for violation in violations:
+        print(f'Over budget: {violation}', file=sys.stderr)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
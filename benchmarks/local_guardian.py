@@ -0,0 +1,201 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+import json
+import os
+import subprocess
+import sys
+
+# Sizes taken from typical Guardian article pages and search responses
+DEFAULT_RESULT_COUNT = 50
+PARAGRAPH_COUNT = 40
+BOILERPLATE_BYTES = 40 * 1024
+
+_PARAGRAPH = (
+    'The government has announced a new package of measures aimed at '
+    'easing pressure on households, with ministers saying the changes '
+    'will take effect from the start of the next financial year. Critics '
+    'said the plans did not go far enough &amp; called for a review.'
+)
+
+
+def article_html(index: int) -> bytes:
+    """
+    Returns the HTML of a local article page: a head with inline
+    scripts and styles, navigation, then paragraphs of body text.
+    """
+    boilerplate = '<script>window.guardian = {"config": "%s"};</script>' % (
+        'x' * BOILERPLATE_BYTES)
+    navigation = ''.join(
+        f'<li><a href="/section/{i}">Section {i}</a></li>'
+        for i in range(60))
+    paragraphs = ''.join(
+        f'<p>{_PARAGRAPH} <a href="/related/{index}/{i}">Read more</a></p>'
+        for i in range(PARAGRAPH_COUNT))
+    return (
+        f'<!DOCTYPE html><html><head><title>Article {index}</title>'
+        f'<style>body {{ font-family: serif; }}</style>{boilerplate}</head>'
+        f'<body><nav><ul>{navigation}</ul></nav>'
+        f'<main><article><h1>Article {index}</h1>{paragraphs}</article>'
+        f'</main><footer><p>© Guardian News &amp; Media Limited</p>'
+        f'</footer></body></html>'
+    ).encode('utf-8')
+
+
+def search_results(base_url: str, query: Dict[str, List[str]],
+                   result_count: int) -> Dict:
+    """
+    Returns a Guardian search response whose hits link to
+    the local article pages.
+    """
+    page = int(query.get('page', ['1'])[0])
+    page_size = int(query.get('page-size', ['10'])[0])
+    show_fields = 'show-fields' in query
+    start = (page - 1) * page_size
+    results = []
+    for index in range(start, min(start + page_size, result_count)):
+        result = {
+            'id': f'world/2024/may/01/article-{index}',
+            'type': 'article',
+            'sectionId': 'world',
+            'sectionName': 'World news',
+            'webPublicationDate': f'2024-05-01T12:{index % 60:02d}:00Z',
+            'webTitle': f'Article {index}',
+            'webUrl': f'{base_url}/article/{index}',
+            'apiUrl': f'{base_url}/api/article/{index}',
+            'isHosted': False,
+            'pillarId': 'pillar/news',
+            'pillarName': 'News',
+        }
+        if show_fields:
+            result['fields'] = {
+                'trailText': _PARAGRAPH[:120],
+                'bodyText': ' '.join([_PARAGRAPH] * 8),
+            }
+        results.append(result)
+    return {'response': {
+        'status': 'ok',
+        'userTier': 'developer',
+        'total': result_count,
+        'startIndex': start + 1,
+        'pageSize': page_size,
+        'currentPage': page,
+        'pages': max(1, -(-result_count // page_size)),
+        'orderBy': query.get('order-by', ['relevance'])[0],
+        'results': results,
+    }}
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading a page early reset the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _make_handler(result_count: int):
+    pages = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            base_url = f'http://{self.server.server_name}:' \
+                f'{self.server.server_port}'
+            url = urlparse(self.path)
+            if url.path == '/search':
+                body = json.dumps(search_results(
+                    base_url, parse_qs(url.query),
+                    result_count)).encode('utf-8')
+                content_type = 'application/json'
+            elif url.path.startswith('/article/'):
+                index = int(url.path.rsplit('/', 1)[1])
+                if index not in pages:
+                    pages[index] = article_html(index)
+                body = pages[index]
+                content_type = 'text/html; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except ConnectionError:
+                # Streaming previews close the connection early
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(result_count: int = DEFAULT_RESULT_COUNT) -> None:
+    """
+    Serves the local Guardian on a free port of 127.0.0.1, printing
+    the port once it is listening.
+    """
+    server = _Server(('127.0.0.1', 0), _make_handler(result_count))
+    server.server_name = '127.0.0.1'
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+class LocalGuardian:
+    """
+    Local HTTP server standing in for the Guardian search API and
+    article pages, so benchmarks run offline. Use it as a context
+    manager; the search endpoint is at search_url.
+
+    The server runs in its own process, so that it does not compete
+    with the code being measured for the GIL.
+
+    Args:
+        result_count (int, optional): The number of hits the search
+        returns. Defaults to DEFAULT_RESULT_COUNT.
+    """
+
+    def __init__(self, result_count: int = DEFAULT_RESULT_COUNT):
+        self.result_count = result_count
+        self._process = None
+        self.base_url = None
+        self.search_url = None
+
+    def page(self, index: int) -> bytes:
+        """
+        Returns the HTML served for the article at index.
+        """
+        return article_html(index)
+
+    def article_url(self, index: int) -> str:
+        return f'{self.base_url}/article/{index}'
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.local_guardian',
+             str(self.result_count)],
+            stdout=subprocess.PIPE, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        port = self._process.stdout.readline().strip()
+        if not port:
+            self._process.kill()
+            raise RuntimeError('The local Guardian server failed to start')
+        self.base_url = f'http://127.0.0.1:{port}'
+        self.search_url = f'{self.base_url}/search'
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.wait()
+        self._process.stdout.close()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RESULT_COUNT)
@@ -0,0 +1,314 @@
+from benchmarks.local_guardian import LocalGuardian, DEFAULT_RESULT_COUNT
+from src.clients import get_boto3_client, reset_clients
+from src.retrieve_api_key import retrieve_api_key, invalidate_api_key
+from src.retrieve_articles import (
+    retrieve_articles, _search_page, API_KEY_SECRET_NAME, MAX_PAGE_SIZE)
+from src.fetch_article_content import (
+    fetch_content_preview, _create_parser, PARSER_BACKENDS,
+    STREAM_CHUNK_SIZE)
+from src.preview_cache import set_preview_cache
+from src.query_cache import set_query_cache
+from src.publish_to_kinesis import publish_to_kinesis, clear_shard_cache
+from src.record_encoding import encode_article, ENCODINGS
+from src.lambda_handler import lambda_handler
+from src.kinesis_consumer import KinesisConsumer
+from src.rate_limiter import (
+    RateLimiter, set_rate_limiter, reset_rate_limiters)
+from moto import mock_kinesis, mock_secretsmanager
+from unittest.mock import patch
+from typing import Callable, Dict, List, Optional
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+
+STREAM_NAME = 'benchmark_stream'
+CONSUMER_STREAM_NAME = 'benchmark_consumer_stream'
+SEARCH_TERM = 'benchmark'
+DEFAULT_REPEAT = 20
+DEFAULT_WARMUP = 2
+# A stage regresses when its median is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.25
+
+
+def summarise(durations: List[float]) -> Dict:
+    """
+    Summarises the durations of a stage's runs, in milliseconds.
+    """
+    ms = sorted(duration * 1000 for duration in durations)
+    return {
+        'runs': len(ms),
+        'min_ms': round(ms[0], 3),
+        'median_ms': round(statistics.median(ms), 3),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p95_ms': round(ms[math.ceil(0.95 * len(ms)) - 1], 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def time_stage(func: Callable[[], object], repeat: int, warmup: int,
+               setup: Optional[Callable[[], object]] = None) -> Dict:
+    """
+    Times repeat runs of a stage after warmup untimed runs. setup,
+    if given, runs untimed before each run.
+    """
+    durations = []
+    for run in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        if run >= warmup:
+            durations.append(time.perf_counter() - start)
+    return summarise(durations)
+
+
+def _streaming_preview(html: bytes, backend: str) -> str:
+    """
+    Parses a page the way streaming fetches do, chunk by chunk
+    until the preview is complete.
+    """
+    parser = _create_parser(backend)
+    for start in range(0, len(html), STREAM_CHUNK_SIZE):
+        parser.feed(html[start:start + STREAM_CHUNK_SIZE].decode(
+            'utf-8', errors='replace'))
+        if parser.done:
+            return parser.preview
+    parser.close()
+    return parser.preview
+
+
+def _available_parsers() -> List[str]:
+    available = []
+    for backend in PARSER_BACKENDS:
+        try:
+            _create_parser(backend)
+        except ValueError:
+            # lxml and bs4 are optional packages
+            continue
+        available.append(backend)
+    return available
+
+
+def _available_encodings(article: Dict) -> List[str]:
+    available = []
+    for encoding in ENCODINGS:
+        try:
+            encode_article(article, encoding)
+        except ValueError:
+            # zstd_json and msgpack need optional packages
+            continue
+        available.append(encoding)
+    return available
+
+
+def _reset_caches() -> None:
+    set_preview_cache(None)
+    set_query_cache(None)
+
+
+def _reset_shared_state() -> None:
+    reset_clients()
+    invalidate_api_key()
+    _reset_caches()
+    clear_shard_cache()
+    reset_rate_limiters()
+
+
+def _unlimited() -> RateLimiter:
+    # The stand-in server never throttles, and waiting for tokens
+    # would be timed as part of the stages
+    return RateLimiter(rate=1e9, burst=10**9, max_concurrency=10**6)
+
+
+def _handle(event: Dict) -> None:
+    response = lambda_handler(event, None)
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"lambda_handler failed: {response['body']}")
+
+
+def run_benchmarks(repeat: int = DEFAULT_REPEAT,
+                   warmup: int = DEFAULT_WARMUP,
+                   article_count: int = DEFAULT_RESULT_COUNT) -> Dict:
+    """
+    Times each stage of the pipeline offline: Secrets Manager and Kinesis
+    are mocked with moto, and the Guardian API and article pages are
+    served by a LocalGuardian server.
+
+    Args:
+        repeat (int, optional): The number of timed runs of each stage.
+        Defaults to DEFAULT_REPEAT.
+        warmup (int, optional): The number of untimed runs before them.
+        Defaults to DEFAULT_WARMUP.
+        article_count (int, optional): The number of articles the search
+        returns and that are published. Defaults to DEFAULT_RESULT_COUNT.
+
+    Returns:
+        Dict: The run's 'metadata' and the timings of each of its 'stages'.
+    """
+    for name, value in (('AWS_ACCESS_KEY_ID', 'benchmark'),
+                        ('AWS_SECRET_ACCESS_KEY', 'benchmark'),
+                        ('AWS_DEFAULT_REGION', 'eu-west-2')):
+        os.environ.setdefault(name, value)
+    page_size = min(article_count, MAX_PAGE_SIZE)
+    stages = {}
+    # The stages log every request at INFO, which would be timed too
+    logging.disable(logging.CRITICAL)
+    _reset_shared_state()
+    set_rate_limiter('search', _unlimited())
+    set_rate_limiter('pages', _unlimited())
+    try:
+        with LocalGuardian(article_count) as guardian, \
+                mock_secretsmanager(), mock_kinesis(), \
+                patch('src.retrieve_articles.SEARCH_URL',
+                      guardian.search_url):
+            get_boto3_client('secretsmanager').create_secret(
+                Name=API_KEY_SECRET_NAME, SecretString='benchmark-key')
+            get_boto3_client('kinesis').create_stream(
+                StreamName=STREAM_NAME, ShardCount=4)
+
+            stages['retrieve_api_key'] = time_stage(
+                lambda: retrieve_api_key(API_KEY_SECRET_NAME),
+                repeat, warmup)
+            stages['search'] = time_stage(
+                lambda: _search_page(
+                    {'q': SEARCH_TERM}, 1, page_size, 'page'),
+                repeat, warmup)
+
+            url = guardian.article_url(0)
+            html = guardian.page(0)
+            stages['fetch_content_preview'] = time_stage(
+                lambda: fetch_content_preview(url, use_cache=False),
+                repeat, warmup)
+            for backend in _available_parsers():
+                stages[f'parse_preview[{backend}]'] = time_stage(
+                    lambda: _streaming_preview(html, backend),
+                    repeat, warmup)
+
+            articles = retrieve_articles(
+                SEARCH_TERM, page_size=page_size, max_results=article_count)
+            for encoding in _available_encodings(articles[0]):
+                stages[f'encode[{encoding}]'] = time_stage(
+                    lambda: [encode_article(article, encoding)
+                             for article in articles],
+                    repeat, warmup)
+            stages['publish_to_kinesis'] = time_stage(
+                lambda: publish_to_kinesis(
+                    STREAM_NAME, SEARCH_TERM, articles, batched=True),
+                repeat, warmup)
+            stages['publish_to_kinesis[aggregate]'] = time_stage(
+                lambda: publish_to_kinesis(
+                    STREAM_NAME, SEARCH_TERM, articles, aggregate=True),
+                repeat, warmup)
+
+            # Reading the articles back from every shard, which includes
+            # the pause between GetRecords calls to each shard
+            get_boto3_client('kinesis').create_stream(
+                StreamName=CONSUMER_STREAM_NAME, ShardCount=4)
+            publish_to_kinesis(CONSUMER_STREAM_NAME, SEARCH_TERM, articles,
+                               batched=True, partition_strategy='url_hash')
+            stages['consume_stream'] = time_stage(
+                lambda: list(KinesisConsumer(
+                    CONSUMER_STREAM_NAME,
+                    stop_at_latest=True).iter_articles()),
+                repeat, warmup)
+
+            event = {'queryStringParameters': {
+                'search_term': SEARCH_TERM,
+                'kinesis_stream': STREAM_NAME,
+                'max_results': str(article_count),
+            }}
+            # Each invocation starts with empty caches, as the pages
+            # of a new search would not have been fetched yet
+            stages['lambda_handler'] = time_stage(
+                lambda: _handle(event), repeat, warmup, setup=_reset_caches)
+            # A repeated query answered from the query cache
+            cached_event = {'queryStringParameters': {
+                **event['queryStringParameters'], 'on_cache_hit': 'return'}}
+            stages['lambda_handler[cached]'] = time_stage(
+                lambda: _handle(cached_event), repeat, warmup)
+    finally:
+        _reset_shared_state()
+        logging.disable(logging.NOTSET)
+
+    return {
+        'metadata': {
+            'timestamp': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'warmup': warmup,
+            'article_count': article_count,
+        },
+        'stages': stages,
+    }
+
+
+def compare_results(baseline: Dict, results: Dict,
+                    threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """
+    Compares the median of each stage with a baseline run.
+
+    Returns:
+        List[str]: A message for every stage whose median is more than
+        threshold (e.g. 0.25 for 25%) slower than in the baseline.
+    """
+    regressions = []
+    for stage, timings in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None or not base['median_ms']:
+            continue
+        change = timings['median_ms'] / base['median_ms'] - 1
+        if change > threshold:
+            regressions.append(
+                f"{stage}: median {timings['median_ms']:.3f} ms vs "
+                f"{base['median_ms']:.3f} ms in the baseline "
+                f"(+{change:.0%})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Run the offline per-stage benchmarks and report '
+                    'the timings as JSON.')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    parser.add_argument('--articles', type=int, default=DEFAULT_RESULT_COUNT,
+                        help='number of articles searched and published')
+    parser.add_argument('--output', help='write the results to this file '
+                                         'instead of standard output')
+    parser.add_argument('--baseline', help='results of an earlier run to '
+                                           'check for regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown of a stage median, '
+                             'e.g. 0.25 for 25%%')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat, args.warmup, args.articles)
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_results(
+                json.load(f), results, args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
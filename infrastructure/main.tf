@@ -22,6 +22,95 @@ resource "aws_lambda_function" "example_lambda" {
     aws_cloudwatch_log_group.example,
   ]
   timeout = 100
+
+  environment {
+    variables = {
+      JOBS_TABLE       = aws_dynamodb_table.jobs.name
+      WATERMARKS_TABLE = aws_dynamodb_table.watermarks.name
+    }
+  }
+}
+
+# The asynchronous invocations that run async=true jobs are not retried,
+# since a retry would publish the job's articles again
+resource "aws_lambda_function_event_invoke_config" "example_lambda" {
+  function_name                = aws_lambda_function.example_lambda.function_name
+  maximum_retry_attempts       = 0
+  maximum_event_age_in_seconds = 3600
+}
+
+# Status of the jobs started by async=true requests
+resource "aws_dynamodb_table" "jobs" {
+  name         = "${var.lambda_function_name}-jobs"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "job_id"
+
+  attribute {
+    name = "job_id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+resource "aws_iam_policy" "lambda_jobs_policy" {
+  name        = "lambda_jobs_policy"
+  description = "IAM policy for running async jobs from a lambda"
+
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [
+      {
+        Effect   = "Allow",
+        Action   = ["dynamodb:GetItem", "dynamodb:PutItem"],
+        Resource = aws_dynamodb_table.jobs.arn
+      },
+      {
+        Effect   = "Allow",
+        Action   = ["lambda:InvokeFunction"],
+        Resource = "arn:aws:lambda:${var.myregion}:${var.accountId}:function:${var.lambda_function_name}"
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_jobs_attachment" {
+  role       = aws_iam_role.lambda_role.name
+  policy_arn = aws_iam_policy.lambda_jobs_policy.arn
+}
+
+# Watermarks of the incremental=true polls, shared by every instance
+resource "aws_dynamodb_table" "watermarks" {
+  name         = "${var.lambda_function_name}-watermarks"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "search_term"
+
+  attribute {
+    name = "search_term"
+    type = "S"
+  }
+}
+
+resource "aws_iam_policy" "lambda_watermarks_policy" {
+  name        = "lambda_watermarks_policy"
+  description = "IAM policy for keeping incremental poll watermarks from a lambda"
+
+  policy = jsonencode({
+    Version = "2012-10-17",
+    Statement = [{
+      Effect   = "Allow",
+      Action   = ["dynamodb:GetItem", "dynamodb:PutItem"],
+      Resource = aws_dynamodb_table.watermarks.arn
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_watermarks_attachment" {
+  role       = aws_iam_role.lambda_role.name
+  policy_arn = aws_iam_policy.lambda_watermarks_policy.arn
 }
 
 resource "aws_cloudwatch_log_group" "example" {
@@ -82,7 +171,7 @@ resource "aws_iam_policy" "kinesis_put_record_policy" {
     Version = "2012-10-17",
     Statement = [{
       Effect   = "Allow",
-      Action   = "kinesis:PutRecord",
+      Action   = ["kinesis:PutRecord", "kinesis:PutRecords", "kinesis:ListShards"],
       Resource = "arn:aws:kinesis:${var.myregion}:${var.accountId}:stream/${var.kinesis_stream_name}"
     }]
   })
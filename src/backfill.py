@@ -0,0 +1,271 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.json_store import MemoryKeyedStore, JsonFileStore
+from src.metrics import increment
+from src.publish_to_kinesis import (
+    publish_to_kinesis, PARTITION_STRATEGIES)
+from src.record_encoding import ENCODINGS
+from src.retrieve_articles import (
+    iter_articles, PREVIEW_SOURCES, MAX_PAGE_SIZE)
+from src.watermarks import advance_watermark
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW_DAYS = 7
+DEFAULT_MAX_WINDOWS = 4
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_PREVIEW_WORKERS = 5
+DEFAULT_CHECKPOINT_PATH = 'backfill_checkpoints.json'
+
+
+class BackfillError(Exception):
+    pass
+
+
+def split_date_range(from_date: str, to_date: str,
+                     window_days: int = DEFAULT_WINDOW_DAYS
+                     ) -> List[Tuple[str, str]]:
+    """
+    Splits a date range into consecutive windows.
+
+    Args:
+        from_date (str): The first date of the range, in YYYY-MM-DD format.
+        to_date (str): The last date of the range, inclusive.
+        window_days (int, optional): The number of days in each window.
+        The last window may be shorter. Defaults to DEFAULT_WINDOW_DAYS.
+
+    Returns:
+        List[Tuple[str, str]]: The first and last date of each window.
+
+    Raises:
+        ValueError: If a date is invalid, from_date is after to_date
+        or window_days is less than 1.
+    """
+    if window_days < 1:
+        raise ValueError('window_days must be at least 1')
+    start = datetime.date.fromisoformat(from_date)
+    end = datetime.date.fromisoformat(to_date)
+    if start > end:
+        raise ValueError(
+            f'from_date {from_date} is after to_date {to_date}')
+    windows = []
+    step = datetime.timedelta(days=window_days)
+    while start <= end:
+        window_end = min(start + step - datetime.timedelta(days=1), end)
+        windows.append((start.isoformat(), window_end.isoformat()))
+        start = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+def _window_key(kinesis_stream: str, search_term: str,
+                window: Tuple[str, str]) -> str:
+    return f'{kinesis_stream}/{search_term}/{window[0]}/{window[1]}'
+
+
+def _batches(articles: Iterator[Dict], size: int) -> Iterator[List[Dict]]:
+    while True:
+        batch = list(itertools.islice(articles, size))
+        if not batch:
+            return
+        yield batch
+
+
+def backfill_window(search_term: str, kinesis_stream: str,
+                    window: Tuple[str, str], checkpoint_store,
+                    page_size: int = DEFAULT_PAGE_SIZE,
+                    max_workers: int = DEFAULT_PREVIEW_WORKERS,
+                    preview_source: str = 'page',
+                    partition_strategy: str = 'term',
+                    encoding: str = 'json',
+                    aggregate: bool = False) -> Dict:
+    """
+    Retrieves the articles of one window, oldest first, and publishes
+    them page by page, checkpointing the window after every page.
+
+    The checkpoint holds a watermark of the articles published so far.
+    A window that was interrupted resumes after its watermark, so its
+    published articles are neither fetched nor published again, and a
+    window that was completed is skipped.
+
+    Args:
+        search_term (str): The search term to query.
+        kinesis_stream (str): The Kinesis stream to publish to.
+        window (Tuple[str, str]): The first and last date of the window.
+        checkpoint_store: Where the window's checkpoint is kept.
+        page_size (int, optional): The number of hits requested per page,
+        and published together. Defaults to DEFAULT_PAGE_SIZE.
+        max_workers (int, optional): The maximum number of article pages
+        fetched concurrently for the window's content previews.
+        preview_source (str, optional): 'page' or 'api'.
+        See retrieve_articles.
+        partition_strategy (str, optional): See publish_to_kinesis.
+        encoding (str, optional): See publish_to_kinesis.
+        aggregate (bool, optional): See publish_to_kinesis.
+
+    Returns:
+        Dict: The window's 'from_date', 'to_date', 'status' ('done' or
+        'skipped' if it was already done) and 'articles_published'.
+
+    Raises:
+        BackfillError: If some articles of a page were not published.
+        The articles published after the first that failed may be
+        published again when the window is resumed.
+        APIRequestError: If a page of the window could not be retrieved.
+    """
+    key = _window_key(kinesis_stream, search_term, window)
+    checkpoint = checkpoint_store.get(key) or {}
+    summary = {'from_date': window[0], 'to_date': window[1]}
+    if checkpoint.get('status') == 'done':
+        logger.info(f'Skipping completed window {window[0]}..{window[1]}')
+        return {**summary, 'status': 'skipped',
+                'articles_published': checkpoint['published']}
+
+    watermark = checkpoint.get('watermark')
+    published_count = checkpoint.get('published', 0)
+    articles = iter_articles(
+        search_term,
+        from_date=watermark['date'][:10] if watermark else window[0],
+        to_date=window[1], page_size=page_size, max_results=None,
+        max_workers=max_workers, preview_source=preview_source,
+        order_by='oldest', watermark=watermark)
+    for batch in _batches(articles, page_size):
+        _, published_articles = publish_to_kinesis(
+            kinesis_stream, search_term, batch, batched=True,
+            partition_strategy=partition_strategy, encoding=encoding,
+            aggregate=aggregate)
+        watermark = advance_watermark(watermark, batch, published_articles)
+        published_count += len(published_articles)
+        checkpoint_store.set(key, {'status': 'running',
+                                   'watermark': watermark,
+                                   'published': published_count})
+        increment('backfill.articles_published', len(published_articles))
+        if len(published_articles) < len(batch):
+            raise BackfillError(
+                f'{len(batch) - len(published_articles)} of {len(batch)} '
+                f'articles were not published')
+
+    checkpoint_store.set(key, {'status': 'done', 'watermark': watermark,
+                               'published': published_count})
+    logger.info(f'Window {window[0]}..{window[1]} done: '
+                f'{published_count} articles published')
+    return {**summary, 'status': 'done',
+            'articles_published': published_count}
+
+
+def backfill(search_term: str, kinesis_stream: str, from_date: str,
+             to_date: str, checkpoint_store=None,
+             window_days: int = DEFAULT_WINDOW_DAYS,
+             max_windows: int = DEFAULT_MAX_WINDOWS,
+             **window_kwargs) -> List[Dict]:
+    """
+    Backfills the articles of a search term published between two
+    dates, by splitting the range into windows and retrieving and
+    publishing several windows in parallel.
+
+    A window that fails is reported and does not stop the others.
+    Running the backfill again with the same checkpoint store retries
+    the failed and interrupted windows and skips the completed ones.
+
+    Args:
+        search_term (str): The search term to query.
+        kinesis_stream (str): The Kinesis stream to publish to.
+        from_date (str): The first date, in YYYY-MM-DD format.
+        to_date (str): The last date, inclusive.
+        checkpoint_store (optional): Where the window checkpoints are
+        kept. Defaults to a new MemoryKeyedStore.
+        window_days (int, optional): The number of days in each window.
+        Defaults to DEFAULT_WINDOW_DAYS.
+        max_windows (int, optional): The maximum number of windows
+        processed concurrently. Defaults to DEFAULT_MAX_WINDOWS.
+        **window_kwargs: The page_size, max_workers, preview_source,
+        partition_strategy, encoding and aggregate options.
+        See backfill_window.
+
+    Returns:
+        List[Dict]: The summary of each window, in date order. A failed
+        window has the status 'failed' and an 'error'.
+    """
+    if max_windows < 1:
+        raise ValueError('max_windows must be at least 1')
+    if checkpoint_store is None:
+        checkpoint_store = MemoryKeyedStore()
+    windows = split_date_range(from_date, to_date, window_days)
+
+    def run(window):
+        try:
+            return backfill_window(search_term, kinesis_stream, window,
+                                   checkpoint_store, **window_kwargs)
+        except Exception as e:
+            logger.error(f'Window {window[0]}..{window[1]} failed: {e}')
+            increment('backfill.windows_failed')
+            checkpoint = checkpoint_store.get(_window_key(
+                kinesis_stream, search_term, window)) or {}
+            return {'from_date': window[0], 'to_date': window[1],
+                    'status': 'failed',
+                    'articles_published': checkpoint.get('published', 0),
+                    'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max_windows) as executor:
+        return list(executor.map(run, windows))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Backfill the articles of a search term published '
+                    'between two dates to a Kinesis stream.')
+    parser.add_argument('--search-term', required=True)
+    parser.add_argument('--kinesis-stream', required=True)
+    parser.add_argument('--from-date', required=True,
+                        help='The first date, in YYYY-MM-DD format.')
+    parser.add_argument('--to-date', required=True,
+                        help='The last date, inclusive.')
+    parser.add_argument('--window-days', type=int,
+                        default=DEFAULT_WINDOW_DAYS)
+    parser.add_argument('--max-windows', type=int,
+                        default=DEFAULT_MAX_WINDOWS,
+                        help='The number of windows run in parallel.')
+    parser.add_argument('--checkpoint-file',
+                        default=DEFAULT_CHECKPOINT_PATH,
+                        help='The JSON file of window checkpoints, read '
+                             'to resume an interrupted backfill.')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        choices=range(1, MAX_PAGE_SIZE + 1),
+                        metavar=f'[1-{MAX_PAGE_SIZE}]')
+    parser.add_argument('--max-workers', type=int,
+                        default=DEFAULT_PREVIEW_WORKERS,
+                        help='Preview fetches per window.')
+    parser.add_argument('--preview-source', choices=PREVIEW_SOURCES,
+                        default='page')
+    parser.add_argument('--partition-strategy',
+                        choices=PARTITION_STRATEGIES, default='term')
+    parser.add_argument('--encoding', choices=ENCODINGS, default='json')
+    parser.add_argument('--aggregate', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        windows = backfill(
+            args.search_term, args.kinesis_stream, args.from_date,
+            args.to_date,
+            checkpoint_store=JsonFileStore(
+                args.checkpoint_file),
+            window_days=args.window_days, max_windows=args.max_windows,
+            page_size=args.page_size, max_workers=args.max_workers,
+            preview_source=args.preview_source,
+            partition_strategy=args.partition_strategy,
+            encoding=args.encoding, aggregate=args.aggregate)
+    except ValueError as e:
+        parser.error(str(e))
+    json.dump(windows, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    return 1 if any(w['status'] == 'failed' for w in windows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+from typing import TYPE_CHECKING, Dict
+import logging
+import os
+import threading
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HTTP_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_http_session = None
+_boto3_clients: Dict[str, object] = {}
+
+
+def _create_http_session(pool_size: int) -> 'requests.Session':
+    """
+    Creates a requests Session with a keep-alive connection pool
+    mounted for both http and https.
+    """
+    # Imported here so that requests only loads once a page is fetched
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_http_session() -> 'requests.Session':
+    """
+    Returns the shared HTTP session, creating it on first use.
+
+    The session lives at module level so that pooled connections
+    (and their TLS handshakes) are reused across warm Lambda
+    invocations. The pool size can be tuned with the
+    HTTP_POOL_SIZE environment variable.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                pool_size = int(os.environ.get(
+                    'HTTP_POOL_SIZE', DEFAULT_HTTP_POOL_SIZE))
+                logger.info(
+                    f'Creating HTTP session with pool size {pool_size}')
+                _http_session = _create_http_session(pool_size)
+    return _http_session
+
+
+def get_boto3_client(service_name: str):
+    """
+    Returns a cached boto3 client for the given service,
+    creating it on first use.
+
+    Args:
+        service_name (str): The AWS service, e.g. 'kinesis'
+        or 'secretsmanager'.
+
+    Returns:
+        The boto3 client for the service.
+    """
+    client = _boto3_clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _boto3_clients.get(service_name)
+            if client is None:
+                logger.info(f'Creating boto3 client for {service_name}')
+                # boto3 takes longer to import than the rest of the
+                # package, so it only loads once a client is needed
+                import boto3
+                client = boto3.client(service_name)
+                _boto3_clients[service_name] = client
+    return client
+
+
+def set_http_session(session: 'requests.Session') -> None:
+    """
+    Replaces the shared HTTP session, e.g. with a test double.
+    """
+    global _http_session
+    with _lock:
+        _http_session = session
+
+
+def set_boto3_client(service_name: str, client) -> None:
+    """
+    Replaces the cached boto3 client for a service, e.g. with a test double.
+    """
+    with _lock:
+        _boto3_clients[service_name] = client
+
+
+def reset_clients() -> None:
+    """
+    Drops the shared HTTP session and all cached boto3 clients,
+    so that they are recreated on next use.
+    """
+    global _http_session
+    with _lock:
+        if _http_session is not None:
+            _http_session.close()
+        _http_session = None
+        _boto3_clients.clear()
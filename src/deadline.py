@@ -0,0 +1,56 @@
+from typing import Optional
+import time
+
+# Time kept back from the Lambda timeout to publish what was retrieved
+DEFAULT_RESERVE_SECONDS = 5.0
+# Requests are never given less than this, so that a nearly expired
+# deadline fails fast rather than with a zero timeout
+MIN_TIMEOUT_SECONDS = 0.1
+
+
+class Deadline:
+    """
+    The point in time by which work must be finished, used to bound
+    request timeouts and to stop starting new work once it has passed.
+
+    Args:
+        seconds (float): The number of seconds from now.
+    """
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context,
+                     reserve: float = DEFAULT_RESERVE_SECONDS
+                     ) -> Optional['Deadline']:
+        """
+        Builds the deadline of a Lambda invocation from its context,
+        keeping reserve seconds back for publishing.
+
+        Returns:
+            Optional[Deadline]: The deadline, or None if the context
+            does not provide the remaining time, e.g. in tests.
+        """
+        get_remaining_time = getattr(
+            context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time is None:
+            return None
+        return cls(get_remaining_time() / 1000 - reserve)
+
+    def remaining(self) -> float:
+        """
+        Returns the number of seconds left, which is negative
+        once the deadline has passed.
+        """
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, default: float) -> float:
+        """
+        Returns the timeout of a request: default, or the time left
+        if that is shorter.
+        """
+        return max(MIN_TIMEOUT_SECONDS, min(default, self.remaining()))
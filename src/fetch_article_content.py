@@ -1,23 +1,337 @@
-import requests
+import codecs
+import functools
+import importlib.util
 import logging
-from bs4 import BeautifulSoup
+import os
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, Optional, Tuple
+from src.clients import get_http_session
+from src.preview_cache import get_preview_cache
+from src.metrics import timed, increment
+from src.rate_limiter import (
+    get_rate_limiter, send_with_backoff, RateLimitTimeout,
+    THROTTLE_STATUS_CODES)
 
+if TYPE_CHECKING:
+    import requests
+    from src.deadline import Deadline
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+PREVIEW_LENGTH = 1000
+STREAM_CHUNK_SIZE = 16 * 1024
+# Applies to connecting and to each read, so a hung page cannot
+# hold a worker for the rest of the invocation
+FETCH_TIMEOUT_SECONDS = 10.0
+# 'lxml' parses with libxml2 in C, 'stdlib' with html.parser without
+# building a DOM, and 'bs4' with BeautifulSoup as previews were first built.
+# 'auto' picks lxml when it is installed and stdlib otherwise.
+PARSER_BACKENDS = ('lxml', 'stdlib', 'bs4')
+# Start tags that close an unclosed <p>, as lxml (libxml2) closes them,
+# so that every backend builds the same preview from malformed pages
+_CLOSES_PARAGRAPH = frozenset((
+    'address', 'blockquote', 'caption', 'center', 'dd', 'dir', 'div', 'dl',
+    'dt', 'fieldset', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
+    'li', 'listing', 'menu', 'ol', 'p', 'pre', 'table', 'tbody', 'td',
+    'th', 'tr', 'ul', 'xmp'))
+# Tags whose text is never part of a preview
+_SKIPPED_TAGS = frozenset(('script', 'style'))
+# Tags without an end tag, which are never left open
+_VOID_TAGS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr'))
+
 
 class FetchPageError(Exception):
     pass
 
 
-def fetch_content_preview(url: str) -> str:
+class _PreviewBuilder:
+    """
+    Builds the content preview from the text of successive paragraphs,
+    collecting the parts in a list that is joined once at the end.
+    """
+
+    def __init__(self, limit: int = PREVIEW_LENGTH):
+        self.limit = limit
+        self.done = False
+        self._parts = []
+        self._length = 0
+
+    def add(self, text: str) -> None:
+        if self.done:
+            return
+        if len(text) + self._length < self.limit:
+            part = text.strip() + ' '
+        else:
+            part = text[:(self.limit - self._length)]
+            self.done = True
+        self._parts.append(part)
+        self._length += len(part)
+
+    @property
+    def preview(self) -> str:
+        return ''.join(self._parts)
+
+
+class _ParagraphPreviewParser(HTMLParser):
+    """
+    Incremental parser that builds the content preview from the text
+    of <p> tags as the page is fed to it, and flags when it is done.
+    It keeps the stack of open tags to close unclosed paragraphs as
+    lxml does, without building a DOM.
+    """
+
+    def __init__(self, limit: int = PREVIEW_LENGTH):
+        super().__init__(convert_charrefs=True)
+        self._builder = _PreviewBuilder(limit)
+        self._open_tags = []
+        self._paragraph = None
+
+    def handle_starttag(self, tag, attrs):
+        if self._paragraph is not None and tag in _CLOSES_PARAGRAPH:
+            self._close_tag('p')
+        if tag not in _VOID_TAGS:
+            self._open_tags.append(tag)
+        if tag == 'p':
+            self._paragraph = []
+
+    def handle_endtag(self, tag):
+        if tag in self._open_tags:
+            self._close_tag(tag)
+
+    def handle_data(self, data):
+        if (self._paragraph is not None and not self.done
+                and self._open_tags[-1] not in _SKIPPED_TAGS):
+            self._paragraph.append(data)
+
+    def _close_tag(self, tag):
+        """Closes the innermost open tag and the tags opened within it."""
+        while self._open_tags:
+            closed = self._open_tags.pop()
+            if closed == 'p':
+                self._end_paragraph()
+            if closed == tag:
+                return
+
+    def _end_paragraph(self):
+        self._builder.add(''.join(self._paragraph))
+        self._paragraph = None
+
+    def close(self):
+        super().close()
+        if self._paragraph is not None:
+            self._end_paragraph()
+        self._open_tags = []
+
+    @property
+    def done(self) -> bool:
+        return self._builder.done
+
+    @property
+    def preview(self) -> str:
+        return self._builder.preview
+
+
+class _LxmlPreviewParser:
+    """
+    Incremental parser backed by lxml, which reports each <p> element
+    as soon as it is closed, so the page is never held as a full tree.
+    """
+
+    def __init__(self, limit: int = PREVIEW_LENGTH):
+        from lxml import etree
+        self._etree = etree
+        self._parser = etree.HTMLPullParser(events=('end',), tag='p')
+        self._builder = _PreviewBuilder(limit)
+
+    def feed(self, data: str) -> None:
+        self._parser.feed(data)
+        self._read_paragraphs()
+
+    def close(self) -> None:
+        self._parser.close()
+        self._read_paragraphs()
+
+    def _read_paragraphs(self) -> None:
+        for _, element in self._parser.read_events():
+            self._etree.strip_elements(
+                element, *_SKIPPED_TAGS, with_tail=False)
+            self._builder.add(''.join(element.itertext()))
+            element.clear(keep_tail=True)
+
+    @property
+    def done(self) -> bool:
+        return self._builder.done
+
+    @property
+    def preview(self) -> str:
+        return self._builder.preview
+
+
+class _Bs4PreviewParser:
+    """
+    Buffers the page and parses it with BeautifulSoup and html.parser
+    once it is closed, as previews were originally built.
+    """
+
+    def __init__(self, limit: int = PREVIEW_LENGTH):
+        self._chunks = []
+        self._builder = _PreviewBuilder(limit)
+
+    def feed(self, data: str) -> None:
+        self._chunks.append(data)
+
+    def close(self) -> None:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(''.join(self._chunks), 'html.parser')
+        self._chunks = []
+        for p in soup.find_all('p'):
+            self._builder.add(_bs4_paragraph_text(p))
+            if self._builder.done:
+                break
+
+    @property
+    def done(self) -> bool:
+        return self._builder.done
+
+    @property
+    def preview(self) -> str:
+        return self._builder.preview
+
+
+def _bs4_paragraph_text(p) -> str:
+    """
+    Returns the text of a <p> tag up to its first tag that would have
+    closed it, since html.parser nests unclosed paragraphs instead.
+    """
+    from bs4 import NavigableString, Tag
+    parts = []
+    for node in p.descendants:
+        if isinstance(node, Tag):
+            if node.name in _CLOSES_PARAGRAPH:
+                break
+        elif (type(node) is NavigableString
+              and node.parent.name not in _SKIPPED_TAGS):
+            parts.append(node)
+    return ''.join(parts)
+
+
+_PARSER_CLASSES = {
+    'lxml': _LxmlPreviewParser,
+    'stdlib': _ParagraphPreviewParser,
+    'bs4': _Bs4PreviewParser,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _is_installed(package: str) -> bool:
+    return importlib.util.find_spec(package) is not None
+
+
+def _create_parser(parser: Optional[str] = None):
+    """
+    Creates a preview parser for a backend in PARSER_BACKENDS or 'auto'.
+    Defaults to the HTML_PARSER environment variable, or 'auto'.
+
+    Raises:
+        ValueError: If the backend is unknown or not installed.
+    """
+    if parser is None:
+        parser = os.environ.get('HTML_PARSER', 'auto')
+    if parser == 'auto':
+        parser = 'lxml' if _is_installed('lxml') else 'stdlib'
+    if parser not in PARSER_BACKENDS:
+        raise ValueError(
+            f'parser must be one of {PARSER_BACKENDS} or auto, '
+            f'got {parser!r}')
+    if parser in ('lxml', 'bs4') and not _is_installed(parser):
+        raise ValueError(
+            f"The {parser!r} parser requires the {parser} package")
+    return _PARSER_CLASSES[parser]()
+
+
+def extract_preview(html: str, parser: Optional[str] = None) -> str:
+    """
+    Extracts the content preview from a full page.
+
+    Args:
+        html (str): The page.
+        parser (str, optional): The parser backend, one of
+        PARSER_BACKENDS or 'auto'. See fetch_content_preview.
+
+    Returns:
+        str: The text of the page's <p> tags, truncated
+        to PREVIEW_LENGTH characters.
+    """
+    preview_parser = _create_parser(parser)
+    preview_parser.feed(html)
+    preview_parser.close()
+    return preview_parser.preview
+
+
+def _stream_preview(response: 'requests.Response', parser,
+                    deadline: Optional['Deadline'] = None
+                    ) -> Tuple[str, bool]:
+    """
+    Extracts the content preview by feeding the response body to an
+    incremental parser chunk by chunk, stopping the download as soon
+    as the preview is complete, or with the preview built so far once
+    the deadline has passed.
+
+    Returns:
+        Tuple[str, bool]: The preview, and whether it is complete.
+    """
+    decoder = codecs.getincrementaldecoder(
+        response.encoding or 'utf-8')(errors='replace')
+    fetched_bytes = 0
+    try:
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            fetched_bytes += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done:
+                return parser.preview, True
+            if deadline is not None and deadline.expired():
+                increment('fetch_content_preview.deadline_truncated')
+                parser.close()
+                return parser.preview, False
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+        return parser.preview, True
+    finally:
+        increment('fetch_content_preview.bytes', fetched_bytes, 'Bytes')
+
+
+@timed('fetch_content_preview')
+def fetch_content_preview(url: str, streaming: bool = True,
+                          use_cache: bool = True,
+                          deadline: Optional['Deadline'] = None,
+                          parser: Optional[str] = None) -> str:
     """
     Fetches the preview content up to 1000 characters
     of a given URL by extracting text from the <p> tags.
 
     Args:
         url (str): The URL of the webpage to fetch content from.
+        streaming (bool, optional): If True, read the page in chunks and
+        close the connection as soon as 1000 characters of paragraph
+        text have been read. If False, download the whole page and
+        parse it in one go. Defaults to True.
+        use_cache (bool, optional): If True, serve fresh previews from
+        the shared preview cache, revalidate stale ones with a
+        conditional GET, and skip URLs that failed recently.
+        Defaults to True.
+        deadline (Deadline, optional): If given, the request times out
+        at the deadline if that is sooner than FETCH_TIMEOUT_SECONDS,
+        is not sent if the rate limiter holds it back past the deadline,
+        and throttled requests are not retried past it. A streamed
+        page stops being read at the deadline, and the preview built
+        so far is returned without being cached.
+        parser (str, optional): The HTML parser backend: 'lxml' (fastest,
+        needs the lxml package), 'stdlib' (html.parser, no DOM) or 'bs4'
+        (BeautifulSoup, needs the whole page even when streaming).
+        Defaults to the HTML_PARSER environment variable, or 'auto',
+        which is lxml if installed and stdlib otherwise.
 
     Returns:
         str: A preview of the webpage content,
@@ -27,22 +341,68 @@ def fetch_content_preview(url: str) -> str:
         FetchPageError: If an error occurs
         while fetching the page.
     """
+    cache = get_preview_cache() if use_cache else None
+    entry = None
+    headers = {}
+    if cache is not None:
+        if cache.has_failed(url):
+            raise FetchPageError("Fetching the page failed recently.")
+        entry = cache.get(url)
+        if entry is None:
+            increment('preview_cache.misses')
+        else:
+            if cache.is_fresh(entry):
+                increment('preview_cache.hits')
+                return entry['preview']
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+    # An unknown or missing backend fails before the page is requested
+    preview_parser = _create_parser(parser)
+    import requests
     try:
-        response = requests.get(url)
+        response = send_with_backoff(
+            get_rate_limiter('pages'),
+            lambda: get_http_session().get(
+                url, stream=streaming, headers=headers,
+                timeout=(FETCH_TIMEOUT_SECONDS if deadline is None
+                         else deadline.timeout(FETCH_TIMEOUT_SECONDS))),
+            deadline=deadline)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            cache.touch(url)
+            increment('preview_cache.revalidations')
+            return entry['preview']
         # Raise HTTPError for bad responses (4xx and 5xx)
         response.raise_for_status()
+        complete = True
+        if streaming:
+            with response:
+                content, complete = _stream_preview(
+                    response, preview_parser, deadline)
+        else:
+            increment('fetch_content_preview.bytes',
+                      len(response.content), 'Bytes')
+            preview_parser.feed(response.text)
+            preview_parser.close()
+            content = preview_parser.preview
     except requests.exceptions.RequestException as e:
+        status_code = getattr(getattr(e, 'response', None),
+                              'status_code', None)
+        # Throttled and timed out pages are not broken, and timeouts may
+        # only reflect a deadline, so they are not negatively cached.
+        if (cache is not None and status_code not in THROTTLE_STATUS_CODES
+                and not isinstance(e, requests.exceptions.Timeout)):
+            cache.put_failure(url)
         logger.error(f"Error fetching the page: {e}")
         raise FetchPageError("Error fetching the page.") from e
+    except RateLimitTimeout as e:
+        logger.error(f"Not fetching the page: {e}")
+        raise FetchPageError("Out of time to fetch the page.") from e
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    content = ''
-    for p in soup.find_all('p'):
-        if len(p.text) + len(content) < 1000:
-            content += p.text.strip() + ' '
-        else:
-            content += p.text[:(1000 - len(content))]
-            break
-
+    if cache is not None and complete:
+        cache.put(url, content, response.headers.get('ETag'),
+                  response.headers.get('Last-Modified'))
     return content
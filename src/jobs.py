@@ -0,0 +1,167 @@
+from src.clients import get_boto3_client
+from typing import Dict, Optional
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+JOB_STATUSES = ('pending', 'running', 'succeeded', 'failed')
+# Finished jobs are dropped from DynamoDB a day after they were created
+JOB_TTL_SECONDS = 24 * 60 * 60
+
+
+def new_job(search_terms, kinesis_stream: str) -> Dict:
+    """
+    Returns a pending job with a new job ID.
+    """
+    now = _now()
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': 'pending',
+        'search_terms': list(search_terms),
+        'kinesis_stream': kinesis_stream,
+        'created_at': now,
+        'updated_at': now,
+        'progress': {'stage': 'queued'},
+    }
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec='milliseconds')
+
+
+class MemoryJobStore:
+    """
+    Job store that keeps the jobs in a dict, for a single process.
+
+    Like every job store, it has create, get and update, and claim,
+    which marks a pending job as running and returns False if the job
+    was already claimed, e.g. when its invocation is delivered twice.
+    A job the store does not know is claimed, and recorded as running.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: Dict) -> None:
+        with self._lock:
+            self._jobs[job['job_id']] = dict(job)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def claim(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id, {'job_id': job_id})
+            if job.get('status', 'pending') != 'pending':
+                return False
+            self._jobs[job_id] = {
+                **job, 'status': 'running', 'updated_at': _now()}
+            return True
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            self._jobs[job_id] = {
+                **self._jobs.get(job_id, {'job_id': job_id}),
+                **fields, 'updated_at': _now()}
+
+
+class DynamoDBJobStore:
+    """
+    Job store backed by a DynamoDB table with the string partition key
+    'job_id'. Each job is stored as JSON in the 'job' attribute, and
+    'expires_at' can be enabled as the table's TTL attribute.
+
+    Args:
+        table_name (str): The name of the DynamoDB table.
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+
+    def _put(self, job: Dict, **put_kwargs) -> None:
+        get_boto3_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item={
+                'job_id': {'S': job['job_id']},
+                'job': {'S': json.dumps(job, ensure_ascii=False)},
+                'expires_at': {'N': str(int(time.time()) + JOB_TTL_SECONDS)},
+            },
+            **put_kwargs)
+
+    def create(self, job: Dict) -> None:
+        self._put(job)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        item = get_boto3_client('dynamodb').get_item(
+            TableName=self.table_name, Key={'job_id': {'S': job_id}},
+            ConsistentRead=True).get('Item')
+        return json.loads(item['job']['S']) if item else None
+
+    def claim(self, job_id: str) -> bool:
+        client = get_boto3_client('dynamodb')
+        item = client.get_item(
+            TableName=self.table_name, Key={'job_id': {'S': job_id}},
+            ConsistentRead=True).get('Item')
+        job = json.loads(item['job']['S']) if item else {'job_id': job_id}
+        if job.get('status', 'pending') != 'pending':
+            return False
+        # Only written if the job is unchanged since it was read, so
+        # that of two invocations claiming it at once only one wins
+        if item:
+            condition = {'ConditionExpression': 'job = :job',
+                         'ExpressionAttributeValues': {':job': item['job']}}
+        else:
+            condition = {
+                'ConditionExpression': 'attribute_not_exists(job_id)'}
+        try:
+            self._put({**job, 'status': 'running', 'updated_at': _now()},
+                      **condition)
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def update(self, job_id: str, **fields) -> None:
+        # Only the invocation running the job writes to it once it is
+        # created, so reading and rewriting the item cannot lose updates.
+        job = self.get(job_id) or {'job_id': job_id}
+        self._put({**job, **fields, 'updated_at': _now()})
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """
+    Returns the shared job store, creating it on first use.
+
+    Jobs are kept in the DynamoDB table named by the JOBS_TABLE
+    environment variable when it is set, so that the invocation
+    running a job and the ones looking it up share them, and in
+    memory otherwise.
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                table_name = os.environ.get('JOBS_TABLE')
+                _default_store = (DynamoDBJobStore(table_name) if table_name
+                                  else MemoryJobStore())
+    return _default_store
+
+
+def set_job_store(store) -> None:
+    """
+    Replaces the shared job store. Passing None makes the next
+    call to get_job_store create a new one.
+    """
+    global _default_store
+    with _default_store_lock:
+        _default_store = store
@@ -0,0 +1,58 @@
+from typing import Any, Dict, Optional
+import json
+import os
+import threading
+
+
+class MemoryKeyedStore:
+    """
+    Store of JSON-serialisable values by string key, kept in a dict
+    for a single process.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._values.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._values[key] = value
+
+
+class JsonFileStore:
+    """
+    Store of JSON-serialisable values by string key, backed by a JSON
+    file mapping each key to its value. The file is replaced atomically
+    on every write, so a reader never sees a partly written file.
+
+    Args:
+        path (str): The path of the JSON file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            values = self._load()
+            values[key] = value
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(values, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,317 @@
+from src.clients import get_boto3_client
+from src.json_store import MemoryKeyedStore, JsonFileStore
+from src.kpl_aggregation import deaggregate, DeaggregationError
+from src.metrics import increment
+from src.record_encoding import decode_record, RecordDecodeError
+from typing import Dict, Iterator, List, Optional
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ITERATOR_TYPES = ('TRIM_HORIZON', 'LATEST')
+DEFAULT_BATCH_LIMIT = 1000
+DEFAULT_POLL_INTERVAL_SECONDS = 1.0
+DEFAULT_QUEUE_SIZE = 16
+# GetRecords allows five calls per second per shard
+MIN_GET_RECORDS_INTERVAL_SECONDS = 0.2
+THROTTLE_BACKOFF_SECONDS = 1.0
+
+
+class _ShardCheckpointKeys:
+    """
+    Keys the checkpoint of each shard by '<stream name>/<shard id>'.
+    """
+
+    def get(self, stream_name: str, shard_id: str) -> Optional[str]:
+        return super().get(f'{stream_name}/{shard_id}')
+
+    def set(self, stream_name: str, shard_id: str,
+            sequence_number: str) -> None:
+        super().set(f'{stream_name}/{shard_id}', sequence_number)
+
+
+class MemoryCheckpointStore(_ShardCheckpointKeys, MemoryKeyedStore):
+    """
+    Checkpoint store that keeps the sequence numbers in a dict,
+    for a single process.
+    """
+
+
+class FileCheckpointStore(_ShardCheckpointKeys, JsonFileStore):
+    """
+    Checkpoint store backed by a JSON file mapping each
+    '<stream name>/<shard id>' to its last processed sequence number.
+
+    Args:
+        path (str): The path of the JSON file.
+    """
+
+
+class ShardBatch:
+    """
+    The articles decoded from one GetRecords call on a shard.
+
+    Attributes:
+        shard_id (str): The shard the records were read from.
+        articles (List[Dict]): The decoded articles, in shard order.
+        sequence_number (str): The sequence number of the last record,
+        which is checkpointed once the batch has been processed.
+        millis_behind_latest (int): How far the shard's reader is
+        behind the tip of the stream, as reported by Kinesis.
+        lag_seconds (float): The time between the last record arriving
+        in Kinesis and it being read.
+    """
+
+    def __init__(self, shard_id: str, articles: List[Dict],
+                 sequence_number: str, millis_behind_latest: int,
+                 lag_seconds: float):
+        self.shard_id = shard_id
+        self.articles = articles
+        self.sequence_number = sequence_number
+        self.millis_behind_latest = millis_behind_latest
+        self.lag_seconds = lag_seconds
+
+
+class _ShardDone:
+    pass
+
+
+class _WorkerError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def decode_records(records: List[Dict]) -> List[Dict]:
+    """
+    Decodes Kinesis records written by publish_to_kinesis into articles,
+    splitting KPL aggregated records and reading every record encoding.
+    Records that cannot be decoded are logged and skipped.
+
+    Args:
+        records (List[Dict]): Records with 'Data' and 'PartitionKey'
+        keys, e.g. from GetRecords.
+
+    Returns:
+        List[Dict]: The articles.
+    """
+    articles = []
+    for record in records:
+        try:
+            for user_record in deaggregate(record):
+                articles.append(decode_record(user_record['Data']))
+        except (DeaggregationError, RecordDecodeError) as e:
+            logger.error(f'Skipping record '
+                         f'{record.get("SequenceNumber")}: {e}')
+            increment('consumer.decode_errors')
+    return articles
+
+
+def _list_shards(kinesis_client, stream_name: str) -> List[Dict]:
+    shards = []
+    kwargs = {'StreamName': stream_name}
+    while True:
+        response = kinesis_client.list_shards(**kwargs)
+        shards.extend(response['Shards'])
+        if not response.get('NextToken'):
+            return shards
+        kwargs = {'NextToken': response['NextToken']}
+
+
+class KinesisConsumer:
+    """
+    Reads the articles published to a Kinesis stream, with one worker
+    thread per shard.
+
+    Each worker polls its shard with GetRecords and decodes every
+    response into a ShardBatch. Batches from all shards are merged into
+    one iterator, in order within each shard. A batch's sequence number
+    is checkpointed when the next batch is requested, so after a restart
+    reading resumes after the last processed batch, and every article is
+    processed at least once. Child shards created by resharding are only
+    read once their parents have been read to the end.
+
+    Args:
+        stream_name (str): The name of the Kinesis stream.
+        checkpoint_store (optional): Where the sequence numbers are
+        checkpointed. Defaults to a new MemoryCheckpointStore.
+        iterator_type (str, optional): Where shards without a checkpoint
+        are read from, 'TRIM_HORIZON' (the oldest record) or 'LATEST'.
+        Defaults to 'TRIM_HORIZON'.
+        batch_limit (int, optional): The maximum number of records
+        read per GetRecords call. Defaults to DEFAULT_BATCH_LIMIT.
+        poll_interval (float, optional): Seconds a worker waits after
+        reading no records. Defaults to DEFAULT_POLL_INTERVAL_SECONDS.
+        stop_at_latest (bool, optional): If True, each worker stops once
+        it has caught up with the tip of its shard, so that iteration
+        ends. Defaults to False, which reads until stop is called.
+        queue_size (int, optional): The maximum number of batches
+        waiting to be processed. Defaults to DEFAULT_QUEUE_SIZE.
+    """
+
+    def __init__(self, stream_name: str, checkpoint_store=None,
+                 iterator_type: str = 'TRIM_HORIZON',
+                 batch_limit: int = DEFAULT_BATCH_LIMIT,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL_SECONDS,
+                 stop_at_latest: bool = False,
+                 queue_size: int = DEFAULT_QUEUE_SIZE):
+        if iterator_type not in ITERATOR_TYPES:
+            raise ValueError(
+                f'iterator_type must be one of {ITERATOR_TYPES}, '
+                f'got {iterator_type!r}')
+        self.stream_name = stream_name
+        self.checkpoint_store = (checkpoint_store if checkpoint_store
+                                 is not None else MemoryCheckpointStore())
+        self.iterator_type = iterator_type
+        self.batch_limit = batch_limit
+        self.poll_interval = poll_interval
+        self.stop_at_latest = stop_at_latest
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        """
+        Stops the workers. Iteration ends once the batches
+        already read have been processed.
+        """
+        self._stop.set()
+
+    def iter_articles(self) -> Iterator[Dict]:
+        """
+        Yields the articles of the stream. See iter_batches.
+        """
+        for batch in self.iter_batches():
+            yield from batch.articles
+
+    def iter_batches(self) -> Iterator[ShardBatch]:
+        """
+        Reads all the shards of the stream in parallel.
+
+        Yields:
+            ShardBatch: The articles of each GetRecords call that
+            returned records.
+
+        Raises:
+            Exception: Any error that stopped a worker, other than
+            throttling and expired shard iterators, which are retried.
+        """
+        kinesis_client = get_boto3_client('kinesis')
+        shards = _list_shards(kinesis_client, self.stream_name)
+        self._stop.clear()
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        finished = {shard['ShardId']: threading.Event() for shard in shards}
+        workers = [
+            threading.Thread(
+                target=self._read_shard,
+                args=(kinesis_client, shard, finished, batch_queue),
+                daemon=True)
+            for shard in shards]
+        for worker in workers:
+            worker.start()
+
+        running = len(workers)
+        try:
+            while running:
+                try:
+                    item = batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    # Once stopped, workers exit without queueing their
+                    # done markers, so end when none is left running.
+                    if self._stop.is_set() and not any(
+                            worker.is_alive() for worker in workers):
+                        return
+                    continue
+                if isinstance(item, _ShardDone):
+                    running -= 1
+                    continue
+                if isinstance(item, _WorkerError):
+                    raise item.error
+                yield item
+                self.checkpoint_store.set(
+                    self.stream_name, item.shard_id, item.sequence_number)
+        finally:
+            self._stop.set()
+
+    def _put(self, batch_queue: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _shard_iterator(self, kinesis_client, shard_id: str,
+                        sequence_number: Optional[str]) -> str:
+        kwargs = {'StreamName': self.stream_name, 'ShardId': shard_id}
+        if sequence_number is not None:
+            kwargs['ShardIteratorType'] = 'AFTER_SEQUENCE_NUMBER'
+            kwargs['StartingSequenceNumber'] = sequence_number
+        else:
+            kwargs['ShardIteratorType'] = self.iterator_type
+        return kinesis_client.get_shard_iterator(**kwargs)['ShardIterator']
+
+    def _read_shard(self, kinesis_client, shard: Dict,
+                    finished: Dict[str, threading.Event],
+                    batch_queue: queue.Queue) -> None:
+        """
+        Reads one shard until it is closed, caught up with (if
+        stop_at_latest) or the consumer is stopped.
+        """
+        from botocore.exceptions import ClientError
+        shard_id = shard['ShardId']
+        try:
+            for key in ('ParentShardId', 'AdjacentParentShardId'):
+                parent = finished.get(shard.get(key))
+                while parent is not None and not parent.wait(0.1):
+                    if self._stop.is_set():
+                        return
+            sequence_number = self.checkpoint_store.get(
+                self.stream_name, shard_id)
+            iterator = self._shard_iterator(
+                kinesis_client, shard_id, sequence_number)
+            last_call = 0.0
+            while iterator is not None and not self._stop.is_set():
+                self._stop.wait(max(0.0, last_call
+                                    + MIN_GET_RECORDS_INTERVAL_SECONDS
+                                    - time.monotonic()))
+                last_call = time.monotonic()
+                try:
+                    response = kinesis_client.get_records(
+                        ShardIterator=iterator, Limit=self.batch_limit)
+                except ClientError as e:
+                    code = e.response['Error']['Code']
+                    if code == 'ProvisionedThroughputExceededException':
+                        increment('consumer.throttled')
+                        self._stop.wait(THROTTLE_BACKOFF_SECONDS)
+                        continue
+                    if code == 'ExpiredIteratorException':
+                        iterator = self._shard_iterator(
+                            kinesis_client, shard_id, sequence_number)
+                        continue
+                    raise
+                iterator = response.get('NextShardIterator')
+                records = response['Records']
+                millis_behind_latest = response.get('MillisBehindLatest', 0)
+                if records:
+                    sequence_number = records[-1]['SequenceNumber']
+                    arrived_at = records[-1]['ApproximateArrivalTimestamp']
+                    increment('consumer.records', len(records))
+                    batch = ShardBatch(
+                        shard_id, decode_records(records), sequence_number,
+                        millis_behind_latest,
+                        time.time() - arrived_at.timestamp())
+                    if not self._put(batch_queue, batch):
+                        return
+                elif self.stop_at_latest and millis_behind_latest == 0:
+                    break
+                else:
+                    self._stop.wait(self.poll_interval)
+        except Exception as e:
+            logger.error(f'Failed to read shard {shard_id}: {e}')
+            self._put(batch_queue, _WorkerError(e))
+        finally:
+            finished[shard_id].set()
+            self._put(batch_queue, _ShardDone())
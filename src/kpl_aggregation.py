@@ -0,0 +1,216 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import hashlib
+
+# Aggregated records follow the Kinesis Producer Library format: these
+# magic bytes, a protobuf-encoded AggregatedRecord message, and the MD5
+# digest of that message. See aggregation-format.md in the KPL repository.
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+# The KPL's default AggregationMaxSize
+DEFAULT_MAX_AGGREGATED_BYTES = 51200
+
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+
+class DeaggregationError(Exception):
+    pass
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _key(field_number: int, wire_type: int) -> bytes:
+    return _varint((field_number << 3) | wire_type)
+
+
+def _length_delimited(field_number: int, value: bytes) -> bytes:
+    return _key(field_number, _LENGTH_DELIMITED) + _varint(len(value)) + value
+
+
+def _encode_record(partition_key_index: int,
+                   explicit_hash_key_index: Optional[int],
+                   data: bytes) -> bytes:
+    message = _key(1, _VARINT) + _varint(partition_key_index)
+    if explicit_hash_key_index is not None:
+        message += _key(2, _VARINT) + _varint(explicit_hash_key_index)
+    return message + _length_delimited(3, data)
+
+
+def _read_varint(buffer: bytes, position: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(buffer):
+            raise DeaggregationError('Truncated varint')
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _read_fields(buffer: bytes) -> Iterator[Tuple[int, object]]:
+    """
+    Yields the (field number, value) pairs of a protobuf message,
+    with varints as ints and length-delimited fields as bytes.
+    """
+    position = 0
+    while position < len(buffer):
+        key, position = _read_varint(buffer, position)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == _VARINT:
+            value, position = _read_varint(buffer, position)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, position = _read_varint(buffer, position)
+            if position + length > len(buffer):
+                raise DeaggregationError('Truncated field')
+            value = buffer[position:position + length]
+            position += length
+        else:
+            raise DeaggregationError(f'Unsupported wire type {wire_type}')
+        yield field_number, value
+
+
+class RecordAggregator:
+    """
+    Packs user records into one KPL aggregated record.
+
+    Args:
+        max_bytes (int, optional): The maximum size of the aggregated
+        record. Defaults to DEFAULT_MAX_AGGREGATED_BYTES.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_AGGREGATED_BYTES):
+        self.max_bytes = max_bytes
+        self._partition_keys: Dict[str, int] = {}
+        self._explicit_hash_keys: Dict[str, int] = {}
+        self._messages: List[bytes] = []
+        self._size = len(KPL_MAGIC) + DIGEST_SIZE
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def _added_size(self, partition_key: str,
+                    explicit_hash_key: Optional[str], data: bytes) -> int:
+        size = 0
+        partition_key_index = self._partition_keys.get(partition_key)
+        if partition_key_index is None:
+            partition_key_index = len(self._partition_keys)
+            size += len(_length_delimited(1, partition_key.encode('utf-8')))
+        explicit_hash_key_index = None
+        if explicit_hash_key is not None:
+            explicit_hash_key_index = self._explicit_hash_keys.get(
+                explicit_hash_key, len(self._explicit_hash_keys))
+            if explicit_hash_key not in self._explicit_hash_keys:
+                size += len(_length_delimited(
+                    2, explicit_hash_key.encode('utf-8')))
+        message = _encode_record(
+            partition_key_index, explicit_hash_key_index, data)
+        return size + len(_length_delimited(3, message))
+
+    def add(self, partition_key: str, explicit_hash_key: Optional[str],
+            data: bytes) -> bool:
+        """
+        Adds a user record, unless it would make the aggregated record
+        larger than max_bytes.
+
+        Returns:
+            bool: True if the record was added. The first record is
+            always added, whatever its size.
+        """
+        added_size = self._added_size(partition_key, explicit_hash_key, data)
+        if self._messages and self._size + added_size > self.max_bytes:
+            return False
+        partition_key_index = self._partition_keys.setdefault(
+            partition_key, len(self._partition_keys))
+        explicit_hash_key_index = None
+        if explicit_hash_key is not None:
+            explicit_hash_key_index = self._explicit_hash_keys.setdefault(
+                explicit_hash_key, len(self._explicit_hash_keys))
+        self._messages.append(_encode_record(
+            partition_key_index, explicit_hash_key_index, data))
+        self._size += added_size
+        return True
+
+    def serialize(self) -> bytes:
+        """
+        Returns the aggregated record's data.
+        """
+        message = b''.join(
+            [_length_delimited(1, key.encode('utf-8'))
+             for key in self._partition_keys]
+            + [_length_delimited(2, key.encode('utf-8'))
+               for key in self._explicit_hash_keys]
+            + [_length_delimited(3, record) for record in self._messages])
+        return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
+def is_aggregated(data: bytes) -> bool:
+    """
+    Returns True if the record data is a KPL aggregated record.
+    """
+    return (data[:len(KPL_MAGIC)] == KPL_MAGIC
+            and len(data) >= len(KPL_MAGIC) + DIGEST_SIZE)
+
+
+def deaggregate(record: Dict) -> List[Dict]:
+    """
+    Splits a Kinesis record into its user records, in the same way as the
+    KCL's deaggregation. Records that are not aggregated are returned
+    unchanged.
+
+    Args:
+        record (Dict): A record with 'Data' and 'PartitionKey' keys,
+        e.g. from GetRecords.
+
+    Returns:
+        List[Dict]: The user records, each with 'Data', 'PartitionKey'
+        and, if set, 'ExplicitHashKey'.
+
+    Raises:
+        DeaggregationError: If the record has the KPL magic bytes
+        but its checksum or protobuf body is invalid.
+    """
+    data = record['Data']
+    if not is_aggregated(data):
+        return [record]
+    message = data[len(KPL_MAGIC):-DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-DIGEST_SIZE:]:
+        raise DeaggregationError('Aggregated record checksum mismatch')
+
+    partition_keys = []
+    explicit_hash_keys = []
+    records = []
+    for field_number, value in _read_fields(message):
+        if field_number == 1:
+            partition_keys.append(value.decode('utf-8'))
+        elif field_number == 2:
+            explicit_hash_keys.append(value.decode('utf-8'))
+        elif field_number == 3:
+            records.append(value)
+
+    user_records = []
+    for message in records:
+        fields = dict(_read_fields(message))
+        try:
+            user_record = {
+                'Data': fields[3],
+                'PartitionKey': partition_keys[fields[1]],
+            }
+            if 2 in fields:
+                user_record['ExplicitHashKey'] = explicit_hash_keys[fields[2]]
+        except (KeyError, IndexError) as e:
+            raise DeaggregationError(f'Invalid user record: {e}') from e
+        user_records.append(user_record)
+    return user_records
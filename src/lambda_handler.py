@@ -1,46 +1,580 @@
-from src.retrieve_articles import retrieve_articles
-from src.publish_to_kinesis import publish_to_kinesis
+from src.retrieve_articles import (
+    retrieve_articles, iter_articles, API_KEY_SECRET_NAME, PREVIEW_SOURCES,
+    PREVIEW_NOT_AVAILABLE)
+from src.retrieve_api_key import get_api_key
+from src.publish_to_kinesis import (
+    publish_to_kinesis, publish_records, publish_result_message,
+    PARTITION_STRATEGIES)
+from src.record_encoding import ENCODINGS
+from src.clients import get_boto3_client
+from src.jobs import new_job, get_job_store
+from src.query_cache import get_query_cache
+from src.pipeline import stream_to_kinesis
+from src.seen_index import get_seen_index
+from src.watermarks import get_watermark_store, advance_watermark
+from src.metrics import timer, increment, flush_metrics
+from src.deadline import Deadline, DEFAULT_RESERVE_SECONDS
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional, Tuple
 import logging
 import json
+import os
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_MAX_CONCURRENT_TERMS = 8
+# Marks the events of asynchronous invocations that run a job
+JOB_EVENT_KEY = 'run_job'
+# 'publish' sends cached articles to Kinesis again, 'return' only
+# returns them in the response
+CACHE_HIT_ACTIONS = ('publish', 'return')
+# The retrieve_articles arguments that identify a cached query
+CACHE_KEY_FIELDS = ('from_date', 'preview_source', 'page_size',
+                    'max_results', 'order_by')
 
-def lambda_handler(event, context):
+
+def _is_enabled(query_params: Dict, name: str) -> bool:
+    return str(query_params.get(name, 'false')).lower() == 'true'
+
+
+def _no_progress(stage: str, **details) -> None:
+    pass
+
+
+def _search_terms(event: Dict) -> List[str]:
     """
-    The Lambda handler function that gets invoked when the API endpoint is hit
+    Returns the search terms of the request. Several terms can be given
+    by repeating search_term, or as a comma-separated search_terms.
     """
-    try:
-        query_params = event.get('queryStringParameters', {})
-        search_term = query_params.get('search_term')
-        kinesis_stream = query_params.get('kinesis_stream')
-        from_date = query_params.get('from_date')
-        if not search_term or not kinesis_stream:
+    query_params = event.get('queryStringParameters') or {}
+    multi_params = event.get('multiValueQueryStringParameters') or {}
+    search_terms = list(multi_params.get('search_term') or [])
+    if not search_terms and query_params.get('search_term'):
+        search_terms = [query_params['search_term']]
+    if query_params.get('search_terms'):
+        search_terms += query_params['search_terms'].split(',')
+    search_terms = [term.strip() for term in search_terms if term.strip()]
+    return list(dict.fromkeys(search_terms))
+
+
+def _retrieve_kwargs(search_term: str, query_params: Dict,
+                     deadline: Optional[Deadline] = None) -> Dict:
+    """
+    Builds the retrieve_articles arguments for a search term from the
+    options in the query parameters.
+    """
+    max_results = int(query_params.get('max_results', 10))
+    hedge_after = query_params.get('hedge_after')
+    retrieve_kwargs = {
+        'seen_index': (get_seen_index()
+                       if _is_enabled(query_params, 'dedupe') else None),
+        'from_date': query_params.get('from_date'),
+        'preview_source': query_params.get('preview_source', 'page'),
+        'page_size': min(max_results, 200) or 1,
+        'max_results': max_results,
+        'deadline': deadline,
+        'hedge_after': float(hedge_after) if hedge_after else None,
+    }
+    if _is_enabled(query_params, 'incremental'):
+        # Only query what was published since the last successful poll
+        watermark = get_watermark_store().get(search_term)
+        retrieve_kwargs['watermark'] = watermark
+        if watermark is not None:
+            retrieve_kwargs['from_date'] = watermark['date'][:10]
+        # Oldest first from a start date, so that a poll capped by
+        # max_results or the deadline retrieves the articles right after
+        # the watermark, and the watermark never skips over any. Without
+        # one, the first poll starts from the newest articles.
+        retrieve_kwargs['order_by'] = (
+            'oldest' if retrieve_kwargs['from_date'] else 'newest')
+    return retrieve_kwargs
+
+
+def _use_cache(query_params: Dict) -> bool:
+    return str(query_params.get('cache', 'true')).lower() != 'false'
+
+
+def _republish_cached(query_params: Dict) -> bool:
+    return query_params.get('on_cache_hit', 'publish') == 'publish'
+
+
+def _cached_result_message(count: int, stream_name: str) -> str:
+    return (f"Returned {count} cached records without adding them "
+            f"to Kinesis stream: {stream_name}")
+
+
+def _has_missing_previews(articles: List[Dict]) -> bool:
+    return any(article.get('contentPreview', '').startswith(
+        PREVIEW_NOT_AVAILABLE) for article in articles)
+
+
+def _retrieve(search_term: str, retrieve_kwargs: Dict,
+              use_cache: bool = False) -> Tuple[List[Dict], bool]:
+    """
+    Retrieves the articles for a search term, dropping the ones
+    already published if deduplication is enabled.
+
+    With use_cache, articles retrieved for an identical query within
+    the query cache's TTL are reused. Incremental queries are never
+    cached, as each poll moves their watermark, and neither are
+    articles cut short by the deadline or with a preview that could
+    not be fetched.
+
+    Returns:
+        Tuple[List[Dict], bool]: The articles, and whether they
+        came from the query cache.
+    """
+    cache = get_query_cache() if use_cache else None
+    if cache is None or 'watermark' in retrieve_kwargs:
+        articles = retrieve_articles(search_term, **retrieve_kwargs)
+        cached = False
+    else:
+        deadline = retrieve_kwargs.get('deadline')
+        dedupe = retrieve_kwargs['seen_index'] is not None
+        key = (search_term, dedupe) + tuple(
+            retrieve_kwargs.get(name) for name in CACHE_KEY_FIELDS)
+        articles, cached = cache.get_or_fetch(
+            key, lambda: retrieve_articles(search_term, **retrieve_kwargs),
+            # Articles cut short by the deadline are incomplete, and
+            # previews that failed are retried by the next request
+            cacheable=lambda articles: (
+                (deadline is None or not deadline.expired())
+                and not _has_missing_previews(articles)),
+            timeout=deadline.remaining() if deadline is not None else None)
+    seen_index = retrieve_kwargs['seen_index']
+    if seen_index is not None:
+        articles = seen_index.filter_unseen(articles)
+    return articles, cached
+
+
+def _record_published(search_term: str, retrieve_kwargs: Dict,
+                      articles: List[Dict],
+                      published_articles: List[Dict]) -> None:
+    """
+    Records the published articles in the seen index and advances the
+    watermark of the search term, if those options are enabled.
+    """
+    seen_index = retrieve_kwargs['seen_index']
+    if seen_index is not None:
+        seen_index.mark(published_articles)
+    if 'watermark' in retrieve_kwargs:
+        watermark = retrieve_kwargs['watermark']
+        new_watermark = advance_watermark(
+            watermark, articles, published_articles)
+        if new_watermark != watermark:
+            get_watermark_store().set(search_term, new_watermark)
+
+
+def _validate_params(query_params: Dict) -> None:
+    """
+    Checks the options in the query parameters up front, so that an
+    asynchronous request with invalid options fails before it is queued.
+
+    Raises:
+        ValueError: If an option is invalid.
+    """
+    if int(query_params.get('max_results', 10)) < 0:
+        raise ValueError('max_results must not be negative')
+    for name in ('term_timeout', 'hedge_after'):
+        if query_params.get(name):
+            float(query_params[name])
+    for name, default, choices in (
+            ('on_cache_hit', 'publish', CACHE_HIT_ACTIONS),
+            ('preview_source', 'page', PREVIEW_SOURCES),
+            ('partition_strategy', 'term', PARTITION_STRATEGIES),
+            ('encoding', 'json', ENCODINGS)):
+        value = query_params.get(name, default)
+        if value not in choices:
             raise ValueError(
-                "search_term and kinesis_stream are required parameters")
-        logger.info(f'## Input Parameters: Search term ({search_term}), '
-                    f'Date ({from_date}), Kinesis stream ({kinesis_stream})'
-                    )
-        articles = retrieve_articles(search_term, from_date=from_date)
-        result, published_articles = publish_to_kinesis(
-            kinesis_stream, search_term, articles)
-        response = {
-            "statusCode": 200,
-            "headers": {
-                "Content-Type": "application/json; charset=utf-8"
-            },
-            "body": json.dumps(
-                {'result': result, 'articles_published': published_articles},
-                indent=4,
-                ensure_ascii=False
-            )
-        }
+                f'{name} must be one of {choices}, got {value!r}')
+
+
+def _retrieve_and_publish(search_term: str, kinesis_stream: str,
+                          query_params: Dict,
+                          deadline: Optional[Deadline] = None,
+                          progress: Callable = _no_progress) -> Dict:
+    """
+    Retrieves the articles for a search term and publishes them
+    to the Kinesis stream, following the options in the query parameters.
+
+    Returns:
+        Dict: The body of the response, with 'result' and
+        'articles_published'. Articles from the query cache are marked
+        'cached', and with on_cache_hit=return they are returned in
+        'articles' rather than published.
+    """
+    retrieve_kwargs = _retrieve_kwargs(search_term, query_params, deadline)
+    partition_strategy = query_params.get('partition_strategy', 'term')
+    encoding = query_params.get('encoding', 'json')
+    aggregate = _is_enabled(query_params, 'aggregate')
+    if (_is_enabled(query_params, 'pipeline')
+            and 'watermark' not in retrieve_kwargs):
+        # Publish micro-batches while the remaining previews are fetched
+        progress('streaming')
+        result, published_articles = stream_to_kinesis(
+            iter_articles(search_term, **retrieve_kwargs),
+            kinesis_stream, search_term,
+            seen_index=retrieve_kwargs['seen_index'],
+            partition_strategy=partition_strategy, encoding=encoding,
+            aggregate=aggregate)
+        return {'result': result, 'articles_published': published_articles}
+
+    articles, cached = _retrieve(
+        search_term, retrieve_kwargs, _use_cache(query_params))
+    if cached and not _republish_cached(query_params):
+        return {'result': _cached_result_message(
+                    len(articles), kinesis_stream),
+                'articles_published': [], 'cached': True,
+                'articles': articles}
+    progress('publishing', articles_retrieved=len(articles))
+    result, published_articles = publish_to_kinesis(
+        kinesis_stream, search_term, articles, batched=True,
+        partition_strategy=partition_strategy, encoding=encoding,
+        aggregate=aggregate)
+    _record_published(
+        search_term, retrieve_kwargs, articles, published_articles)
+    body = {'result': result, 'articles_published': published_articles}
+    if cached:
+        body['cached'] = True
+    return body
+
+
+def _retrieve_and_publish_many(search_terms: List[str], kinesis_stream: str,
+                               query_params: Dict,
+                               deadline: Optional[Deadline] = None,
+                               progress: Callable = _no_progress
+                               ) -> List[Dict]:
+    """
+    Retrieves the articles of several search terms concurrently and
+    publishes them to the Kinesis stream in shared PutRecords batches,
+    each article keyed by its own search term.
+
+    A term that fails, or takes longer than the term_timeout query
+    parameter (in seconds) from when a worker starts on it, or runs past
+    the deadline, is reported with an error without holding back the
+    other terms. A timed out term is given up on: its retrieval stops at
+    its own deadline, and whatever it returns afterwards is discarded
+    rather than published.
+
+    Returns:
+        List[Dict]: One result per search term, with either 'result' and
+        'articles_published', or 'error'. Terms answered from the query
+        cache are marked 'cached', as in _retrieve_and_publish.
+    """
+    max_concurrent = int(query_params.get(
+        'max_concurrent_terms', DEFAULT_MAX_CONCURRENT_TERMS))
+    term_timeout = query_params.get('term_timeout')
+    term_timeout = float(term_timeout) if term_timeout else None
+    use_cache = _use_cache(query_params)
+    # The deadline of each term that a worker has started on
+    term_deadlines = {}
+
+    def retrieve_term(term, retrieve_kwargs):
+        # A term's timeout runs from when it starts, not from when it
+        # was queued behind the other terms
+        if term_timeout is not None:
+            term_deadline = Deadline(term_timeout)
+            if deadline is not None and deadline.remaining() < term_timeout:
+                term_deadline = deadline
+            term_deadlines[term] = term_deadline
+            retrieve_kwargs = {**retrieve_kwargs, 'deadline': term_deadline}
+        return _retrieve(term, retrieve_kwargs, use_cache)
+
+    def wait_timeout(pending):
+        # Wake up when the first started term or the deadline expires.
+        # A term starting meanwhile expires at least term_timeout later.
+        timeouts = [term_deadlines[term].remaining()
+                    for term in (futures[future][0] for future in pending)
+                    if term in term_deadlines]
+        if term_timeout is not None:
+            timeouts.append(term_timeout)
+        if deadline is not None:
+            timeouts.append(deadline.remaining())
+        return max(0.0, min(timeouts)) if timeouts else None
+
+    # Warm the API key cache once rather than once per term
+    get_api_key(API_KEY_SECRET_NAME)
+
+    results = {term: {'search_term': term} for term in search_terms}
+    retrieved = {}
+    executor = ThreadPoolExecutor(
+        max_workers=min(max_concurrent, len(search_terms)))
+    try:
+        futures = {}
+        for term in search_terms:
+            try:
+                retrieve_kwargs = _retrieve_kwargs(
+                    term, query_params, deadline)
+            except Exception as e:
+                results[term]['error'] = str(e)
+                continue
+            futures[executor.submit(
+                retrieve_term, term, retrieve_kwargs)] = (
+                term, retrieve_kwargs)
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=wait_timeout(pending),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                term, retrieve_kwargs = futures[future]
+                try:
+                    articles, cached = future.result()
+                except Exception as e:
+                    logger.error(
+                        f'Failed to retrieve articles for {term}: {e}')
+                    results[term]['error'] = str(e)
+                    continue
+                if cached:
+                    results[term]['cached'] = True
+                    if not _republish_cached(query_params):
+                        results[term]['result'] = _cached_result_message(
+                            len(articles), kinesis_stream)
+                        results[term]['articles_published'] = []
+                        results[term]['articles'] = articles
+                        continue
+                retrieved[term] = (articles, retrieve_kwargs)
+            for future in list(pending):
+                term, _ = futures[future]
+                term_deadline = term_deadlines.get(term, deadline)
+                if term_deadline is None or not term_deadline.expired():
+                    continue
+                # Given up on: the future is never collected, so its
+                # articles are never published
+                pending.discard(future)
+                future.cancel()
+                logger.error(f'Retrieving articles for {term} timed out')
+                increment('lambda_handler.terms_timed_out')
+                results[term]['error'] = (
+                    f'Timed out after {term_timeout:g} seconds'
+                    if term in term_deadlines
+                    else 'Timed out at the deadline')
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    entries = []
+    owners = []
+    for term in search_terms:
+        if term in retrieved:
+            for article in retrieved[term][0]:
+                entries.append((term, article))
+                owners.append(term)
+    published_by_term = {term: [] for term in retrieved}
+    progress('publishing', articles_retrieved=len(entries))
+    if entries:
+        for index in publish_records(
+                kinesis_stream, entries,
+                partition_strategy=query_params.get(
+                    'partition_strategy', 'term'),
+                encoding=query_params.get('encoding', 'json'),
+                aggregate=_is_enabled(query_params, 'aggregate')):
+            published_by_term[owners[index]].append(entries[index][1])
+
+    for term, (articles, retrieve_kwargs) in retrieved.items():
+        published_articles = published_by_term[term]
+        _record_published(term, retrieve_kwargs, articles, published_articles)
+        results[term]['result'] = publish_result_message(
+            len(published_articles), len(articles), kinesis_stream)
+        results[term]['articles_published'] = published_articles
+    return [results[term] for term in search_terms]
+
+
+def _required_params(event: Dict) -> Tuple[List[str], str]:
+    """
+    Returns the search terms and the Kinesis stream of the request.
+
+    Raises:
+        ValueError: If either is missing.
+    """
+    query_params = event.get('queryStringParameters') or {}
+    search_terms = _search_terms(event)
+    kinesis_stream = query_params.get('kinesis_stream')
+    if not search_terms or not kinesis_stream:
+        raise ValueError(
+            "search_term and kinesis_stream are required parameters")
+    return search_terms, kinesis_stream
+
+
+def _process(event: Dict, deadline: Optional[Deadline] = None,
+             progress: Callable = _no_progress) -> Dict:
+    """
+    Retrieves and publishes the articles of a request, and returns
+    the body of its response.
+    """
+    query_params = event.get('queryStringParameters') or {}
+    search_terms, kinesis_stream = _required_params(event)
+    from_date = query_params.get('from_date')
+    logger.info(f'## Input Parameters: Search term '
+                f'({", ".join(search_terms)}), '
+                f'Date ({from_date}), Kinesis stream ({kinesis_stream})'
+                )
+    progress('retrieving')
+    if len(search_terms) == 1:
+        return _retrieve_and_publish(
+            search_terms[0], kinesis_stream, query_params, deadline,
+            progress)
+    return {'results': _retrieve_and_publish_many(
+        search_terms, kinesis_stream, query_params, deadline, progress)}
+
+
+def _json_response(status_code: int, body: Dict) -> Dict:
+    return {
+        "statusCode": status_code,
+        "headers": {
+            "Content-Type": "application/json; charset=utf-8"
+        },
+        "body": json.dumps(
+            body,
+            indent=4,
+            ensure_ascii=False
+        )
+    }
+
+
+def _start_job(event: Dict) -> Dict:
+    """
+    Records a pending job for the request and invokes this function
+    asynchronously to run it.
+
+    Returns:
+        Dict: The pending job.
+    """
+    query_params = event.get('queryStringParameters') or {}
+    search_terms, kinesis_stream = _required_params(event)
+    _validate_params(query_params)
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        raise ValueError(
+            'async requests need AWS_LAMBDA_FUNCTION_NAME to be set')
+    job = new_job(search_terms, kinesis_stream)
+    store = get_job_store()
+    store.create(job)
+    # Only the parameters are passed on, keeping the payload well under
+    # the 256 KB limit of asynchronous invocations
+    payload = {
+        JOB_EVENT_KEY: job['job_id'],
+        'request': {
+            'queryStringParameters': query_params,
+            'multiValueQueryStringParameters': event.get(
+                'multiValueQueryStringParameters'),
+        },
+    }
+    try:
+        get_boto3_client('lambda').invoke(
+            FunctionName=function_name, InvocationType='Event',
+            Payload=json.dumps(payload).encode('utf-8'))
+    except Exception as e:
+        store.update(job['job_id'], status='failed',
+                     error=f'Failed to start job: {e}')
+        raise
+    logger.info(f'## Started job {job["job_id"]}')
+    return job
+
+
+def _job_summary(body: Dict) -> Dict:
+    """
+    Replaces the article lists of a response body with their counts,
+    so that the job stays well under DynamoDB's 400 KB item limit
+    however many articles were published.
+    """
+    summary = {}
+    for key, value in body.items():
+        if key in ('articles_published', 'articles'):
+            summary[f'{key}_count'] = len(value)
+        elif key == 'results':
+            summary[key] = [_job_summary(result) for result in value]
+        else:
+            summary[key] = value
+    return summary
+
+
+def _run_job(event: Dict, deadline: Optional[Deadline] = None) -> Dict:
+    """
+    Runs a job started by an asynchronous request, recording its
+    progress and a summary of its result in the job store.
+
+    Errors, including failures to record the outcome, are logged rather
+    than raised, so that Lambda does not retry the invocation and
+    publish the articles twice. A job that was already claimed, e.g.
+    by an invocation delivered again, is not run a second time.
+    """
+    job_id = event[JOB_EVENT_KEY]
+    store = get_job_store()
+    if not store.claim(job_id):
+        logger.warning(f'Job {job_id} was already started, not running it')
+        increment('jobs.duplicate')
+        return {'job_id': job_id, 'status': store.get(job_id)['status']}
+
+    def progress(stage: str, **details) -> None:
+        store.update(job_id, progress={'stage': stage, **details})
+
+    try:
+        body = _process(event['request'], deadline, progress)
+        status = 'succeeded'
+        fields = {'progress': {'stage': 'done'}, **_job_summary(body)}
+    except Exception as e:
+        logger.error(f'Job {job_id} failed: {e}')
+        increment('jobs.failed')
+        status = 'failed'
+        fields = {'error': str(e), 'progress': {'stage': 'failed'}}
+    try:
+        store.update(job_id, status=status, **fields)
+    except Exception as e:
+        logger.error(f'Failed to record the outcome of job {job_id}: {e}')
+        increment('jobs.record_failed')
+    return {'job_id': job_id, 'status': status}
+
+
+def _handle_request(event: Dict,
+                    deadline: Optional[Deadline] = None) -> Dict:
+    """
+    Processes an API Gateway event and builds the HTTP response.
+    Retrieval stops at the deadline, if given, and the articles
+    retrieved by then are published.
+
+    With async=true the request is validated and queued as a job, and
+    202 is returned with its job ID at once. A request with only a
+    job_id returns the status of that job.
+    """
+    try:
+        query_params = event.get('queryStringParameters') or {}
+        if query_params.get('job_id') and not _search_terms(event):
+            job = get_job_store().get(query_params['job_id'])
+            if job is None:
+                return _json_response(
+                    404, {'error': f'Unknown job {query_params["job_id"]}'})
+            return _json_response(200, job)
+        if _is_enabled(query_params, 'async'):
+            job = _start_job(event)
+            return _json_response(202, {
+                'job_id': job['job_id'], 'status': job['status']})
+        response = _json_response(200, _process(event, deadline))
         logger.info(f'## Response returned: {response}')
         return response
     except Exception as e:
         logger.error(f'Error processing request: {e}')
+        increment('lambda_handler.errors')
         return {
             "statusCode": 500,
             "body": json.dumps({'error': str(e)}),
         }
+
+
+def lambda_handler(event, context):
+    """
+    The Lambda handler function that gets invoked when the API endpoint is hit
+    """
+    # Logging is configured on the first invocation rather than at import.
+    # This does nothing in Lambda, where the runtime has set up a handler.
+    logging.basicConfig(level=logging.INFO)
+    # Stop retrieving early enough to publish before the Lambda times out
+    deadline = Deadline.from_context(context, reserve=float(os.environ.get(
+        'DEADLINE_RESERVE_SECONDS', DEFAULT_RESERVE_SECONDS)))
+    try:
+        if JOB_EVENT_KEY in event:
+            with timer('job'):
+                return _run_job(event, deadline)
+        with timer('lambda_handler'):
+            return _handle_request(event, deadline)
+    finally:
+        flush_metrics()
@@ -0,0 +1,204 @@
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Optional
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+DEFAULT_NAMESPACE = 'StreamingDataProject'
+# CloudWatch limits for one Embedded Metric Format document
+MAX_METRICS_PER_DOCUMENT = 100
+MAX_VALUES_PER_METRIC = 100
+
+_NO_TIMER = nullcontext()
+
+
+class MetricsRecorder:
+    """
+    Collects timings and counters during an invocation and writes them
+    to standard output as CloudWatch Embedded Metric Format (EMF)
+    documents, which CloudWatch Logs turns into metrics.
+
+    Timings keep every value so that CloudWatch can compute percentiles,
+    while counters are summed.
+
+    Args:
+        namespace (str, optional): The CloudWatch namespace of the
+        metrics. Defaults to DEFAULT_NAMESPACE.
+        dimensions (Dict[str, str], optional): The dimensions of every
+        metric. Defaults to the Lambda function name.
+        stream (optional): Where the documents are written.
+        Defaults to sys.stdout at the time they are written.
+    """
+
+    def __init__(self, namespace: str = DEFAULT_NAMESPACE,
+                 dimensions: Optional[Dict[str, str]] = None, stream=None):
+        self.namespace = namespace
+        if dimensions is None:
+            dimensions = {'FunctionName': os.environ.get(
+                'AWS_LAMBDA_FUNCTION_NAME', 'local')}
+        self.dimensions = dimensions
+        self.stream = stream
+        self._units: Dict[str, str] = {}
+        self._values: Dict[str, List[float]] = {}
+        self._counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add_value(self, name: str, value: float,
+                  unit: str = 'Milliseconds') -> None:
+        """
+        Records one value of a distribution, e.g. a duration.
+        """
+        with self._lock:
+            self._units[name] = unit
+            self._values.setdefault(name, []).append(value)
+
+    def increment(self, name: str, value: float = 1,
+                  unit: str = 'Count') -> None:
+        """
+        Adds value to a counter.
+        """
+        with self._lock:
+            self._units[name] = unit
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Records the duration of the block in milliseconds as
+        the '<name>.duration' metric, even if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_value(f'{name}.duration',
+                           (time.perf_counter() - start) * 1000)
+
+    def _documents(self) -> List[Dict]:
+        with self._lock:
+            units = self._units
+            pending = {name: list(values)
+                       for name, values in self._values.items()}
+            pending.update(
+                {name: [value] for name, value in self._counters.items()})
+            self._units = {}
+            self._values = {}
+            self._counters = {}
+
+        documents = []
+        timestamp = int(time.time() * 1000)
+        while pending:
+            names = sorted(pending)[:MAX_METRICS_PER_DOCUMENT]
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(self.dimensions)],
+                        'Metrics': [{'Name': name, 'Unit': units[name]}
+                                    for name in names],
+                    }],
+                },
+                **self.dimensions,
+            }
+            for name in names:
+                values = pending[name][:MAX_VALUES_PER_METRIC]
+                pending[name] = pending[name][MAX_VALUES_PER_METRIC:]
+                if not pending[name]:
+                    del pending[name]
+                document[name] = values if len(values) > 1 else values[0]
+            documents.append(document)
+        return documents
+
+    def flush(self) -> None:
+        """
+        Writes the metrics recorded since the last flush, one EMF
+        document per line, and starts afresh.
+        """
+        stream = self.stream if self.stream is not None else sys.stdout
+        for document in self._documents():
+            stream.write(json.dumps(document, separators=(',', ':')) + '\n')
+        stream.flush()
+
+
+_UNSET = object()
+_default_recorder = _UNSET
+_default_recorder_lock = threading.Lock()
+
+
+def get_metrics_recorder() -> Optional[MetricsRecorder]:
+    """
+    Returns the shared metrics recorder, or None if metrics are disabled.
+
+    Metrics are enabled by setting the METRICS_ENABLED environment
+    variable to 'true'. METRICS_NAMESPACE overrides the namespace.
+    """
+    global _default_recorder
+    if _default_recorder is _UNSET:
+        with _default_recorder_lock:
+            if _default_recorder is _UNSET:
+                enabled = os.environ.get(
+                    'METRICS_ENABLED', 'false').lower() == 'true'
+                _default_recorder = MetricsRecorder(os.environ.get(
+                    'METRICS_NAMESPACE', DEFAULT_NAMESPACE)
+                ) if enabled else None
+    return _default_recorder
+
+
+def set_metrics_recorder(recorder: Optional[MetricsRecorder]) -> None:
+    """
+    Replaces the shared metrics recorder. Passing None makes the next
+    call to get_metrics_recorder read the environment again.
+    """
+    global _default_recorder
+    with _default_recorder_lock:
+        _default_recorder = _UNSET if recorder is None else recorder
+
+
+def timer(name: str):
+    """
+    Returns a context manager recording the duration of its block as
+    '<name>.duration', or one that does nothing if metrics are disabled.
+    """
+    recorder = get_metrics_recorder()
+    if recorder is None:
+        return _NO_TIMER
+    return recorder.timer(name)
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator recording the duration of every call of a function
+    as '<name>.duration'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = get_metrics_recorder()
+            if recorder is None:
+                return func(*args, **kwargs)
+            with recorder.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def increment(name: str, value: float = 1, unit: str = 'Count') -> None:
+    """
+    Adds value to a counter, if metrics are enabled.
+    """
+    recorder = get_metrics_recorder()
+    if recorder is not None:
+        recorder.increment(name, value, unit)
+
+
+def flush_metrics() -> None:
+    """
+    Writes the recorded metrics, if metrics are enabled.
+    """
+    recorder = get_metrics_recorder()
+    if recorder is not None:
+        recorder.flush()
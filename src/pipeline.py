@@ -0,0 +1,148 @@
+from src.publish_to_kinesis import publish_to_kinesis, publish_result_message
+from typing import Dict, Iterable, List, Tuple
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 25
+DEFAULT_FLUSH_INTERVAL_SECONDS = 0.5
+DEFAULT_QUEUE_SIZE = 100
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def _produce(articles: Iterable[Dict], article_queue: queue.Queue,
+             stop: threading.Event) -> None:
+    """
+    Puts the articles on the queue as they are retrieved, followed by
+    the end marker, or the error that stopped the retrieval.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                article_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for article in articles:
+            if not put(article):
+                return
+    except Exception as e:
+        put(_ProducerError(e))
+        return
+    put(_END)
+
+
+def stream_to_kinesis(
+        articles: Iterable[Dict], stream_name: str, partition_key: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        seen_index=None,
+        partition_strategy: str = 'term',
+        encoding: str = 'json',
+        aggregate: bool = False) -> Tuple[str, List[Dict]]:
+    """
+    Publishes articles to a Kinesis stream while they are still being
+    retrieved. A background thread pulls the articles into a bounded
+    queue, and micro-batches are published with PutRecords whenever
+    batch_size articles are waiting or flush_interval seconds have
+    passed since the first article of the batch arrived.
+
+    Args:
+        articles (Iterable[Dict]): The articles to publish, usually the
+        generator returned by iter_articles.
+        stream_name (str): The name of the Kinesis stream.
+        partition_key (str): The partition key - the search term.
+        batch_size (int, optional): The number of articles that triggers
+        a flush. Defaults to DEFAULT_BATCH_SIZE.
+        flush_interval (float, optional): The maximum number of seconds an
+        article waits before its batch is flushed.
+        Defaults to DEFAULT_FLUSH_INTERVAL_SECONDS.
+        queue_size (int, optional): The maximum number of articles
+        buffered between the two stages. Defaults to DEFAULT_QUEUE_SIZE.
+        seen_index (SeenIndex, optional): If provided, articles that were
+        already published are dropped, and published ones are recorded.
+        partition_strategy (str, optional): How records are spread across
+        shards. See publish_to_kinesis. Defaults to 'term'.
+        encoding (str, optional): How articles are encoded.
+        See publish_to_kinesis. Defaults to 'json'.
+        aggregate (bool, optional): If True, each micro-batch is packed
+        into KPL aggregated records. See publish_to_kinesis.
+        Defaults to False.
+
+    Returns:
+        Tuple[str, List[Dict]]: The same result message and list of
+        published articles as publish_to_kinesis.
+
+    Raises:
+        Exception: Any error raised while retrieving or publishing.
+        Batches flushed before the error stay published.
+    """
+    article_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_produce, args=(articles, article_queue, stop), daemon=True)
+    producer.start()
+
+    total = 0
+    published_articles = []
+    batch = []
+    batch_started = None
+
+    def flush():
+        nonlocal batch, batch_started
+        if batch:
+            logger.info(f'Flushing {len(batch)} articles to Kinesis.')
+            _, published = publish_to_kinesis(
+                stream_name, partition_key, batch, batched=True,
+                partition_strategy=partition_strategy, encoding=encoding,
+                aggregate=aggregate)
+            published_articles.extend(published)
+            if seen_index is not None:
+                seen_index.mark(published)
+        batch = []
+        batch_started = None
+
+    try:
+        while True:
+            timeout = None
+            if batch_started is not None:
+                timeout = max(
+                    0, batch_started + flush_interval - time.monotonic())
+            try:
+                item = article_queue.get(timeout=timeout)
+            except queue.Empty:
+                flush()
+                continue
+            if item is _END:
+                break
+            if isinstance(item, _ProducerError):
+                flush()
+                raise item.error
+            if seen_index is not None and (
+                    item in batch or seen_index.seen(item)):
+                continue
+            total += 1
+            batch.append(item)
+            if batch_started is None:
+                batch_started = time.monotonic()
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+    finally:
+        stop.set()
+
+    return publish_result_message(
+        len(published_articles), total, stream_name), published_articles
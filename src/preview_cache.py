@@ -0,0 +1,308 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_FRESH_TTL_SECONDS = 300
+DEFAULT_NEGATIVE_TTL_SECONDS = 60
+MAX_NEGATIVE_ENTRIES = 1024
+
+
+def _entry_size(url: str, entry: Dict) -> int:
+    return (len(url) + len(entry['preview'])
+            + len(entry.get('etag') or '')
+            + len(entry.get('last_modified') or ''))
+
+
+class PreviewCache:
+    """
+    LRU cache of article content previews keyed by URL.
+
+    Entries keep the ETag and Last-Modified headers of the page so that
+    stale entries can be revalidated with a conditional GET. Memory use is
+    bounded by the total size of the cached entries, and an optional disk
+    tier (e.g. under /tmp) keeps entries across warm Lambda invocations.
+    The disk tier is indexed once when the cache is created, assuming
+    one cache instance writes to it at a time, and evicts the least
+    recently used files.
+    URLs that failed are remembered for a short time so they are not
+    fetched again straight away.
+
+    Args:
+        max_bytes (int, optional): The maximum total size of the entries
+        kept in memory. Defaults to DEFAULT_MAX_BYTES.
+        fresh_ttl (float, optional): Seconds an entry is used without
+        revalidation. Defaults to DEFAULT_FRESH_TTL_SECONDS.
+        negative_ttl (float, optional): Seconds a failed URL is remembered.
+        Defaults to DEFAULT_NEGATIVE_TTL_SECONDS.
+        disk_dir (str, optional): Directory for the disk tier.
+        If not provided, entries are only kept in memory.
+        max_disk_bytes (int, optional): The maximum total size of the
+        disk tier. Defaults to ten times max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES,
+                 fresh_ttl: float = DEFAULT_FRESH_TTL_SECONDS,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL_SECONDS,
+                 disk_dir: str = None, max_disk_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.fresh_ttl = fresh_ttl
+        self.negative_ttl = negative_ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = (
+            max_disk_bytes if max_disk_bytes is not None else max_bytes * 10)
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self._failures: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # The size of each disk tier file, least recently used first
+        self._disk_files: OrderedDict = OrderedDict()
+        self._disk_size = 0
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[Dict]:
+        """
+        Returns the cached entry for a URL, or None if there is none.
+        The entry has 'preview', 'etag', 'last_modified' and 'stored_at'
+        keys.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+        if entry is not None:
+            if self.disk_dir:
+                with self._disk_lock:
+                    path = self._disk_path(url)
+                    if path in self._disk_files:
+                        self._disk_files.move_to_end(path)
+            return entry
+        entry = self._read_disk(url)
+        if entry is not None:
+            with self._lock:
+                self._insert(url, entry)
+        return entry
+
+    def is_fresh(self, entry: Dict) -> bool:
+        """
+        Returns True if the entry can be used without revalidation.
+        """
+        return time.time() - entry['stored_at'] < self.fresh_ttl
+
+    def put(self, url: str, preview: str, etag: str = None,
+            last_modified: str = None) -> None:
+        """
+        Caches the preview of a URL along with its validators.
+        """
+        entry = {
+            'preview': preview,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+        }
+        with self._lock:
+            self._failures.pop(url, None)
+            self._insert(url, entry)
+        self._write_disk(url, entry)
+
+    def touch(self, url: str) -> None:
+        """
+        Marks a cached entry as fresh again, e.g. after a 304 response.
+        """
+        entry = self.get(url)
+        if entry is not None:
+            self.put(url, entry['preview'], entry['etag'],
+                     entry['last_modified'])
+
+    def put_failure(self, url: str) -> None:
+        """
+        Remembers that fetching a URL failed, unless it has a fresh
+        entry, e.g. from a concurrent request that succeeded.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and self.is_fresh(entry):
+                return
+            if len(self._failures) >= MAX_NEGATIVE_ENTRIES:
+                self._failures = {
+                    u: expires for u, expires in self._failures.items()
+                    if expires > now}
+            if len(self._failures) < MAX_NEGATIVE_ENTRIES:
+                self._failures[url] = now + self.negative_ttl
+
+    def has_failed(self, url: str) -> bool:
+        """
+        Returns True if fetching a URL failed within the negative TTL.
+        """
+        with self._lock:
+            expires = self._failures.get(url)
+            if expires is None:
+                return False
+            if expires <= time.time():
+                del self._failures[url]
+                return False
+            return True
+
+    def clear(self) -> None:
+        """
+        Removes all entries from memory and disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._failures.clear()
+        if self.disk_dir:
+            with self._disk_lock:
+                for path in self._disk_files:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._disk_files.clear()
+                self._disk_size = 0
+
+    def _insert(self, url: str, entry: Dict) -> None:
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._size -= _entry_size(url, old)
+        size = _entry_size(url, entry)
+        if size > self.max_bytes:
+            return
+        self._entries[url] = entry
+        self._size += size
+        while self._size > self.max_bytes:
+            evicted_url, evicted = self._entries.popitem(last=False)
+            self._size -= _entry_size(evicted_url, evicted)
+
+    def _disk_path(self, url: str) -> str:
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f'{name}.json')
+
+    def _load_disk_index(self) -> None:
+        """
+        Indexes the files already in the disk tier, e.g. from a previous
+        warm invocation, ordered by their last use. The index is only
+        built here, so writes and evictions do not scan the directory.
+        """
+        files = []
+        with os.scandir(self.disk_dir) as entries:
+            for dir_entry in entries:
+                if not dir_entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, dir_entry.path))
+        for _, size, path in sorted(files):
+            self._disk_files[path] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def _read_disk(self, url: str) -> Optional[Dict]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(url)
+        try:
+            with open(path, encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('url') != url:
+            return None
+        with self._disk_lock:
+            if path in self._disk_files:
+                self._disk_files.move_to_end(path)
+        try:
+            # Keeps the least recently used order for the next instance
+            os.utime(path)
+        except OSError:
+            pass
+        return record['entry']
+
+    def _write_disk(self, url: str, entry: Dict) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(url)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        data = json.dumps({'url': url, 'entry': entry},
+                          ensure_ascii=False).encode('utf-8')
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Could not write preview cache entry: {e}')
+            return
+        with self._disk_lock:
+            self._disk_size += len(data) - self._disk_files.pop(path, 0)
+            self._disk_files[path] = len(data)
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        # Called with _disk_lock held, or from __init__
+        while self._disk_size > self.max_disk_bytes and self._disk_files:
+            path, size = self._disk_files.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_preview_cache() -> PreviewCache:
+    """
+    Returns the shared preview cache, creating it on first use.
+
+    The cache is configured with the PREVIEW_CACHE_MAX_BYTES,
+    PREVIEW_CACHE_FRESH_TTL_SECONDS and PREVIEW_CACHE_NEGATIVE_TTL_SECONDS
+    environment variables. Setting PREVIEW_CACHE_DIR (e.g. to
+    /tmp/preview_cache) enables the disk tier.
+
+    Returns:
+        PreviewCache: The shared cache.
+    """
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = PreviewCache(
+                    max_bytes=int(os.environ.get(
+                        'PREVIEW_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+                    fresh_ttl=float(os.environ.get(
+                        'PREVIEW_CACHE_FRESH_TTL_SECONDS',
+                        DEFAULT_FRESH_TTL_SECONDS)),
+                    negative_ttl=float(os.environ.get(
+                        'PREVIEW_CACHE_NEGATIVE_TTL_SECONDS',
+                        DEFAULT_NEGATIVE_TTL_SECONDS)),
+                    disk_dir=os.environ.get('PREVIEW_CACHE_DIR'),
+                )
+    return _default_cache
+
+
+def set_preview_cache(cache: Optional[PreviewCache]) -> None:
+    """
+    Replaces the shared preview cache. Passing None makes the next
+    call to get_preview_cache create a new one.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = cache
@@ -1,16 +1,342 @@
-import boto3
-from botocore.exceptions import (
-    NoCredentialsError, PartialCredentialsError, ClientError)
-from typing import List, Dict, Tuple
-import json
+from typing import List, Dict, Tuple, Iterator
+from src.clients import get_boto3_client
+from src.record_encoding import encode_article, ENCODINGS
+from src.kpl_aggregation import RecordAggregator
+from src.metrics import timed, increment
+import bisect
+import hashlib
+import itertools
 import logging
+import random
+import time
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# PutRecords service limits
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024
 
+DEFAULT_MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.1
+
+# 'term' keeps each search term on one shard, in order. 'url_hash' spreads
+# articles by URL. 'round_robin' cycles through the open shards, and
+# 'explicit_hash' pins each URL to a shard with an ExplicitHashKey, so
+# articles are spread evenly even when the shard hash ranges are not.
+PARTITION_STRATEGIES = ('term', 'url_hash', 'round_robin', 'explicit_hash')
+SHARD_CACHE_SECONDS = 300
+
+_shard_cache: Dict[str, Tuple[float, List[str]]] = {}
+_round_robin_counter = itertools.count()
+
+
+def publish_result_message(success_count: int, total: int,
+                           stream_name: str) -> str:
+    """
+    Builds the summary message returned by publish_to_kinesis.
+
+    Args:
+        success_count (int): The number of records published.
+        total (int): The number of records that should have been published.
+        stream_name (str): The name of the Kinesis stream.
+
+    Returns:
+        str: The summary message.
+    """
+    if success_count == 0:
+        return f"Failed to add any records to Kinesis stream: {stream_name}"
+    elif success_count < total:
+        return (
+            f"Only added {success_count} out of {total} "
+            f"records to Kinesis stream: {stream_name}"
+        )
+    return (
+        f"Successfully added all {success_count} records "
+        f"to Kinesis stream: {stream_name}"
+    )
+
+
+def _chunk_records(records: List[Dict]) -> Iterator[List[int]]:
+    """
+    Splits PutRecords entries into batches that respect the
+    per-call record count and payload size limits.
+
+    Args:
+        records (List[Dict]): PutRecords entries with
+        'Data' and 'PartitionKey' keys.
+
+    Yields:
+        List[int]: The indices of the records in each batch.
+    """
+    batch = []
+    batch_bytes = 0
+    for index, record in enumerate(records):
+        record_bytes = len(record['Data']) + len(
+            record['PartitionKey'].encode('utf-8'))
+        if record_bytes > MAX_RECORD_BYTES:
+            raise ValueError(
+                f"Record {index} is {record_bytes} bytes, "
+                f"above the {MAX_RECORD_BYTES} byte limit")
+        if batch and (len(batch) == MAX_BATCH_RECORDS
+                      or batch_bytes + record_bytes > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(index)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch
+
+
+def _put_records_with_retry(kinesis_client, stream_name: str,
+                            records: List[Dict], indices: List[int],
+                            max_retries: int) -> List[int]:
+    """
+    Sends one batch with PutRecords, resending only the records that
+    failed (e.g. throttled by the shard) with jittered exponential backoff.
+
+    Returns:
+        List[int]: The indices of the records that were published.
+    """
+    published = []
+    pending = indices
+    for attempt in range(max_retries + 1):
+        if attempt:
+            increment('kinesis.records_retried', len(pending))
+            delay = RETRY_BACKOFF_SECONDS * (2 ** (attempt - 1))
+            time.sleep(delay + random.uniform(0, delay))
+        response = kinesis_client.put_records(
+            StreamName=stream_name,
+            Records=[records[index] for index in pending],
+        )
+        failed = []
+        for index, result in zip(pending, response['Records']):
+            if 'ErrorCode' in result:
+                failed.append((index, result))
+            else:
+                published.append(index)
+        if response.get('FailedRecordCount', len(failed)) == 0:
+            increment('kinesis.records_put', len(published))
+            return published
+        logger.warning(
+            f"{len(failed)} records failed on attempt {attempt + 1}, "
+            f"error codes: {sorted({r['ErrorCode'] for _, r in failed})}")
+        pending = [index for index, _ in failed]
+
+    increment('kinesis.records_put', len(published))
+    increment('kinesis.records_failed', len(failed))
+    for index, result in failed:
+        logger.error(
+            f"Failed to publish record {index}: {result['ErrorCode']} "
+            f"{result.get('ErrorMessage', '')}")
+    return published
+
+
+def clear_shard_cache() -> None:
+    """
+    Forgets the cached shard hash ranges, e.g. after resharding a stream.
+    """
+    _shard_cache.clear()
+
+
+def _shard_starting_hash_keys(kinesis_client, stream_name: str) -> List[str]:
+    """
+    Returns the starting hash keys of the open shards of a stream,
+    cached for SHARD_CACHE_SECONDS.
+    """
+    cached = _shard_cache.get(stream_name)
+    if cached is not None and time.monotonic() - cached[0] < (
+            SHARD_CACHE_SECONDS):
+        return cached[1]
+    starting_hash_keys = []
+    kwargs = {'StreamName': stream_name}
+    while True:
+        response = kinesis_client.list_shards(**kwargs)
+        for shard in response['Shards']:
+            # Closed shards have an ending sequence number
+            if 'EndingSequenceNumber' not in shard['SequenceNumberRange']:
+                starting_hash_keys.append(
+                    shard['HashKeyRange']['StartingHashKey'])
+        if not response.get('NextToken'):
+            break
+        kwargs = {'NextToken': response['NextToken']}
+    starting_hash_keys.sort(key=int)
+    _shard_cache[stream_name] = (time.monotonic(), starting_hash_keys)
+    return starting_hash_keys
+
+
+def _partition_fields(partition_strategy: str, search_term: str,
+                      article: Dict, shard_keys: List[str]) -> Dict:
+    """
+    Returns the PartitionKey, and ExplicitHashKey if the strategy sets one,
+    of the record for an article.
+    """
+    if partition_strategy == 'term':
+        return {'PartitionKey': search_term}
+    url_hash = hashlib.md5(article['webUrl'].encode('utf-8')).hexdigest()
+    if partition_strategy == 'url_hash':
+        return {'PartitionKey': url_hash}
+    if partition_strategy == 'round_robin':
+        shard = next(_round_robin_counter) % len(shard_keys)
+    else:
+        shard = int(url_hash, 16) % len(shard_keys)
+    return {'PartitionKey': search_term,
+            'ExplicitHashKey': shard_keys[shard]}
+
+
+def _partitioner(kinesis_client, stream_name: str, partition_strategy: str):
+    """
+    Returns a function giving the partition fields of an article's record
+    under the given strategy.
+    """
+    if partition_strategy not in PARTITION_STRATEGIES:
+        raise ValueError(
+            f'partition_strategy must be one of {PARTITION_STRATEGIES}, '
+            f'got {partition_strategy!r}')
+    shard_keys = []
+    if partition_strategy in ('round_robin', 'explicit_hash'):
+        shard_keys = _shard_starting_hash_keys(kinesis_client, stream_name)
+
+    def partition(search_term: str, article: Dict) -> Dict:
+        return _partition_fields(
+            partition_strategy, search_term, article, shard_keys)
+    return partition
+
+
+def _aggregation_group(record: Dict, shard_keys: List[str],
+                       shard_hash_keys: List[int]) -> Tuple[str, Dict]:
+    """
+    Returns the key of the records that can share an aggregated record,
+    and the partition fields of that aggregated record. Records are only
+    aggregated with records that would have gone to the same shard.
+    """
+    if 'ExplicitHashKey' in record:
+        return record['ExplicitHashKey'], {
+            'PartitionKey': record['PartitionKey'],
+            'ExplicitHashKey': record['ExplicitHashKey']}
+    if not shard_keys:
+        return record['PartitionKey'], {
+            'PartitionKey': record['PartitionKey']}
+    # Kinesis maps a partition key to the shard whose hash key range
+    # holds the MD5 of the key
+    hash_key = int(hashlib.md5(
+        record['PartitionKey'].encode('utf-8')).hexdigest(), 16)
+    shard = max(bisect.bisect_right(shard_hash_keys, hash_key) - 1, 0)
+    return shard_keys[shard], {
+        'PartitionKey': record['PartitionKey'],
+        'ExplicitHashKey': shard_keys[shard]}
+
+
+def _aggregate_records(records: List[Dict], shard_keys: List[str]
+                       ) -> Tuple[List[Dict], List[List[int]]]:
+    """
+    Packs PutRecords entries into KPL aggregated records, keeping the
+    order of the entries within each shard.
+
+    Args:
+        records (List[Dict]): PutRecords entries.
+        shard_keys (List[str]): The starting hash keys of the open shards,
+        needed to group entries that only have a PartitionKey by shard.
+        If empty, such entries are grouped by PartitionKey.
+
+    Returns:
+        Tuple[List[Dict], List[List[int]]]: The aggregated PutRecords
+        entries, and the indices of the entries packed in each of them.
+    """
+    shard_hash_keys = [int(key) for key in shard_keys]
+    aggregated_records = []
+    members = []
+    open_groups = {}
+
+    def close(group):
+        aggregator, fields, indices = open_groups.pop(group)
+        aggregated_records.append({'Data': aggregator.serialize(), **fields})
+        members.append(indices)
+
+    for index, record in enumerate(records):
+        group, fields = _aggregation_group(
+            record, shard_keys, shard_hash_keys)
+        user_record = (record['PartitionKey'],
+                       record.get('ExplicitHashKey'), record['Data'])
+        current = open_groups.get(group)
+        if current is None or not current[0].add(*user_record):
+            if current is not None:
+                close(group)
+            aggregator = RecordAggregator()
+            aggregator.add(*user_record)
+            current = open_groups[group] = (aggregator, fields, [])
+        current[2].append(index)
+    for group in list(open_groups):
+        close(group)
+    return aggregated_records, members
+
+
+@timed('publish_records')
+def publish_records(stream_name: str, entries: List[Tuple[str, Dict]],
+                    max_retries: int = DEFAULT_MAX_RETRIES,
+                    kinesis_client=None,
+                    partition_strategy: str = 'term',
+                    encoding: str = 'json',
+                    aggregate: bool = False) -> List[int]:
+    """
+    Publishes articles with their own partition keys using batched
+    PutRecords calls, resending only the records that failed.
+
+    Args:
+        stream_name (str): The name of the Kinesis stream.
+        entries (List[Tuple[str, Dict]]): (search term, article) pairs.
+        max_retries (int, optional): The number of times failed records
+        are resent. Defaults to DEFAULT_MAX_RETRIES.
+        kinesis_client (optional): The Kinesis client to use.
+        Defaults to the shared client.
+        partition_strategy (str, optional): One of PARTITION_STRATEGIES.
+        Defaults to 'term', which uses the search term as partition key.
+        encoding (str, optional): How articles are encoded, one of
+        ENCODINGS. See encode_article. Defaults to 'json'.
+        aggregate (bool, optional): If True, pack the articles bound for
+        the same shard into KPL aggregated records, which consumers split
+        with deaggregate or the KCL. Defaults to False.
+
+    Returns:
+        List[int]: The sorted indices of the entries that were published.
+    """
+    if kinesis_client is None:
+        kinesis_client = get_boto3_client('kinesis')
+    partition = _partitioner(kinesis_client, stream_name, partition_strategy)
+    if encoding not in ENCODINGS:
+        raise ValueError(
+            f'encoding must be one of {ENCODINGS}, got {encoding!r}')
+    records = [
+        {
+            'Data': encode_article(article, encoding),
+            **partition(search_term, article),
+        }
+        for search_term, article in entries
+    ]
+    members = [[index] for index in range(len(records))]
+    if aggregate:
+        shard_keys = []
+        if partition_strategy == 'url_hash':
+            shard_keys = _shard_starting_hash_keys(
+                kinesis_client, stream_name)
+        records, members = _aggregate_records(records, shard_keys)
+    published_indices = []
+    for indices in _chunk_records(records):
+        for index in _put_records_with_retry(
+                kinesis_client, stream_name, records, indices, max_retries):
+            published_indices.extend(members[index])
+    return sorted(published_indices)
+
+
+@timed('publish_to_kinesis')
 def publish_to_kinesis(stream_name: str, partition_key: str,
-                       list_articles: List[Dict]) -> Tuple[str, List[Dict]]:
+                       list_articles: List[Dict], batched: bool = False,
+                       max_retries: int = DEFAULT_MAX_RETRIES,
+                       partition_strategy: str = 'term',
+                       encoding: str = 'json',
+                       aggregate: bool = False
+                       ) -> Tuple[str, List[Dict]]:
     """
     Publishes a list of articles to a Kinesis stream.
 
@@ -26,6 +352,24 @@ def publish_to_kinesis(stream_name: str, partition_key: str,
             - 'webTitle': The title of the article.
             - 'webUrl': The URL of the article.
             - 'contentPreview': Content preview of the article.
+        batched (bool, optional): If True, publish the articles with
+        PutRecords in batches of up to 500 records or 5 MB, resending
+        only the records that failed. Defaults to False, which makes
+        one PutRecord call per article.
+        max_retries (int, optional): The number of times failed records
+        are resent in batched mode. Defaults to DEFAULT_MAX_RETRIES.
+        partition_strategy (str, optional): How records are spread across
+        shards, one of PARTITION_STRATEGIES. Defaults to 'term', which keeps
+        every article of the search term on one shard; in the unbatched
+        mode its records are also strictly ordered with
+        SequenceNumberForOrdering.
+        encoding (str, optional): How articles are encoded, one of
+        ENCODINGS. 'json' is the original indented JSON; the compact,
+        compressed and msgpack formats carry a header read by
+        decode_record. Defaults to 'json'.
+        aggregate (bool, optional): If True, pack many articles into each
+        Kinesis record using the KPL aggregated record format. This
+        implies the batched mode. Defaults to False.
 
     Returns:
         Tuple[str, List[Dict]]: A tuple containing a success message and a list
@@ -38,38 +382,52 @@ def publish_to_kinesis(stream_name: str, partition_key: str,
         NoCredentialsError: If no credentials are found.
         Exception: For any unexpected errors encountered during publishing.
     """
+    from botocore.exceptions import (
+        NoCredentialsError, PartialCredentialsError, ClientError)
+
     success_count = 0
     published_articles = []
     try:
-        kinesis_client = boto3.client('kinesis')
+        kinesis_client = get_boto3_client('kinesis')
+
+        if batched or aggregate:
+            published_indices = publish_records(
+                stream_name,
+                [(partition_key, article) for article in list_articles],
+                max_retries=max_retries, kinesis_client=kinesis_client,
+                partition_strategy=partition_strategy, encoding=encoding,
+                aggregate=aggregate)
+            published_articles = [
+                list_articles[index] for index in published_indices]
+            return publish_result_message(
+                len(published_articles), len(list_articles), stream_name
+            ), published_articles
 
+        partition = _partitioner(
+            kinesis_client, stream_name, partition_strategy)
+        previous_sequence_number = None
         for index, article in enumerate(list_articles):
-            article_json = json.dumps(article, indent=4, ensure_ascii=False)
-            response = kinesis_client.put_record(
-                StreamName=stream_name,
-                Data=article_json.encode('utf-8'),
-                PartitionKey=partition_key,
-            )
+            put_kwargs = {
+                'StreamName': stream_name,
+                'Data': encode_article(article, encoding),
+                **partition(partition_key, article),
+            }
+            if partition_strategy == 'term' and previous_sequence_number:
+                put_kwargs['SequenceNumberForOrdering'] = (
+                    previous_sequence_number)
+            response = kinesis_client.put_record(**put_kwargs)
             if response['ResponseMetadata']['HTTPStatusCode'] == 200:
                 success_count += 1
+                increment('kinesis.records_put')
                 published_articles.append(list_articles[index])
+                previous_sequence_number = response.get('SequenceNumber')
             else:
+                increment('kinesis.records_failed')
                 logging.error(f"Failed to publish article: {article}")
 
-        if success_count == 0:
-            return (
-                f"Failed to add any records to Kinesis stream: {stream_name}"
-            ), published_articles
-        elif success_count < len(list_articles):
-            return (
-                f"Only added {success_count} out of {len(list_articles)} "
-                f"records to Kinesis stream: {stream_name}"
-            ), published_articles
-        else:
-            return (
-                f"Successfully added all {success_count} records "
-                f"to Kinesis stream: {stream_name}"
-            ), published_articles
+        return publish_result_message(
+            success_count, len(list_articles), stream_name
+        ), published_articles
 
     except ClientError as e:
         logger.error(
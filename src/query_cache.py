@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from src.metrics import increment
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_TTL_SECONDS = 30.0
+
+
+class _Flight:
+    """
+    A fetch in progress, shared by the identical queries waiting for it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.articles: Optional[List[Dict]] = None
+        self.error: Optional[Exception] = None
+
+
+class QueryCache:
+    """
+    LRU cache of the articles retrieved for a query, so that identical
+    requests arriving within seconds of each other, e.g. from dashboards
+    or retries, do not search the Guardian and fetch every page again.
+
+    Fetches are single-flight: while a query is being fetched, identical
+    queries wait for that fetch and share its articles rather than
+    fetching them again. Failed fetches are not cached.
+
+    Args:
+        max_entries (int, optional): The maximum number of queries kept.
+        Defaults to DEFAULT_MAX_ENTRIES.
+        ttl (float, optional): Seconds the articles of a query are reused.
+        Defaults to DEFAULT_TTL_SECONDS.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl: float = DEFAULT_TTL_SECONDS):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[List[Dict]]:
+        """
+        Returns the cached articles of a query, or None if there are
+        none or they have expired.
+        """
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: Hashable) -> Optional[List[Dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, articles = entry
+        if time.monotonic() - stored_at >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return list(articles)
+
+    def put(self, key: Hashable, articles: List[Dict]) -> None:
+        """
+        Caches the articles of a query, evicting the least
+        recently used query if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), list(articles))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, key: Hashable,
+                     fetch: Callable[[], List[Dict]],
+                     cacheable: Callable[[List[Dict]], bool] = None,
+                     timeout: float = None) -> Tuple[List[Dict], bool]:
+        """
+        Returns the cached articles of a query, or fetches them.
+
+        Args:
+            key (Hashable): Identifies the query.
+            fetch (Callable): Retrieves the articles of the query.
+            cacheable (Callable, optional): Decides whether fetched
+            articles are cached, e.g. not when they are incomplete.
+            Defaults to caching them all.
+            timeout (float, optional): The maximum number of seconds to
+            wait for an identical query being fetched, after which the
+            query is fetched again. Defaults to waiting until it is done.
+
+        Returns:
+            Tuple[List[Dict], bool]: The articles, and whether they
+            came from the cache or another query's fetch.
+
+        Raises:
+            Exception: Any error raised by fetch, including the fetch
+            of the identical query waited for.
+        """
+        with self._lock:
+            articles = self._get(key)
+            if articles is not None:
+                increment('query_cache.hits')
+                return articles, True
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(timeout):
+                if flight.error is not None:
+                    raise flight.error
+                increment('query_cache.coalesced')
+                return list(flight.articles), True
+            logger.warning('Timed out waiting for an identical query, '
+                           'fetching it again.')
+            increment('query_cache.misses')
+            return fetch(), False
+
+        increment('query_cache.misses')
+        try:
+            flight.articles = fetch()
+            if cacheable is None or cacheable(flight.articles):
+                self.put(key, flight.articles)
+            return flight.articles, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def clear(self) -> None:
+        """
+        Removes all cached queries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_UNSET = object()
+_default_cache = _UNSET
+_default_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> Optional[QueryCache]:
+    """
+    Returns the shared query cache, or None if it is disabled.
+
+    The cache is configured with the QUERY_CACHE_TTL_SECONDS and
+    QUERY_CACHE_MAX_ENTRIES environment variables. Setting
+    QUERY_CACHE_TTL_SECONDS to 0 disables it.
+    """
+    global _default_cache
+    if _default_cache is _UNSET:
+        with _default_cache_lock:
+            if _default_cache is _UNSET:
+                ttl = float(os.environ.get(
+                    'QUERY_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS))
+                _default_cache = QueryCache(
+                    max_entries=int(os.environ.get(
+                        'QUERY_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+                    ttl=ttl) if ttl > 0 else None
+    return _default_cache
+
+
+def set_query_cache(cache: Optional[QueryCache]) -> None:
+    """
+    Replaces the shared query cache. Passing None makes the next
+    call to get_query_cache read the environment again.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = _UNSET if cache is None else cache
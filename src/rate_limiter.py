@@ -0,0 +1,280 @@
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+from src.metrics import increment
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+
+if TYPE_CHECKING:
+    from src.deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Responses that mean the server is shedding load
+THROTTLE_STATUS_CODES = (429, 503)
+DEFAULT_MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 20.0
+
+# The search endpoint is rate limited per API key, while article pages
+# are served by the Guardian's CDN and tolerate far more requests.
+DEFAULT_LIMITS = {
+    'search': {'rate': 5.0, 'burst': 10, 'max_concurrency': 8},
+    'pages': {'rate': 50.0, 'burst': 50, 'max_concurrency': 20},
+}
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Limits the rate and concurrency of requests to one service.
+
+    A token bucket caps the request rate, allowing bursts of up to
+    burst requests. The number of requests in flight is limited
+    with AIMD: the limit grows by one for each limit's worth of
+    successful requests, and is multiplied by decrease whenever the
+    service throttles a request. pause stops all requests, e.g. for
+    the time given by a Retry-After header.
+
+    Args:
+        rate (float): The average number of requests per second.
+        burst (int): The number of requests that can be sent at once.
+        max_concurrency (int): The upper bound of the concurrency limit,
+        which is also its initial value.
+        min_concurrency (int, optional): The lower bound of the
+        concurrency limit. Defaults to 1.
+        decrease (float, optional): The factor applied to the
+        concurrency limit on throttling. Defaults to 0.5.
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int,
+                 min_concurrency: int = 1, decrease: float = 0.5):
+        if rate <= 0 or burst < 1 or max_concurrency < 1:
+            raise ValueError(
+                'rate, burst and max_concurrency must be positive')
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.decrease = decrease
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, deadline: Optional['Deadline'] = None) -> None:
+        """
+        Waits until a request may be sent, and counts it as in flight.
+
+        Args:
+            deadline (Deadline, optional): If given, stop waiting at the
+            deadline, or at once if the limiter is paused or out of
+            tokens until after it.
+
+        Raises:
+            RateLimitTimeout: If the request could not be sent before
+            the deadline.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = max(0.0, self._paused_until - now)
+                if self._tokens < 1:
+                    wait = max(wait, (1 - self._tokens) / self.rate)
+                if wait == 0 and self.in_flight < int(
+                        self.concurrency_limit):
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    return
+                timeout = wait or None
+                if deadline is not None:
+                    remaining = deadline.remaining()
+                    if remaining <= 0 or (timeout or 0) > remaining:
+                        increment('rate_limiter.deadline_reached')
+                        raise RateLimitTimeout(
+                            'No request can be sent before the deadline')
+                    timeout = min(timeout or remaining, remaining)
+                # Woken early by release when a request completes
+                self._condition.wait(timeout)
+
+    def release(self, throttled: bool = False) -> None:
+        """
+        Marks a request as complete, adjusting the concurrency limit
+        depending on whether the service throttled it.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.concurrency_limit = max(
+                    self.min_concurrency,
+                    self.concurrency_limit * self.decrease)
+            else:
+                self.concurrency_limit = min(
+                    self.max_concurrency,
+                    self.concurrency_limit + 1 / self.concurrency_limit)
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Holds back every request for the given number of seconds.
+        """
+        with self._condition:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """
+    Returns the delay requested by the Retry-After header of a response,
+    given either in seconds or as an HTTP date, or None if there is none.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(
+        datetime.timezone.utc)).total_seconds())
+
+
+def send_with_backoff(limiter: RateLimiter, send: Callable[[], object],
+                      max_retries: int = DEFAULT_MAX_RETRIES,
+                      deadline: Optional['Deadline'] = None):
+    """
+    Sends a request through a rate limiter, resending it while the
+    service throttles it (429 or 503). If the response has a Retry-After
+    header, the whole limiter is paused for that long, so other requests
+    to the service wait too. Otherwise the request is resent after a
+    jittered exponential backoff.
+
+    Args:
+        limiter (RateLimiter): The limiter of the service.
+        send (Callable): Sends the request and returns the response.
+        max_retries (int, optional): The number of times a throttled
+        request is resent. Defaults to DEFAULT_MAX_RETRIES.
+        deadline (Deadline, optional): If given, the request is not
+        sent or resent when waiting for the limiter or the delay would
+        take it past the deadline, and the limiter is only paused for
+        a Retry-After delay that ends before the deadline.
+
+    Returns:
+        The first response that was not throttled,
+        or the last one once the retries are used up.
+
+    Raises:
+        RateLimitTimeout: If the first attempt could not be sent
+        before the deadline.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            limiter.acquire(deadline)
+        except RateLimitTimeout:
+            if attempt == 0:
+                raise
+            # Out of time to resend, so return the throttled response
+            break
+        throttled = False
+        try:
+            response = send()
+            throttled = response.status_code in THROTTLE_STATUS_CODES
+        finally:
+            limiter.release(throttled)
+        if not throttled:
+            return response
+        increment('rate_limiter.throttled')
+        if attempt == max_retries:
+            break
+        response.close()
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            delay = min(retry_after, MAX_BACKOFF_SECONDS)
+        else:
+            delay = min(RETRY_BACKOFF_SECONDS * (2 ** attempt),
+                        MAX_BACKOFF_SECONDS)
+            delay += random.uniform(0, delay)
+        if deadline is not None and delay >= deadline.remaining():
+            break
+        if retry_after is not None:
+            # The next acquire waits until the pause is over
+            limiter.pause(delay)
+        logger.warning(
+            f'Request throttled ({response.status_code}), '
+            f'retrying in {delay:.2f} seconds.')
+        if retry_after is None:
+            time.sleep(delay)
+    return response
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """
+    Returns the shared rate limiter of a service, 'search' or 'pages',
+    creating it on first use.
+
+    The limits default to DEFAULT_LIMITS and can be set with the
+    <NAME>_RATE_LIMIT (requests per second), <NAME>_BURST and
+    <NAME>_MAX_CONCURRENCY environment variables, e.g. SEARCH_RATE_LIMIT.
+    """
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                defaults = DEFAULT_LIMITS[name]
+                prefix = name.upper()
+                limiter = RateLimiter(
+                    rate=float(os.environ.get(
+                        f'{prefix}_RATE_LIMIT', defaults['rate'])),
+                    burst=int(os.environ.get(
+                        f'{prefix}_BURST', defaults['burst'])),
+                    max_concurrency=int(os.environ.get(
+                        f'{prefix}_MAX_CONCURRENCY',
+                        defaults['max_concurrency'])))
+                _limiters[name] = limiter
+    return limiter
+
+
+def set_rate_limiter(name: str, limiter: Optional[RateLimiter]) -> None:
+    """
+    Replaces the shared rate limiter of a service. Passing None makes
+    the next call to get_rate_limiter create a new one.
+    """
+    with _limiters_lock:
+        if limiter is None:
+            _limiters.pop(name, None)
+        else:
+            _limiters[name] = limiter
+
+
+def reset_rate_limiters() -> None:
+    """
+    Drops all the shared rate limiters.
+    """
+    with _limiters_lock:
+        _limiters.clear()
@@ -0,0 +1,126 @@
+from typing import Dict
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Encoded records start with this magic byte followed by a format byte.
+# Records in the original indented JSON format start with '{' instead,
+# so they carry no header and are still recognised by decode_record.
+HEADER_MAGIC = 0xA7
+FORMAT_IDS = {
+    'compact_json': 1,
+    'gzip_json': 2,
+    'zstd_json': 3,
+    'msgpack': 4,
+}
+ENCODINGS = ('json',) + tuple(FORMAT_IDS)
+_FORMAT_NAMES = {format_id: name for name, format_id in FORMAT_IDS.items()}
+
+
+class RecordDecodeError(Exception):
+    pass
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ValueError(
+            "The 'zstd_json' encoding requires the zstandard package") from e
+    return zstandard
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError as e:
+        raise ValueError(
+            "The 'msgpack' encoding requires the msgpack package") from e
+    return msgpack
+
+
+def _compact_json(article: Dict) -> bytes:
+    return json.dumps(
+        article, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_article(article: Dict, encoding: str = 'json') -> bytes:
+    """
+    Encodes an article as the data of a Kinesis record.
+
+    Args:
+        article (Dict): The article to encode.
+        encoding (str, optional): One of ENCODINGS. 'json' is the original
+        indented JSON without a header. The others are prefixed with a
+        two-byte header naming the format: 'compact_json', 'gzip_json',
+        'zstd_json' (needs zstandard) and 'msgpack' (needs msgpack).
+        Defaults to 'json'.
+
+    Returns:
+        bytes: The record data.
+    """
+    if encoding == 'json':
+        return json.dumps(article, indent=4, ensure_ascii=False).encode(
+            'utf-8')
+    if encoding not in FORMAT_IDS:
+        raise ValueError(
+            f'encoding must be one of {ENCODINGS}, got {encoding!r}')
+
+    if encoding == 'compact_json':
+        body = _compact_json(article)
+    elif encoding == 'gzip_json':
+        body = gzip.compress(_compact_json(article), mtime=0)
+    elif encoding == 'zstd_json':
+        body = _zstandard().ZstdCompressor().compress(_compact_json(article))
+    else:
+        body = _msgpack().packb(article, use_bin_type=True)
+    return bytes((HEADER_MAGIC, FORMAT_IDS[encoding])) + body
+
+
+def record_encoding(data: bytes) -> str:
+    """
+    Returns the name of the encoding of a record's data.
+    """
+    if len(data) >= 2 and data[0] == HEADER_MAGIC:
+        try:
+            return _FORMAT_NAMES[data[1]]
+        except KeyError:
+            raise RecordDecodeError(f'Unknown record format id: {data[1]}')
+    return 'json'
+
+
+def decode_record(data: bytes) -> Dict:
+    """
+    Decodes the data of a Kinesis record written by publish_to_kinesis
+    back into an article, whatever encoding it was written with.
+
+    Args:
+        data (bytes): The record data.
+
+    Returns:
+        Dict: The article.
+
+    Raises:
+        RecordDecodeError: If the data cannot be decoded.
+    """
+    encoding = record_encoding(data)
+    body = data if encoding == 'json' else data[2:]
+    if encoding == 'zstd_json':
+        zstandard = _zstandard()
+    elif encoding == 'msgpack':
+        msgpack = _msgpack()
+    try:
+        if encoding in ('json', 'compact_json'):
+            return json.loads(body.decode('utf-8'))
+        if encoding == 'gzip_json':
+            return json.loads(gzip.decompress(body).decode('utf-8'))
+        if encoding == 'zstd_json':
+            return json.loads(
+                zstandard.ZstdDecompressor().decompress(body).decode('utf-8'))
+        return msgpack.unpackb(body, raw=False)
+    except Exception as e:
+        logger.error(f'Failed to decode {encoding} record: {e}')
+        raise RecordDecodeError(
+            f'Failed to decode {encoding} record: {e}') from e
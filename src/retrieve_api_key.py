@@ -1,12 +1,22 @@
-import boto3
-from botocore.exceptions import (ClientError, ParamValidationError,
-                                 ConnectTimeoutError, NoCredentialsError)
+from src.clients import get_boto3_client
+from src.metrics import timed
+from typing import Dict
 import logging
+import os
+import threading
+import time
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_API_KEY_TTL_SECONDS = 300
+DEFAULT_API_KEY_STALE_SECONDS = 600
+
+_api_key_cache: Dict[str, Dict] = {}
+_api_key_lock = threading.Lock()
+
+
+@timed('retrieve_api_key')
 def retrieve_api_key(secret_name: str) -> str:
     """
     Retrieve the API key from AWS Secrets Manager.
@@ -17,10 +27,12 @@ def retrieve_api_key(secret_name: str) -> str:
     Returns:
         str: The retrieved secret string.
     """
+    from botocore.exceptions import (ClientError, ParamValidationError,
+                                     ConnectTimeoutError, NoCredentialsError)
 
     logger.info('Interacting with AWS Secretsmanager')
     try:
-        secrets_manager = boto3.client("secretsmanager")
+        secrets_manager = get_boto3_client("secretsmanager")
         logger.info('Attempting to retrieve Guardian API Key.')
         response = secrets_manager.get_secret_value(SecretId=secret_name)
 
@@ -53,3 +65,93 @@ def retrieve_api_key(secret_name: str) -> str:
         logger.error("SecretString not found in the response.")
         raise ValueError("SecretString not found in the response.")
     return secret
+
+
+def _fetch_and_cache(secret_name: str) -> str:
+    secret = retrieve_api_key(secret_name)
+    with _api_key_lock:
+        _api_key_cache[secret_name] = {
+            'value': secret,
+            'fetched_at': time.monotonic(),
+            'refreshing': False,
+        }
+    return secret
+
+
+def _refresh_in_background(secret_name: str) -> None:
+    """
+    Starts a single background refresh of a cached secret,
+    unless one is already running.
+    """
+    with _api_key_lock:
+        entry = _api_key_cache.get(secret_name)
+        if entry is None or entry['refreshing']:
+            return
+        entry['refreshing'] = True
+
+    def refresh():
+        try:
+            _fetch_and_cache(secret_name)
+        except Exception as e:
+            logger.error(f'Background refresh of the API key failed: {e}')
+            with _api_key_lock:
+                if secret_name in _api_key_cache:
+                    _api_key_cache[secret_name]['refreshing'] = False
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_api_key(secret_name: str, ttl: float = None,
+                stale_ttl: float = None) -> str:
+    """
+    Returns the API key from an in-process cache, retrieving it from
+    AWS Secrets Manager only when the cached value has expired.
+
+    A cached key younger than ttl is returned as is. Once it is older
+    than ttl but younger than ttl + stale_ttl, the cached key is still
+    returned while a refresh runs in the background. Older keys are
+    retrieved synchronously.
+
+    Args:
+        secret_name (str): The name of the secret in AWS Secrets Manager.
+        ttl (float, optional): Seconds a cached key is fresh. Defaults to
+        the API_KEY_TTL_SECONDS environment variable, or 300.
+        stale_ttl (float, optional): Seconds after ttl during which a stale
+        key may be served. Defaults to the API_KEY_STALE_SECONDS
+        environment variable, or 600.
+
+    Returns:
+        str: The API key.
+    """
+    if ttl is None:
+        ttl = float(os.environ.get(
+            'API_KEY_TTL_SECONDS', DEFAULT_API_KEY_TTL_SECONDS))
+    if stale_ttl is None:
+        stale_ttl = float(os.environ.get(
+            'API_KEY_STALE_SECONDS', DEFAULT_API_KEY_STALE_SECONDS))
+
+    entry = _api_key_cache.get(secret_name)
+    if entry is not None:
+        age = time.monotonic() - entry['fetched_at']
+        if age < ttl:
+            return entry['value']
+        if age < ttl + stale_ttl:
+            _refresh_in_background(secret_name)
+            return entry['value']
+    return _fetch_and_cache(secret_name)
+
+
+def invalidate_api_key(secret_name: str = None) -> None:
+    """
+    Removes a cached API key, e.g. after the API rejected it,
+    so that the next call retrieves it again.
+
+    Args:
+        secret_name (str, optional): The secret to invalidate.
+        If not provided, the whole cache is cleared.
+    """
+    with _api_key_lock:
+        if secret_name is None:
+            _api_key_cache.clear()
+        else:
+            _api_key_cache.pop(secret_name, None)
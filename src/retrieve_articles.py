@@ -1,73 +1,486 @@
-import requests
-from src.retrieve_api_key import retrieve_api_key
-from src.fetch_article_content import fetch_content_preview
+import html
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.retrieve_api_key import get_api_key, invalidate_api_key
+from src.fetch_article_content import fetch_content_preview, PREVIEW_LENGTH
+from src.deadline import Deadline
+from src.clients import get_http_session
+from src.metrics import timed, increment
+from src.rate_limiter import get_rate_limiter, send_with_backoff
+from src.watermarks import is_before_watermark
 import logging
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Optional, Iterator
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+API_KEY_SECRET_NAME = 'guardian/api-key'
+DEFAULT_MAX_WORKERS = 10
+PREVIEW_NOT_AVAILABLE = 'Content preview not available'
+# 'page' scrapes every article page, 'api' builds previews from the
+# search response and only scrapes the hits that lack preview fields.
+PREVIEW_SOURCES = ('page', 'api')
+PREVIEW_FIELDS = 'bodyText,trailText'
+ORDER_BY_OPTIONS = ('relevance', 'newest', 'oldest')
+# Orders in which articles after a watermark can be found
+WATERMARK_ORDERS = ('newest', 'oldest')
+SEARCH_URL = 'http://content.guardianapis.com/search'
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 200
+SEARCH_TIMEOUT_SECONDS = 10.0
+
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
 class APIRequestError(Exception):
     pass
 
 
-def retrieve_articles(
-        search_term: str, from_date: str = None) -> Union[str, List[Dict]]:
+def _fetch_with_hedge(url: str, fetch_kwargs: Dict,
+                      hedge_after: float) -> str:
     """
-    Retrieves articles from the Guardian API based on search term and date.
+    Fetches a content preview, sending a second identical request if the
+    first has not completed after hedge_after seconds, and returns
+    whichever succeeds first.
+    """
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {executor.submit(fetch_content_preview, url,
+                                   **fetch_kwargs)}
+        if not wait(futures, timeout=hedge_after)[0]:
+            increment('fetch_content_preview.hedged')
+            futures.add(executor.submit(fetch_content_preview, url,
+                                        **fetch_kwargs))
+        error = None
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+    finally:
+        # The slower request is left to finish within its timeout
+        executor.shutdown(wait=False)
 
-    Args:
-        search_term (str): The search term to query.
-        from_date (str, optional): The start date for the search
-        in YYYY-MM-DD format. If not provided, defaults to None,
-        in which case most relevant articles will be retrieved
+
+def _fetch_preview_or_fallback(url: str, deadline: Optional[Deadline] = None,
+                               hedge_after: Optional[float] = None
+                               ) -> Optional[str]:
+    """
+    Fetches the content preview of a single article, falling back
+    to a placeholder message if the page could not be fetched.
 
     Returns:
-        list: A list of dictionaries containing
-        the retrieved articles' information.
+        Optional[str]: The preview, or None if the deadline passed
+        before the fetch could start.
     """
+    if deadline is not None and deadline.expired():
+        return None
+    fetch_kwargs = {} if deadline is None else {'deadline': deadline}
     try:
-        url = 'http://content.guardianapis.com/search'
-        my_params = {
-            'from-date': from_date,
-            'order-by': 'relevance',
-            'q': search_term,
-            'api-key': retrieve_api_key('guardian/api-key'),
-        }
-        logger.info('Making a request to the Guardian API.')
-        response = requests.get(url, params=my_params)
-        api_key_marker = 'api-key'
-        api_key_index = response.url.find(api_key_marker)
+        if hedge_after is not None:
+            return _fetch_with_hedge(url, fetch_kwargs, hedge_after)
+        return fetch_content_preview(url, **fetch_kwargs)
+    except Exception as e:
+        logger.error(f'Failed to fetch content preview: {e}')
+        return PREVIEW_NOT_AVAILABLE
+
+
+def _iter_previews(urls: List[str], max_workers: int,
+                   deadline: Optional[Deadline] = None,
+                   hedge_after: Optional[float] = None
+                   ) -> Iterator[Optional[str]]:
+    """
+    Fetches the content previews of several articles concurrently
+    using a bounded thread pool.
+
+    Args:
+        urls (List[str]): The article URLs to fetch previews for.
+        max_workers (int): The maximum number of concurrent fetches.
+        deadline (Deadline, optional): Fetches do not start after it,
+        and those in flight time out at it.
+        hedge_after (float, optional): Seconds after which a slow fetch
+        is hedged with a second request. Defaults to no hedging.
+
+    Yields:
+        Optional[str]: The content previews, in the same order as the
+        URLs, each as soon as it and all the previews before it are
+        ready. None stands for a preview skipped because of the deadline.
+    """
+    if not urls:
+        return
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+
+    def fetch(url):
+        return _fetch_preview_or_fallback(url, deadline, hedge_after)
+
+    workers = min(max_workers, len(urls))
+    if workers == 1:
+        for url in urls:
+            yield fetch(url)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(fetch, urls)
+
+
+def _preview_from_fields(fields: Dict) -> Optional[str]:
+    """
+    Builds a content preview from the fields returned inline by the
+    search endpoint, preferring the body text over the trail text.
+
+    Returns:
+        Optional[str]: The preview truncated to 1000 characters,
+        or None if the hit has neither field.
+    """
+    text = (fields.get('bodyText') or '').strip()
+    if not text:
+        trail_text = fields.get('trailText') or ''
+        text = html.unescape(_TAG_PATTERN.sub('', trail_text)).strip()
+    if not text:
+        return None
+    return text[:PREVIEW_LENGTH]
+
+
+def _iter_article_previews(articles: List[Dict], preview_source: str,
+                           max_workers: int,
+                           deadline: Optional[Deadline] = None,
+                           hedge_after: Optional[float] = None
+                           ) -> Iterator[Optional[str]]:
+    """
+    Yields the content previews of the search hits in order, scraping the
+    article pages only for the hits whose previews cannot come from the API.
+    """
+    if preview_source == 'page':
+        yield from _iter_previews(
+            [article['webUrl'] for article in articles], max_workers,
+            deadline, hedge_after)
+        return
+
+    previews = [_preview_from_fields(article.get('fields', {}))
+                for article in articles]
+    missing = [article['webUrl']
+               for article, preview in zip(articles, previews)
+               if preview is None]
+    if missing:
         logger.info(
-            f'Request URL: {response.url[:api_key_index]}api-key=[REDACTED]')
-        data = response.json()
-        if response.status_code == 200:
-            logger.info('Request was successful')
-            article_hits_info = []
-            articles = data['response']['results']
-            for article in articles:
-                try:
-                    content_preview = fetch_content_preview(article['webUrl'])
-                except Exception as e:
-                    logger.error(f'Failed to fetch content preview: {e}')
-                    content_preview = 'Content preview not available'
-                article_info = {
+            f'{len(missing)} hits have no preview fields, '
+            f'fetching their pages.')
+    fetched = _iter_previews(missing, max_workers, deadline, hedge_after)
+    for preview in previews:
+        yield preview if preview is not None else next(fetched)
+
+
+def _get_search_results(params: Dict, deadline: Optional[Deadline]):
+    """
+    Sends a search request through the shared rate limiter of the
+    search endpoint, backing off while the API throttles it.
+    """
+    return send_with_backoff(
+        get_rate_limiter('search'),
+        lambda: get_http_session().get(
+            SEARCH_URL, params=params,
+            timeout=(SEARCH_TIMEOUT_SECONDS if deadline is None
+                     else deadline.timeout(SEARCH_TIMEOUT_SECONDS))),
+        deadline=deadline)
+
+
+@timed('search')
+def _search_page(query: Dict, page: int, page_size: int,
+                 preview_source: str,
+                 deadline: Optional[Deadline] = None) -> Dict:
+    """
+    Requests one page of search results from the Guardian API.
+
+    Args:
+        query (Dict): The 'q', 'from-date', 'to-date' and 'order-by'
+        parameters.
+        page (int): The page number, starting at 1.
+        page_size (int): The number of hits per page.
+        preview_source (str): 'page' or 'api'.
+        deadline (Deadline, optional): If given, the request times out
+        at the deadline if that is sooner than SEARCH_TIMEOUT_SECONDS.
+
+    Returns:
+        Dict: The 'response' object of the API reply, with the
+        'results' of the page and the total number of 'pages'.
+
+    Raises:
+        APIRequestError: If the API does not return a 200 response.
+    """
+    api_key = get_api_key(API_KEY_SECRET_NAME)
+    my_params = {
+        **query,
+        'page': page,
+        'page-size': page_size,
+        'api-key': api_key,
+    }
+    if preview_source == 'api':
+        my_params['show-fields'] = PREVIEW_FIELDS
+    logger.info('Making a request to the Guardian API.')
+    response = _get_search_results(my_params, deadline)
+    if response.status_code in (401, 403):
+        # The cached key may have been rotated, so drop it
+        # and retry once if Secrets Manager has a different one.
+        logger.warning(
+            f'Guardian API rejected the API key '
+            f'({response.status_code}), invalidating cached key.')
+        invalidate_api_key(API_KEY_SECRET_NAME)
+        fresh_api_key = get_api_key(API_KEY_SECRET_NAME)
+        if fresh_api_key != api_key:
+            my_params['api-key'] = fresh_api_key
+            response = _get_search_results(my_params, deadline)
+    api_key_marker = 'api-key'
+    api_key_index = response.url.find(api_key_marker)
+    logger.info(
+        f'Request URL: {response.url[:api_key_index]}api-key=[REDACTED]')
+    if response.status_code != 200:
+        try:
+            error_message = response.json()['response'].get(
+                'message', 'No message provided')
+        except (ValueError, KeyError, TypeError):
+            # e.g. a throttling response from the gateway, not the API
+            error_message = 'No message provided'
+        raise APIRequestError(
+            f'Error {response.status_code} : {error_message}')
+    logger.info('Request was successful')
+    return response.json()['response']
+
+
+def _seen_inline(seen_index, article: Dict) -> bool:
+    """
+    Returns True if a hit's preview from its inline fields was already
+    published, so that it can be skipped before its previews are built.
+    """
+    preview = _preview_from_fields(article.get('fields', {}))
+    return preview is not None and seen_index.seen(
+        {'webUrl': article['webUrl'], 'contentPreview': preview + '...'})
+
+
+def _iter_articles(query: Dict, page_size: int, max_results: Optional[int],
+                   max_workers: int, preview_source: str,
+                   seen_index, watermark: Optional[Dict],
+                   deadline: Optional[Deadline],
+                   hedge_after: Optional[float]) -> Iterator[Dict]:
+    import requests
+    page_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        next_page = page_executor.submit(
+            _search_page, query, 1, page_size, preview_source, deadline)
+        page = 1
+        yielded = 0
+        while next_page is not None:
+            data = next_page.result()
+            articles = data['results']
+            reached_watermark = False
+            if watermark is not None:
+                # Newest first, everything after the first article older
+                # than the watermark was already published. Oldest first,
+                # the articles up to the watermark are only skipped.
+                fresh = []
+                for article in articles:
+                    if (query['order-by'] == 'newest'
+                            and article['webPublicationDate']
+                            < watermark['date']):
+                        reached_watermark = True
+                        break
+                    if not is_before_watermark(article, watermark):
+                        fresh.append(article)
+                articles = fresh
+            if seen_index is not None and preview_source == 'api':
+                # Inline previews are known before any page is fetched
+                articles = [article for article in articles
+                            if not _seen_inline(seen_index, article)]
+            if max_results is not None:
+                articles = articles[:max_results - yielded]
+            more_pages = (data['results'] and not reached_watermark
+                          and page < data.get('pages', 1))
+            next_page = None
+            if (more_pages
+                    and (max_results is None
+                         or yielded + len(articles) < max_results)
+                    and (deadline is None or not deadline.expired())):
+                # Prefetch the next page while building previews
+                page += 1
+                next_page = page_executor.submit(
+                    _search_page, query, page, page_size, preview_source,
+                    deadline)
+
+            content_previews = _iter_article_previews(
+                articles, preview_source, max_workers, deadline, hedge_after)
+            for article, content_preview in zip(articles, content_previews):
+                if content_preview is None:
+                    # Out of time: return what was retrieved so far
+                    logger.warning(
+                        f'Deadline reached after {yielded} articles, '
+                        'skipping the rest.')
+                    increment('retrieve_articles.deadline_reached')
+                    return
+                article = {
                     'webPublicationDate': article['webPublicationDate'],
                     'webTitle': article['webTitle'],
                     'webUrl': article['webUrl'],
                     'contentPreview': content_preview + '...'
                 }
-                article_hits_info.append(article_info)
-        else:
-            error_message = data['response'].get(
-                'message', 'No message provided')
-            raise APIRequestError(
-                f'Error {response.status_code} : {error_message}')
+                # A page may have changed since it was published, so
+                # only an identical preview counts as already published
+                if seen_index is not None and seen_index.seen(article):
+                    continue
+                yield article
+                yielded += 1
+            if (next_page is None and more_pages
+                    and max_results is not None and yielded < max_results
+                    and (deadline is None or not deadline.expired())):
+                # Articles already published left room for another page
+                page += 1
+                next_page = page_executor.submit(
+                    _search_page, query, page, page_size, preview_source,
+                    deadline)
+    except APIRequestError:
+        raise
     except requests.exceptions.RequestException as e:
         logger.error(f'Request failed: {e}')
         raise APIRequestError(f'Request failed: {e}')
     except Exception as e:
         logger.error(f'An unexpected error occurred: {e}')
         raise APIRequestError(f'An unexpected error occurred: {e}')
-    return article_hits_info
+    finally:
+        page_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_articles(
+        search_term: str, from_date: str = None, to_date: str = None,
+        page_size: int = DEFAULT_PAGE_SIZE, max_results: int = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        preview_source: str = 'page', seen_index=None,
+        order_by: str = 'relevance',
+        watermark: Dict = None, deadline: Deadline = None,
+        hedge_after: float = None) -> Iterator[Dict]:
+    """
+    Yields articles from the Guardian API page by page, so that
+    articles can be processed as soon as their page arrives. The next
+    page is requested while the previews of the current one are fetched.
+
+    Args:
+        search_term (str): The search term to query.
+        from_date (str, optional): The start date for the search
+        in YYYY-MM-DD format.
+        to_date (str, optional): The end date for the search, inclusive,
+        in YYYY-MM-DD format. Defaults to no end date.
+        page_size (int, optional): The number of hits requested per page,
+        up to 200. Defaults to DEFAULT_PAGE_SIZE.
+        max_results (int, optional): The maximum number of articles to
+        yield. If not provided, all pages are read.
+        max_workers (int, optional): The maximum number of article
+        pages fetched concurrently for content previews.
+        preview_source (str, optional): Where content previews come from,
+        'page' or 'api'. See retrieve_articles.
+        seen_index (SeenIndex, optional): If provided, articles already
+        published with the same content preview are skipped, and do not
+        count towards max_results. Pages are fetched again to tell
+        whether they changed, while inline previews are checked before
+        any page is fetched.
+        order_by (str, optional): 'relevance', 'newest' or 'oldest'.
+        Defaults to 'relevance'.
+        watermark (Dict, optional): The last published 'date' and the
+        'urls' published at that date. Requires order_by='newest' or
+        'oldest'. Articles at or before the watermark are skipped, and
+        with 'newest', paging stops at the first article older than it.
+        deadline (Deadline, optional): If given, requests time out at
+        the deadline, and no page or preview is requested after it.
+        The articles retrieved by then are yielded, and the rest dropped.
+        hedge_after (float, optional): If given, a preview fetch still
+        running after this many seconds is duplicated, and the first
+        response used. Defaults to no hedging.
+
+    Yields:
+        Dict: The retrieved article's information.
+
+    Raises:
+        APIRequestError: If a page could not be retrieved.
+    """
+    if preview_source not in PREVIEW_SOURCES:
+        raise ValueError(
+            f'preview_source must be one of {PREVIEW_SOURCES}, '
+            f'got {preview_source!r}')
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(
+            f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+    if max_results is not None and max_results < 0:
+        raise ValueError('max_results must not be negative')
+    if order_by not in ORDER_BY_OPTIONS:
+        raise ValueError(
+            f'order_by must be one of {ORDER_BY_OPTIONS}, got {order_by!r}')
+    if watermark is not None and order_by not in WATERMARK_ORDERS:
+        raise ValueError(
+            f'watermark requires order_by in {WATERMARK_ORDERS}')
+    query = {
+        'from-date': from_date,
+        'to-date': to_date,
+        'order-by': order_by,
+        'q': search_term,
+    }
+    if hedge_after is not None and hedge_after <= 0:
+        raise ValueError('hedge_after must be positive')
+    return _iter_articles(query, page_size, max_results, max_workers,
+                          preview_source, seen_index, watermark,
+                          deadline, hedge_after)
+
+
+@timed('retrieve_articles')
+def retrieve_articles(
+        search_term: str, from_date: str = None, to_date: str = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        preview_source: str = 'page', page_size: int = DEFAULT_PAGE_SIZE,
+        max_results: int = DEFAULT_PAGE_SIZE,
+        seen_index=None, order_by: str = 'relevance',
+        watermark: Dict = None, deadline: Deadline = None,
+        hedge_after: float = None) -> Union[str, List[Dict]]:
+    """
+    Retrieves articles from the Guardian API based on search term and date.
+
+    Args:
+        search_term (str): The search term to query.
+        from_date (str, optional): The start date for the search
+        in YYYY-MM-DD format. If not provided, defaults to None,
+        in which case most relevant articles will be retrieved
+        to_date (str, optional): The end date for the search, inclusive,
+        in YYYY-MM-DD format. Defaults to no end date.
+        max_workers (int, optional): The maximum number of article
+        pages fetched concurrently for content previews.
+        Defaults to DEFAULT_MAX_WORKERS.
+        preview_source (str, optional): Where content previews come from.
+        'page' scrapes each article page. 'api' requests the body and
+        trail text with the search and scrapes only the hits that lack
+        both. Defaults to 'page'.
+        page_size (int, optional): The number of hits requested per page,
+        up to 200. Defaults to DEFAULT_PAGE_SIZE.
+        max_results (int, optional): The maximum number of articles to
+        retrieve across pages, or None for all of them.
+        Defaults to DEFAULT_PAGE_SIZE, i.e. the first page.
+        seen_index (SeenIndex, optional): If provided, articles already
+        published with the same content preview are skipped, and do not
+        count towards max_results. Pages are fetched again to tell
+        whether they changed, while inline previews are checked before
+        any page is fetched.
+        order_by (str, optional): 'relevance', 'newest' or 'oldest'.
+        Defaults to 'relevance'.
+        watermark (Dict, optional): Only retrieve articles published
+        after this watermark. See iter_articles.
+        deadline (Deadline, optional): Stop retrieving at this deadline
+        and return the articles retrieved so far. See iter_articles.
+        hedge_after (float, optional): Hedge preview fetches slower than
+        this many seconds. See iter_articles.
+
+    Returns:
+        list: A list of dictionaries containing
+        the retrieved articles' information.
+    """
+    return list(iter_articles(
+        search_term, from_date=from_date, to_date=to_date,
+        page_size=page_size, max_results=max_results, max_workers=max_workers,
+        preview_source=preview_source, seen_index=seen_index,
+        order_by=order_by, watermark=watermark, deadline=deadline,
+        hedge_after=hedge_after))
@@ -0,0 +1,249 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Matches the 72 hour retention period of the Kinesis stream
+DEFAULT_TTL_SECONDS = 72 * 60 * 60
+DEFAULT_BLOOM_CAPACITY = 100_000
+DEFAULT_BLOOM_ERROR_RATE = 0.001
+
+
+def preview_hash(content_preview: str) -> str:
+    """
+    Returns the hash of an article's content preview.
+    """
+    return hashlib.sha256(content_preview.encode('utf-8')).hexdigest()
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter of strings. It may report keys that were
+    never added, but never misses a key that was.
+
+    Args:
+        capacity (int): The number of keys the filter is sized for.
+        error_rate (float): The false positive rate at capacity.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_BLOOM_CAPACITY,
+                 error_rate: float = DEFAULT_BLOOM_ERROR_RATE):
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(key))
+
+
+class MemorySeenStore:
+    """
+    Seen store that keeps records in a dict, for a single process.
+    """
+
+    def __init__(self):
+        self._records: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            return self._records.get(url)
+
+    def put_many(self, records: Iterable[Tuple[str, str, float]]) -> None:
+        with self._lock:
+            for url, hash_, seen_at in records:
+                self._records[url] = (hash_, seen_at)
+
+    def purge(self, older_than: float) -> None:
+        with self._lock:
+            self._records = {
+                url: record for url, record in self._records.items()
+                if record[1] >= older_than}
+
+    def urls(self, newer_than: float) -> List[str]:
+        with self._lock:
+            return [url for url, (_, seen_at) in self._records.items()
+                    if seen_at >= newer_than]
+
+
+class SqliteSeenStore:
+    """
+    Seen store backed by a SQLite database file, so that records
+    persist across processes (e.g. under /tmp between warm invocations)
+    or in a shared location.
+
+    Args:
+        path (str): The path of the database file,
+        or ':memory:' for tests.
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS seen ('
+                'url TEXT PRIMARY KEY, preview_hash TEXT NOT NULL, '
+                'seen_at REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS seen_at_index ON seen (seen_at)')
+
+    def get(self, url: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            return self._connection.execute(
+                'SELECT preview_hash, seen_at FROM seen WHERE url = ?',
+                (url,)).fetchone()
+
+    def put_many(self, records: Iterable[Tuple[str, str, float]]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO seen (url, preview_hash, seen_at) '
+                'VALUES (?, ?, ?)', list(records))
+
+    def purge(self, older_than: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM seen WHERE seen_at < ?', (older_than,))
+
+    def urls(self, newer_than: float) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT url FROM seen WHERE seen_at >= ?', (newer_than,))]
+
+
+class SeenIndex:
+    """
+    Index of the articles already published, used to skip duplicates
+    when the same search term is polled repeatedly.
+
+    Records are keyed on the article URL and store a hash of the content
+    preview, so an article is only a duplicate if its preview is
+    unchanged. An in-memory Bloom filter of the URLs answers most
+    lookups for new articles without touching the store, and records
+    older than ttl are ignored and purged.
+
+    Args:
+        store (optional): The backend holding the records, e.g. a
+        MemorySeenStore or SqliteSeenStore. Defaults to a MemorySeenStore.
+        ttl (float, optional): Seconds a record is kept.
+        Defaults to DEFAULT_TTL_SECONDS.
+        bloom_capacity (int, optional): The number of URLs the Bloom
+        filter is sized for. Defaults to DEFAULT_BLOOM_CAPACITY.
+    """
+
+    def __init__(self, store=None, ttl: float = DEFAULT_TTL_SECONDS,
+                 bloom_capacity: int = DEFAULT_BLOOM_CAPACITY):
+        self.store = store if store is not None else MemorySeenStore()
+        self.ttl = ttl
+        self._bloom = BloomFilter(bloom_capacity)
+        cutoff = time.time() - ttl
+        self.store.purge(cutoff)
+        for url in self.store.urls(cutoff):
+            self._bloom.add(url)
+
+    def _record(self, url: str) -> Optional[Tuple[str, float]]:
+        if url not in self._bloom:
+            return None
+        record = self.store.get(url)
+        if record is None or record[1] < time.time() - self.ttl:
+            return None
+        return record
+
+    def seen_url(self, url: str) -> bool:
+        """
+        Returns True if an article with this URL was published within
+        the TTL, whatever its content preview was.
+        """
+        return self._record(url) is not None
+
+    def seen(self, article: Dict) -> bool:
+        """
+        Returns True if the article was published within the TTL
+        with the same content preview.
+        """
+        record = self._record(article['webUrl'])
+        return (record is not None
+                and record[0] == preview_hash(article['contentPreview']))
+
+    def filter_unseen(self, articles: Iterable[Dict]) -> List[Dict]:
+        """
+        Returns the articles that have not been published yet,
+        dropping repeats within the articles themselves.
+        """
+        unseen = []
+        keys = set()
+        for article in articles:
+            key = (article['webUrl'], article['contentPreview'])
+            if key in keys or self.seen(article):
+                continue
+            keys.add(key)
+            unseen.append(article)
+        return unseen
+
+    def mark(self, articles: Iterable[Dict]) -> None:
+        """
+        Records the articles as published.
+        """
+        now = time.time()
+        records = [
+            (article['webUrl'], preview_hash(article['contentPreview']), now)
+            for article in articles]
+        self.store.put_many(records)
+        for url, _, _ in records:
+            self._bloom.add(url)
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_seen_index() -> SeenIndex:
+    """
+    Returns the shared seen index, creating it on first use.
+
+    Records are kept in SQLite at SEEN_INDEX_PATH (e.g. /tmp/seen.db)
+    when that environment variable is set, and in memory otherwise.
+    SEEN_INDEX_TTL_SECONDS overrides the 72 hour TTL.
+
+    Returns:
+        SeenIndex: The shared index.
+    """
+    global _default_index
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                path = os.environ.get('SEEN_INDEX_PATH')
+                store = SqliteSeenStore(path) if path else MemorySeenStore()
+                _default_index = SeenIndex(
+                    store, ttl=float(os.environ.get(
+                        'SEEN_INDEX_TTL_SECONDS', DEFAULT_TTL_SECONDS)))
+    return _default_index
+
+
+def set_seen_index(index: Optional[SeenIndex]) -> None:
+    """
+    Replaces the shared seen index. Passing None makes the next
+    call to get_seen_index create a new one.
+    """
+    global _default_index
+    with _default_index_lock:
+        _default_index = index
@@ -0,0 +1,141 @@
+from src.clients import get_boto3_client
+from src.json_store import MemoryKeyedStore, JsonFileStore
+from typing import Dict, List, Optional
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryWatermarkStore(MemoryKeyedStore):
+    """
+    Watermark store that keeps the watermark of each search term
+    in a dict, for a single process.
+    """
+
+
+class FileWatermarkStore(JsonFileStore):
+    """
+    Watermark store backed by a JSON file mapping each search term
+    to its watermark.
+
+    Args:
+        path (str): The path of the JSON file.
+    """
+
+
+class DynamoDBWatermarkStore:
+    """
+    Watermark store backed by a DynamoDB table with the string partition
+    key 'search_term', so that every instance of the function polls
+    from the same watermarks. Each watermark is stored as JSON in the
+    'watermark' attribute.
+
+    Args:
+        table_name (str): The name of the DynamoDB table.
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+
+    def get(self, search_term: str) -> Optional[Dict]:
+        item = get_boto3_client('dynamodb').get_item(
+            TableName=self.table_name,
+            Key={'search_term': {'S': search_term}},
+            ConsistentRead=True).get('Item')
+        return json.loads(item['watermark']['S']) if item else None
+
+    def set(self, search_term: str, watermark: Dict) -> None:
+        get_boto3_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item={
+                'search_term': {'S': search_term},
+                'watermark': {'S': json.dumps(watermark, ensure_ascii=False)},
+            })
+
+
+def is_before_watermark(article: Dict, watermark: Optional[Dict]) -> bool:
+    """
+    Returns True if the article was published before the watermark,
+    or at the watermark's date and already published.
+    """
+    if watermark is None:
+        return False
+    date = article['webPublicationDate']
+    return date < watermark['date'] or (
+        date == watermark['date'] and article['webUrl'] in watermark['urls'])
+
+
+def advance_watermark(watermark: Optional[Dict], articles: List[Dict],
+                      published_articles: List[Dict]) -> Optional[Dict]:
+    """
+    Computes the watermark after publishing some of the retrieved articles.
+
+    The watermark only moves up to the latest publication date for which
+    every retrieved article up to that date was published, so articles
+    that failed to publish are retrieved again on the next poll.
+
+    Args:
+        watermark (Optional[Dict]): The current watermark, with the last
+        published 'date' and the 'urls' published at that date.
+        articles (List[Dict]): The articles retrieved after the watermark.
+        published_articles (List[Dict]): The articles that were published.
+
+    Returns:
+        Optional[Dict]: The new watermark, which is the current one
+        if nothing could be advanced.
+    """
+    published_urls = {article['webUrl'] for article in published_articles}
+    new_watermark = watermark
+    for article in sorted(articles, key=lambda a: a['webPublicationDate']):
+        if article['webUrl'] not in published_urls:
+            break
+        date = article['webPublicationDate']
+        if new_watermark is not None and new_watermark['date'] == date:
+            urls = new_watermark['urls'] + [article['webUrl']]
+        else:
+            urls = [article['webUrl']]
+        new_watermark = {'date': date, 'urls': urls}
+    return new_watermark
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_watermark_store():
+    """
+    Returns the shared watermark store, creating it on first use.
+
+    Watermarks are kept in the DynamoDB table named by the
+    WATERMARKS_TABLE environment variable when it is set, so that they
+    are shared by every instance of the function and survive cold
+    starts. Otherwise they are kept in the JSON file at WATERMARK_PATH
+    (e.g. /tmp/watermarks.json) when that is set, and in memory
+    otherwise, both of which only last as long as the instance.
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                table_name = os.environ.get('WATERMARKS_TABLE')
+                path = os.environ.get('WATERMARK_PATH')
+                if table_name:
+                    _default_store = DynamoDBWatermarkStore(table_name)
+                elif path:
+                    _default_store = FileWatermarkStore(path)
+                else:
+                    _default_store = MemoryWatermarkStore()
+    return _default_store
+
+
+def set_watermark_store(store) -> None:
+    """
+    Replaces the shared watermark store. Passing None makes the next
+    call to get_watermark_store create a new one.
+    """
+    global _default_store
+    with _default_store_lock:
+        _default_store = store
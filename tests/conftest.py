@@ -0,0 +1,71 @@
+import pytest
+from moto import mock_kinesis
+import boto3
+import os
+from src.clients import reset_clients
+from src.retrieve_api_key import invalidate_api_key
+from src.preview_cache import set_preview_cache
+from src.seen_index import set_seen_index
+from src.watermarks import set_watermark_store
+from src.publish_to_kinesis import clear_shard_cache
+from src.metrics import set_metrics_recorder
+from src.rate_limiter import reset_rate_limiters
+from src.jobs import set_job_store
+from src.query_cache import set_query_cache
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_state():
+    """Drop cached HTTP sessions, boto3 clients, API keys, previews,
+    seen articles, watermarks, shard ranges, metrics recorders, rate
+    limiters, jobs and cached queries between tests, so that each test's
+    mocks apply to newly created clients."""
+    reset_clients()
+    invalidate_api_key()
+    set_preview_cache(None)
+    set_seen_index(None)
+    set_watermark_store(None)
+    clear_shard_cache()
+    set_metrics_recorder(None)
+    reset_rate_limiters()
+    set_job_store(None)
+    set_query_cache(None)
+    yield
+    reset_clients()
+    invalidate_api_key()
+    set_preview_cache(None)
+    set_seen_index(None)
+    set_watermark_store(None)
+    clear_shard_cache()
+    set_metrics_recorder(None)
+    reset_rate_limiters()
+    set_job_store(None)
+    set_query_cache(None)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ['AWS_ACCESS_KEY_ID'] = 'test'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'test'
+    os.environ['AWS_SECURITY_TOKEN'] = 'test'
+    os.environ['AWS_SESSION_TOKEN'] = 'test'
+    os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
+
+
+@pytest.fixture(scope="function")
+def aws_kinesis(aws_credentials):
+    """Mock AWS Kinesis client with a created stream for testing."""
+    with mock_kinesis():
+        client = boto3.client("kinesis", region_name='eu-west-2')
+        client.create_stream(StreamName="test_stream", ShardCount=1)
+        yield client
+
+
+@pytest.fixture(scope="function")
+def aws_kinesis_four_shards(aws_credentials):
+    """Mock AWS Kinesis client with a four-shard stream, as deployed."""
+    with mock_kinesis():
+        client = boto3.client("kinesis", region_name='eu-west-2')
+        client.create_stream(StreamName="test_stream", ShardCount=4)
+        yield client
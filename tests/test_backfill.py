@@ -0,0 +1,191 @@
+from src.backfill import (
+    backfill, backfill_window, split_date_range, main, BackfillError)
+from src.json_store import MemoryKeyedStore, JsonFileStore
+from src.kinesis_consumer import KinesisConsumer
+import pytest
+from unittest.mock import patch, Mock
+import json
+
+# Three articles a day from 1 to 10 May 2024
+ARTICLES = [{
+    'webPublicationDate': f'2024-05-{day:02d}T{hour:02d}:00:00Z',
+    'webTitle': f'title {day} {hour}',
+    'webUrl': f'http://example.com/{day}/{hour}',
+} for day in range(1, 11) for hour in (6, 12, 18)]
+
+
+def _search(url, params, **kwargs):
+    """Stand-in for the Guardian search, ordered oldest first."""
+    hits = [article for article in ARTICLES
+            if params['from-date'] <= article['webPublicationDate']
+            and article['webPublicationDate'][:10] <= params['to-date']]
+    size = params['page-size']
+    start = (params['page'] - 1) * size
+    response = Mock()
+    response.status_code = 200
+    response.url = 'http://example.com'
+    response.json.return_value = {'response': {
+        'pages': max(1, -(-len(hits) // size)),
+        'results': hits[start:start + size]}}
+    return response
+
+
+@pytest.fixture
+def guardian():
+    """Stand-in Guardian search and article pages."""
+    with patch('requests.Session.get', side_effect=_search) as mock_get, \
+            patch('src.retrieve_articles.get_api_key',
+                  return_value='test_api_key'), \
+            patch('src.retrieve_articles.fetch_content_preview',
+                  side_effect=lambda url, **kwargs: f'preview of {url}'
+                  ) as mock_fetch_content_preview:
+        yield mock_get, mock_fetch_content_preview
+
+
+def _published_urls():
+    return [article['webUrl'] for article in KinesisConsumer(
+        'test_stream', stop_at_latest=True,
+        poll_interval=0.01).iter_articles()]
+
+
+def test_split_date_range_into_windows():
+    """Test that a range is split into windows of window_days,
+    the last of which may be shorter."""
+    assert split_date_range('2024-05-01', '2024-05-10', 4) == [
+        ('2024-05-01', '2024-05-04'), ('2024-05-05', '2024-05-08'),
+        ('2024-05-09', '2024-05-10')]
+    assert split_date_range('2024-05-01', '2024-05-01') == [
+        ('2024-05-01', '2024-05-01')]
+
+
+@pytest.mark.parametrize('from_date,to_date,window_days', [
+    ('2024-05-02', '2024-05-01', 7), ('2024-05-01', '2024-05-02', 0),
+    ('2024-05', '2024-05-02', 7)])
+def test_split_date_range_rejects_invalid_ranges(
+        from_date, to_date, window_days):
+    """Test that inverted ranges, empty windows and bad dates fail."""
+    with pytest.raises(ValueError):
+        split_date_range(from_date, to_date, window_days)
+
+
+def test_backfill_publishes_every_window(aws_kinesis, guardian):
+    """Test that the articles of every window are published once."""
+    windows = backfill('test', 'test_stream', '2024-05-01', '2024-05-10',
+                       window_days=3, max_windows=4, page_size=2)
+
+    assert [window['status'] for window in windows] == ['done'] * 4
+    assert [window['articles_published'] for window in windows] == [
+        9, 9, 9, 3]
+    assert sorted(_published_urls()) == sorted(
+        article['webUrl'] for article in ARTICLES)
+
+
+def test_backfill_skips_completed_windows(aws_kinesis, guardian):
+    """Test that running a backfill again with the same checkpoints
+    neither searches nor publishes the completed windows."""
+    mock_get, _ = guardian
+    store = MemoryKeyedStore()
+    backfill('test', 'test_stream', '2024-05-01', '2024-05-06',
+             checkpoint_store=store, window_days=3)
+    searches = mock_get.call_count
+
+    windows = backfill('test', 'test_stream', '2024-05-01', '2024-05-06',
+                       checkpoint_store=store, window_days=3)
+
+    assert [window['status'] for window in windows] == ['skipped'] * 2
+    assert mock_get.call_count == searches
+    assert len(_published_urls()) == 18
+
+
+def test_interrupted_window_resumes_after_checkpoint(
+        aws_kinesis, guardian, tmp_path):
+    """Test that a window interrupted after some pages resumes after
+    its last published page, without fetching or publishing the
+    articles that were already published."""
+    _, mock_fetch_content_preview = guardian
+    store = JsonFileStore(str(tmp_path / 'checkpoints.json'))
+    window = ('2024-05-01', '2024-05-03')
+    calls = []
+
+    def fail_second_page(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise Exception('Kinesis unavailable')
+        return ('Published', args[2])
+
+    with patch('src.backfill.publish_to_kinesis',
+               side_effect=fail_second_page):
+        with pytest.raises(Exception):
+            backfill_window('test', 'test_stream', window, store,
+                            page_size=4)
+    checkpoint = store.get('test_stream/test/2024-05-01/2024-05-03')
+    assert checkpoint['status'] == 'running'
+    assert checkpoint['published'] == 4
+    mock_fetch_content_preview.reset_mock()
+
+    summary = backfill_window('test', 'test_stream', window, store,
+                              page_size=4)
+
+    assert summary['status'] == 'done'
+    assert summary['articles_published'] == 9
+    assert _published_urls() == [
+        article['webUrl'] for article in ARTICLES[4:9]]
+    assert mock_fetch_content_preview.call_count == 5
+
+
+@patch('src.backfill.publish_to_kinesis')
+def test_partially_published_page_fails_window(
+        mock_publish_to_kinesis, guardian):
+    """Test that a window stops when articles of a page were not
+    published, with its checkpoint before the first that failed."""
+    mock_publish_to_kinesis.side_effect = (
+        lambda stream, term, articles, **kwargs: (
+            'Published', [articles[0], articles[2]]))
+    store = MemoryKeyedStore()
+
+    with pytest.raises(BackfillError):
+        backfill_window('test', 'test_stream', ('2024-05-01', '2024-05-01'),
+                        store, page_size=3)
+
+    checkpoint = store.get('test_stream/test/2024-05-01/2024-05-01')
+    assert checkpoint['watermark'] == {
+        'date': ARTICLES[0]['webPublicationDate'],
+        'urls': [ARTICLES[0]['webUrl']]}
+
+
+@patch('src.backfill.backfill_window')
+def test_failed_window_does_not_stop_the_others(mock_backfill_window):
+    """Test that a failing window is reported while the others run."""
+    def run(term, stream, window, store, **kwargs):
+        if window[0] == '2024-05-04':
+            raise Exception('Guardian unavailable')
+        return {'from_date': window[0], 'to_date': window[1],
+                'status': 'done', 'articles_published': 1}
+    mock_backfill_window.side_effect = run
+
+    windows = backfill('test', 'test_stream', '2024-05-01', '2024-05-09',
+                       window_days=3)
+
+    assert [window['status'] for window in windows] == [
+        'done', 'failed', 'done']
+    assert windows[1]['error'] == 'Guardian unavailable'
+
+
+@patch('src.backfill.backfill')
+def test_main_reports_windows_and_exit_status(
+        mock_backfill, tmp_path, capsys):
+    """Test that the command prints the window summaries and exits
+    with status 1 if a window failed."""
+    mock_backfill.return_value = [
+        {'from_date': '2024-05-01', 'to_date': '2024-05-07',
+         'status': 'failed', 'articles_published': 0, 'error': 'failed'}]
+
+    status = main(['--search-term', 'test', '--kinesis-stream',
+                   'test_stream', '--from-date', '2024-05-01',
+                   '--to-date', '2024-05-07', '--checkpoint-file',
+                   str(tmp_path / 'checkpoints.json')])
+
+    assert status == 1
+    assert json.loads(capsys.readouterr().out) == (
+        mock_backfill.return_value)
+    assert mock_backfill.call_args.kwargs['window_days'] == 7
@@ -0,0 +1,54 @@
+from benchmarks.run_benchmarks import (
+    run_benchmarks, compare_results, summarise, main)
+import json
+
+
+def test_run_benchmarks_times_every_stage():
+    """Test that a short offline run reports timings for each stage."""
+    results = run_benchmarks(repeat=1, warmup=0, article_count=5)
+
+    assert results['metadata']['article_count'] == 5
+    assert {'retrieve_api_key', 'search', 'fetch_content_preview',
+            'parse_preview[stdlib]', 'parse_preview[bs4]', 'encode[json]',
+            'publish_to_kinesis', 'lambda_handler'} <= set(results['stages'])
+    for timings in results['stages'].values():
+        assert timings['runs'] == 1
+        assert 0 < timings['min_ms'] <= timings['max_ms']
+
+
+def test_summarise_reports_milliseconds():
+    """Test the statistics computed from the durations of the runs."""
+    timings = summarise([0.004, 0.001, 0.002, 0.003])
+
+    assert timings == {'runs': 4, 'min_ms': 1.0, 'median_ms': 2.5,
+                       'mean_ms': 2.5, 'p95_ms': 4.0, 'max_ms': 4.0}
+
+
+def test_compare_results_flags_slower_stages():
+    """Test that only stages slower than the threshold are reported."""
+    baseline = {'stages': {'search': {'median_ms': 10.0},
+                           'lambda_handler': {'median_ms': 100.0}}}
+    results = {'stages': {'search': {'median_ms': 13.0},
+                          'lambda_handler': {'median_ms': 110.0},
+                          'new_stage': {'median_ms': 1.0}}}
+
+    regressions = compare_results(baseline, results, threshold=0.25)
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith('search: median 13.000 ms')
+
+
+def test_main_fails_on_regression(tmp_path, capsys):
+    """Test that the command line exits with 1 when a stage regressed
+    against the baseline, and writes the results as JSON."""
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps(
+        {'stages': {'encode[json]': {'median_ms': 0.000001}}}))
+    output = tmp_path / 'results.json'
+
+    exit_code = main(['--repeat', '1', '--warmup', '0', '--articles', '2',
+                      '--output', str(output), '--baseline', str(baseline)])
+
+    assert exit_code == 1
+    assert 'encode[json]' in json.loads(output.read_text())['stages']
+    assert 'Regression: encode[json]' in capsys.readouterr().err
@@ -0,0 +1,45 @@
+from src.clients import (get_http_session, get_boto3_client,
+                         set_http_session, set_boto3_client, reset_clients)
+from unittest.mock import patch, Mock
+import requests
+
+
+def test_get_http_session_is_reused():
+    """Test that the same session is returned on every call."""
+    session = get_http_session()
+    assert isinstance(session, requests.Session)
+    assert get_http_session() is session
+
+
+def test_get_http_session_uses_configured_pool_size(monkeypatch):
+    """Test that HTTP_POOL_SIZE sets the size of the connection pool."""
+    monkeypatch.setenv('HTTP_POOL_SIZE', '25')
+    adapter = get_http_session().get_adapter('https://example.com')
+    assert adapter._pool_maxsize == 25
+    assert adapter._pool_connections == 25
+
+
+@patch('boto3.client')
+def test_get_boto3_client_is_cached_per_service(mock_boto_client):
+    """Test that each boto3 client is created once per service."""
+    mock_boto_client.side_effect = lambda service: Mock(name=service)
+
+    kinesis = get_boto3_client('kinesis')
+    assert get_boto3_client('kinesis') is kinesis
+    assert get_boto3_client('secretsmanager') is not kinesis
+    assert mock_boto_client.call_count == 2
+
+
+def test_clients_can_be_injected_and_reset():
+    """Test that injected clients are returned until reset."""
+    session = Mock()
+    client = Mock()
+    set_http_session(session)
+    set_boto3_client('kinesis', client)
+
+    assert get_http_session() is session
+    assert get_boto3_client('kinesis') is client
+
+    reset_clients()
+    session.close.assert_called_once()
+    assert get_http_session() is not session
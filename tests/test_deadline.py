@@ -0,0 +1,210 @@
+import pytest
+from src.deadline import Deadline, MIN_TIMEOUT_SECONDS
+from src.lambda_handler import lambda_handler
+from src.rate_limiter import (
+    RateLimiter, RateLimitTimeout, send_with_backoff, set_rate_limiter)
+from src.retrieve_articles import retrieve_articles
+from src.fetch_article_content import fetch_content_preview, FetchPageError
+from src.preview_cache import get_preview_cache
+from unittest.mock import patch, Mock
+import threading
+import time
+
+
+def _search_response(page_size=4):
+    response = Mock()
+    response.status_code = 200
+    response.url = 'http://example.com'
+    response.json.return_value = {
+        'response': {
+            'pages': 1,
+            'results': [
+                {'webUrl': f'url_{i}',
+                 'webPublicationDate': f'date_{i}',
+                 'webTitle': f'title_{i}'}
+                for i in range(page_size)
+            ]
+        }
+    }
+    return response
+
+
+def test_deadline_from_context_keeps_reserve():
+    """Test that the deadline of an invocation is the remaining time
+    of the Lambda context less the reserve."""
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 30000
+
+    deadline = Deadline.from_context(context, reserve=5)
+
+    assert 24.9 < deadline.remaining() <= 25
+    assert not deadline.expired()
+
+
+def test_deadline_from_context_without_remaining_time():
+    """Test that a context without the remaining time gives no deadline."""
+    assert Deadline.from_context({}) is None
+
+
+def test_deadline_bounds_timeout():
+    """Test that timeouts are cut to the time left, but never
+    below the minimum timeout."""
+    assert Deadline(60).timeout(10) == 10
+    assert Deadline(2).timeout(10) <= 2
+    assert Deadline(-1).timeout(10) == MIN_TIMEOUT_SECONDS
+    assert Deadline(-1).expired()
+
+
+@patch('src.rate_limiter.time.sleep')
+def test_send_with_backoff_stops_retrying_at_deadline(mock_sleep):
+    """Test that a throttled request is not resent when the
+    backoff would take it past the deadline."""
+    send = Mock(return_value=Mock(status_code=429, headers={}))
+
+    response = send_with_backoff(
+        RateLimiter(rate=1000, burst=10, max_concurrency=10), send,
+        deadline=Deadline(0.01))
+
+    assert response.status_code == 429
+    assert send.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_rate_limiter_gives_up_at_deadline():
+    """Test that acquire does not wait for a pause or concurrency
+    slot that only frees up after the deadline."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=1)
+    limiter.pause(20)
+
+    started = time.monotonic()
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(Deadline(1))
+    assert time.monotonic() - started < 0.1
+
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=1)
+    limiter.acquire()
+    started = time.monotonic()
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(Deadline(0.05))
+    assert time.monotonic() - started < 0.5
+    assert limiter.in_flight == 1
+
+
+def test_retry_after_past_deadline_does_not_pause_limiter():
+    """Test that a Retry-After delay longer than the time left neither
+    pauses the limiter for the other requests nor is waited for."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=10)
+    send = Mock(return_value=Mock(status_code=429,
+                                  headers={'Retry-After': '20'}))
+
+    response = send_with_backoff(limiter, send, deadline=Deadline(5))
+
+    assert response.status_code == 429
+    assert send.call_count == 1
+    limiter.acquire(Deadline(0.05))
+
+
+def test_fetch_content_preview_fails_fast_when_limiter_is_paused():
+    """Test that a preview fetch held back by the limiter past the
+    deadline fails at once, without negatively caching the page."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=10)
+    limiter.pause(20)
+    set_rate_limiter('pages', limiter)
+
+    with pytest.raises(FetchPageError):
+        fetch_content_preview('http://example.com/page',
+                              deadline=Deadline(1))
+    assert not get_preview_cache().has_failed('http://example.com/page')
+
+
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_passes_deadline_timeouts(
+        mock_get, mock_get_api_key):
+    """Test that the search request and the preview fetches
+    are given timeouts bounded by the deadline."""
+    mock_get.return_value = _search_response(page_size=1)
+    deadline = Deadline(3)
+
+    with patch('src.retrieve_articles.fetch_content_preview',
+               return_value='preview') as mock_fetch:
+        retrieve_articles('TEST', deadline=deadline)
+
+    assert mock_get.call_args.kwargs['timeout'] <= 3
+    mock_fetch.assert_called_once_with('url_0', deadline=deadline)
+
+
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_returns_partial_results_at_deadline(
+        mock_get, mock_get_api_key):
+    """Test that no preview is fetched once the deadline has passed,
+    and the articles retrieved before it are returned."""
+    mock_get.return_value = _search_response()
+    deadline = Deadline(0.2)
+
+    def slow_fetch(url, deadline):
+        time.sleep(0.15)
+        return f'preview_{url}'
+
+    with patch('src.retrieve_articles.fetch_content_preview',
+               side_effect=slow_fetch) as mock_fetch:
+        articles = retrieve_articles('TEST', max_workers=1,
+                                     deadline=deadline)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_0', 'url_1']
+    assert mock_fetch.call_count == 2
+
+
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_slow_preview_fetch_is_hedged(mock_get, mock_get_api_key):
+    """Test that a preview fetch slower than hedge_after is sent
+    again, and the first response to arrive is used."""
+    mock_get.return_value = _search_response(page_size=1)
+    first_call = threading.Event()
+    release = threading.Event()
+
+    def fetch(url):
+        if not first_call.is_set():
+            first_call.set()
+            release.wait(2)
+            return 'slow preview'
+        return 'hedged preview'
+
+    with patch('src.retrieve_articles.fetch_content_preview',
+               side_effect=fetch) as mock_fetch:
+        articles = retrieve_articles('TEST', hedge_after=0.05)
+    release.set()
+
+    assert articles[0]['contentPreview'] == 'hedged preview...'
+    assert mock_fetch.call_count == 2
+
+
+def test_retrieve_articles_rejects_non_positive_hedge_after():
+    """Test that hedge_after must be positive."""
+    with pytest.raises(ValueError):
+        retrieve_articles('TEST', hedge_after=0)
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', []))
+@patch('src.lambda_handler.retrieve_articles', return_value=[])
+def test_lambda_handler_derives_deadline_from_context(
+        mock_retrieve_articles, mock_publish_to_kinesis, monkeypatch):
+    """Test that the handler passes a deadline taken from the Lambda
+    context, less DEADLINE_RESERVE_SECONDS, to the retrieval."""
+    monkeypatch.setenv('DEADLINE_RESERVE_SECONDS', '2')
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 10000
+    event = {'queryStringParameters': {
+        'search_term': 'test', 'kinesis_stream': 'test_stream',
+        'hedge_after': '0.5'}}
+
+    response = lambda_handler(event, context)
+
+    assert response['statusCode'] == 200
+    kwargs = mock_retrieve_articles.call_args.kwargs
+    assert 7.9 < kwargs['deadline'].remaining() <= 8
+    assert kwargs['hedge_after'] == 0.5
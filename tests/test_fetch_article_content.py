@@ -1,8 +1,34 @@
 import pytest
-from src.fetch_article_content import fetch_content_preview, FetchPageError
+from src.fetch_article_content import (
+    fetch_content_preview, extract_preview, _create_parser,
+    _ParagraphPreviewParser, FetchPageError, PARSER_BACKENDS)
+from src.deadline import Deadline
+from src.preview_cache import get_preview_cache
 import requests_mock
+from unittest.mock import patch, Mock
+import os
+import time
 
 TEST_URL = "http://testexample.com/page"
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+FIXTURE_PAGES = ('article.html', 'short_article.html', 'live_blog.html',
+                 'malformed_article.html')
+
+
+def _fixture_page(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def _installed_backends():
+    backends = []
+    for backend in PARSER_BACKENDS:
+        try:
+            _create_parser(backend)
+        except ValueError:
+            continue
+        backends.append(backend)
+    return backends
 
 
 def test_fetch_content_preview_success():
@@ -80,3 +106,251 @@ def test_fetch_content_preview_handles_long_paragraphs():
         mocker.get(TEST_URL, text=response_text)
         content_preview = fetch_content_preview(TEST_URL)
         assert len(content_preview) == 1000
+
+
+ARTICLE_HTML = """
+<html>
+  <head><title>Article</title><script>var p = "<p>";</script></head>
+  <body>
+    <nav><a href="/">Home</a></nav>
+    <p>First paragraph with <a href="/x">a link</a> and &amp; entity. </p>
+    <div><p>  Second paragraph, inside a div.</p></div>
+    <p>Café naïve — unicode text.</p>
+""" + "<p>" + "Long paragraph text. " * 30 + "</p>" + """
+    <p>Never reached.</p>
+  </body>
+</html>
+"""
+
+
+@pytest.mark.parametrize('response_text', [
+    ARTICLE_HTML,
+    "<html><body><p>Test Article</p></body></html>" * 2000,
+    "<p>Unclosed paragraph at the end",
+    "<p>one</p><p>two</p><p>three</p>",
+])
+def test_fetch_content_preview_streaming_matches_full_parse(response_text):
+    '''
+    Test that the streaming extractor produces the same
+    preview as parsing the whole page with BeautifulSoup.
+    '''
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, text=response_text)
+        streamed = fetch_content_preview(
+            TEST_URL, streaming=True, use_cache=False)
+        parsed = fetch_content_preview(
+            TEST_URL, streaming=False, use_cache=False, parser='bs4')
+    assert streamed == parsed
+
+
+def test_fetch_content_preview_streaming_stops_reading_early():
+    '''
+    Test that the streaming extractor stops reading the
+    response once it has 1000 characters of paragraph text.
+    '''
+    chunks_read = []
+
+    def chunks(chunk_size):
+        for i in range(1000):
+            chunks_read.append(i)
+            yield ("<p>" + "x" * 200 + "</p>").encode('utf-8')
+
+    response = Mock()
+    response.encoding = 'utf-8'
+    response.headers = {}
+    response.iter_content.side_effect = chunks
+    response.__enter__ = Mock(return_value=response)
+    response.__exit__ = Mock(return_value=False)
+
+    with patch('requests.Session.get', return_value=response) as mock_get:
+        content_preview = fetch_content_preview(TEST_URL)
+
+    assert mock_get.call_args.kwargs['stream'] is True
+    assert len(content_preview) == 1000
+    assert len(chunks_read) == 5
+    response.__exit__.assert_called_once()
+
+
+def test_fetch_content_preview_streaming_stops_at_the_deadline():
+    '''
+    Test that a slowly streamed page stops being read once the
+    deadline has passed, and that the partial preview is not cached.
+    '''
+    chunks_read = []
+
+    def chunks(chunk_size):
+        for i in range(100):
+            time.sleep(0.05)
+            chunks_read.append(i)
+            yield f"<p>Paragraph {i}.</p>".encode('utf-8')
+
+    response = Mock()
+    response.encoding = 'utf-8'
+    response.headers = {}
+    response.iter_content.side_effect = chunks
+    response.__enter__ = Mock(return_value=response)
+    response.__exit__ = Mock(return_value=False)
+
+    with patch('requests.Session.get', return_value=response):
+        content_preview = fetch_content_preview(
+            TEST_URL, deadline=Deadline(0.2))
+
+    assert content_preview.startswith('Paragraph 0. Paragraph 1. ')
+    assert content_preview == ''.join(
+        f'Paragraph {i}. ' for i in chunks_read)
+    assert len(chunks_read) < 10
+    response.__exit__.assert_called_once()
+    assert get_preview_cache().get(TEST_URL) is None
+
+
+def test_fetch_content_preview_streaming_decodes_split_characters():
+    '''
+    Test that multi-byte characters split across
+    chunk boundaries are decoded correctly.
+    '''
+    body = "<p>Café — naïve</p>".encode('utf-8')
+    response = Mock()
+    response.encoding = 'utf-8'
+    response.headers = {}
+    response.iter_content.return_value = [
+        body[i:i + 1] for i in range(len(body))]
+    response.__enter__ = Mock(return_value=response)
+    response.__exit__ = Mock(return_value=False)
+
+    with patch('requests.Session.get', return_value=response):
+        content_preview = fetch_content_preview(TEST_URL)
+
+    assert content_preview == "Café — naïve "
+
+
+def test_fetch_content_preview_serves_fresh_previews_from_cache():
+    '''
+    Test that a fresh cached preview is returned
+    without fetching the page again.
+    '''
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, text="<p>Cached content</p>")
+        first = fetch_content_preview(TEST_URL)
+        second = fetch_content_preview(TEST_URL)
+        assert mocker.call_count == 1
+    assert first == second == "Cached content "
+
+
+def test_fetch_content_preview_revalidates_stale_previews():
+    '''
+    Test that a stale cached preview is revalidated with a
+    conditional GET and reused when the page returns 304.
+    '''
+    get_preview_cache().fresh_ttl = 0
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, text="<p>Cached content</p>",
+                   headers={'ETag': '"v1"',
+                            'Last-Modified': 'Wed, 01 May 2024 12:00:00 GMT'})
+        fetch_content_preview(TEST_URL)
+
+        mocker.get(TEST_URL, status_code=304)
+        content_preview = fetch_content_preview(TEST_URL)
+        request_headers = mocker.last_request.headers
+
+    assert content_preview == "Cached content "
+    assert request_headers['If-None-Match'] == '"v1"'
+    assert request_headers['If-Modified-Since'] == (
+        'Wed, 01 May 2024 12:00:00 GMT')
+
+
+def test_fetch_content_preview_caches_failures():
+    '''
+    Test that a URL which returned 404 is not fetched
+    again while it is in the negative cache.
+    '''
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, status_code=404)
+        with pytest.raises(FetchPageError):
+            fetch_content_preview(TEST_URL)
+        with pytest.raises(FetchPageError):
+            fetch_content_preview(TEST_URL)
+        assert mocker.call_count == 1
+
+
+def test_fetch_content_preview_does_not_cache_timeouts():
+    '''
+    Test that a page that timed out, e.g. on a timeout shortened by
+    the deadline, is fetched again rather than negatively cached.
+    '''
+    import requests
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, [
+            {'exc': requests.exceptions.ConnectTimeout},
+            {'text': '<p>Test Article</p>'}])
+        with pytest.raises(FetchPageError):
+            fetch_content_preview(TEST_URL)
+        assert fetch_content_preview(TEST_URL) == 'Test Article '
+
+
+def test_failure_after_concurrent_success_is_not_cached():
+    '''
+    Test that a request failing after a concurrent request for the
+    same page succeeded, e.g. the losing one of a hedged pair, does
+    not negatively cache the page.
+    '''
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TEST_URL, text='<p>Test Article</p>')
+        fetch_content_preview(TEST_URL)
+        get_preview_cache().put_failure(TEST_URL)
+
+        assert fetch_content_preview(TEST_URL) == 'Test Article '
+
+
+@pytest.mark.parametrize('page', FIXTURE_PAGES)
+@pytest.mark.parametrize('backend', _installed_backends())
+def test_parser_backends_build_identical_previews(page, backend):
+    """
+    Test that every installed parser backend builds the same preview
+    of the fixture pages as BeautifulSoup, whether the page is parsed
+    whole or fed in small chunks as it is streamed.
+    """
+    html = _fixture_page(page)
+    expected = extract_preview(html, 'bs4')
+
+    parser = _create_parser(backend)
+    for start in range(0, len(html), 64):
+        parser.feed(html[start:start + 64])
+    parser.close()
+
+    assert expected
+    assert extract_preview(html, backend) == expected
+    assert parser.preview == expected
+
+
+@pytest.mark.parametrize('html,expected', [
+    ('<p>Intro<div class=nav>Menu</div>'
+     '<script>var tracking = {id: 1};</script><p>Body para.</p>',
+     'Intro Body para. '),
+    ('<p>a<p>b</p>', 'a b '),
+    ('<p>a<script>x</script>b<style>.c {}</style></p>', 'ab '),
+    ('<p>a<ul><li>item</li></ul>b</p>', 'a '),
+    ('<div><p>a</div>b<p>c', 'a c '),
+])
+@pytest.mark.parametrize('backend', _installed_backends())
+def test_parser_backends_close_unclosed_paragraphs(html, expected, backend):
+    """
+    Test that every backend closes an unclosed <p> at the next block
+    tag or at the end of its parent, as lxml does, without repeating
+    its text or keeping the text of scripts and styles.
+    """
+    assert extract_preview(html, backend) == expected
+
+
+def test_html_parser_env_selects_backend(monkeypatch):
+    """Test that HTML_PARSER selects the default parser backend."""
+    monkeypatch.setenv('HTML_PARSER', 'stdlib')
+
+    assert isinstance(_create_parser(), _ParagraphPreviewParser)
+
+
+def test_fetch_content_preview_rejects_unknown_parser():
+    """Test that an unknown backend fails before the page is requested."""
+    with requests_mock.Mocker() as mocker:
+        with pytest.raises(ValueError):
+            fetch_content_preview(TEST_URL, parser='html5lib')
+        assert not mocker.called
@@ -0,0 +1,71 @@
+from benchmarks.import_time import (
+    measure_import, parse_importtime, check_budget)
+import subprocess
+import sys
+import textwrap
+
+
+def test_lambda_handler_import_defers_heavy_packages():
+    """Test that importing the Lambda handler loads none of
+    boto3, botocore, requests, urllib3 or bs4."""
+    result = measure_import('src.lambda_handler', runs=1)
+
+    assert result['deferred_packages_loaded'] == []
+    assert result['cumulative_ms'] > 0
+
+
+def test_streaming_and_api_previews_do_not_load_bs4():
+    """Test that bs4 stays unloaded when previews come from the
+    search response or are parsed while streaming."""
+    script = textwrap.dedent('''
+        import sys
+        from unittest.mock import MagicMock, Mock
+        from src.clients import set_http_session
+        from src.fetch_article_content import fetch_content_preview
+        from src.retrieve_articles import _iter_article_previews
+
+        response = MagicMock(status_code=200, encoding='utf-8', headers={})
+        response.iter_content.return_value = [b'<p>Streamed text</p>']
+        response.__enter__.return_value = response
+        set_http_session(Mock(get=Mock(return_value=response)))
+        articles = [{'webUrl': 'http://example.com',
+                     'fields': {'bodyText': 'Body text'}}]
+
+        assert list(_iter_article_previews(articles, 'api', 2)) == [
+            'Body text']
+        assert fetch_content_preview(
+            'http://example.com').strip() == 'Streamed text'
+        print('bs4' in sys.modules)
+    ''')
+    completed = subprocess.run(
+        [sys.executable, '-c', script], capture_output=True, text=True,
+        check=True)
+
+    assert completed.stdout.strip() == 'False'
+
+
+def test_parse_importtime_reads_each_module():
+    """Test that the python -X importtime report is parsed."""
+    output = (
+        'import time: self [us] | cumulative | imported package\n'
+        'import time:       120 |        120 |   json.decoder\n'
+        'import time:       300 |        420 | json\n'
+    )
+
+    assert parse_importtime(output) == [
+        {'module': 'json.decoder', 'self_us': 120, 'cumulative_us': 120},
+        {'module': 'json', 'self_us': 300, 'cumulative_us': 420},
+    ]
+
+
+def test_check_budget_reports_slow_imports_and_loaded_packages():
+    """Test that an import over budget, or that loads a deferred
+    package, is reported."""
+    result = {'module': 'src.lambda_handler', 'cumulative_ms': 150.0,
+              'deferred_packages_loaded': ['boto3']}
+
+    violations = check_budget(result, budget_ms=100)
+
+    assert len(violations) == 2
+    assert check_budget(dict(result, cumulative_ms=50.0,
+                             deferred_packages_loaded=[])) == []
@@ -0,0 +1,252 @@
+from src.jobs import (
+    MemoryJobStore, DynamoDBJobStore, new_job, get_job_store, set_job_store)
+from src.lambda_handler import lambda_handler, JOB_EVENT_KEY
+import pytest
+from moto import mock_dynamodb
+import boto3
+from unittest.mock import patch, Mock
+import json
+
+
+@pytest.fixture(scope="function")
+def jobs_table(aws_credentials):
+    """Mock DynamoDB with a created jobs table for testing."""
+    with mock_dynamodb():
+        client = boto3.client('dynamodb', region_name='eu-west-2')
+        client.create_table(
+            TableName='jobs',
+            KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'job_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        yield 'jobs'
+
+
+@pytest.fixture
+def lambda_client(monkeypatch):
+    """Stand-in Lambda client recording asynchronous invocations."""
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'test_function')
+    client = Mock()
+    with patch('src.lambda_handler.get_boto3_client',
+               return_value=client):
+        yield client
+
+
+def _event(**params):
+    return {'queryStringParameters': {
+        'search_term': 'test', 'kinesis_stream': 'test_stream', **params}}
+
+
+def test_memory_job_store_updates_jobs():
+    """Test that updates are merged into the stored job."""
+    store = MemoryJobStore()
+    job = new_job(['test'], 'test_stream')
+    store.create(job)
+
+    store.update(job['job_id'], status='running')
+
+    stored = store.get(job['job_id'])
+    assert stored['status'] == 'running'
+    assert stored['search_terms'] == ['test']
+    assert store.get('unknown') is None
+
+
+def test_dynamodb_job_store_round_trips_jobs(jobs_table):
+    """Test that jobs are stored in and read back from DynamoDB."""
+    store = DynamoDBJobStore(jobs_table)
+    job = new_job(['Football', 'Émile'], 'test_stream')
+    store.create(job)
+
+    store.update(job['job_id'], status='succeeded',
+                 articles_published=[{'webUrl': 'url'}])
+
+    stored = store.get(job['job_id'])
+    assert stored['status'] == 'succeeded'
+    assert stored['search_terms'] == ['Football', 'Émile']
+    assert stored['articles_published'] == [{'webUrl': 'url'}]
+    assert store.get('unknown') is None
+
+
+def test_get_job_store_uses_jobs_table(monkeypatch):
+    """Test that JOBS_TABLE selects the DynamoDB job store."""
+    monkeypatch.setenv('JOBS_TABLE', 'jobs')
+    set_job_store(None)
+
+    assert isinstance(get_job_store(), DynamoDBJobStore)
+    assert get_job_store().table_name == 'jobs'
+
+
+def test_async_request_returns_202_and_invokes_job(lambda_client):
+    """Test that an async request is queued as a pending job and
+    runs in an asynchronous invocation of the same function."""
+    response = lambda_handler(_event(**{'async': 'true'}), {})
+
+    assert response['statusCode'] == 202
+    job_id = json.loads(response['body'])['job_id']
+    assert get_job_store().get(job_id)['status'] == 'pending'
+    kwargs = lambda_client.invoke.call_args.kwargs
+    assert kwargs['FunctionName'] == 'test_function'
+    assert kwargs['InvocationType'] == 'Event'
+    payload = json.loads(kwargs['Payload'])
+    assert payload[JOB_EVENT_KEY] == job_id
+    assert payload['request']['queryStringParameters']['search_term'] == (
+        'test')
+
+
+def test_async_request_is_validated_before_queueing(lambda_client):
+    """Test that an async request with invalid options fails at once."""
+    response = lambda_handler(
+        _event(**{'async': 'true', 'encoding': 'xml'}), {})
+
+    assert response['statusCode'] == 500
+    lambda_client.invoke.assert_not_called()
+
+
+def test_failed_invocation_marks_job_failed(lambda_client):
+    """Test that a job whose invocation could not be sent is failed."""
+    lambda_client.invoke.side_effect = Exception('throttled')
+    store = MemoryJobStore()
+    set_job_store(store)
+
+    response = lambda_handler(_event(**{'async': 'true'}), {})
+
+    assert response['statusCode'] == 500
+    [job] = store._jobs.values()
+    assert job['status'] == 'failed'
+
+
+@patch('src.lambda_handler.publish_to_kinesis')
+@patch('src.lambda_handler.retrieve_articles')
+def test_job_invocation_records_progress_and_result(
+        mock_retrieve_articles, mock_publish_to_kinesis, lambda_client):
+    """Test that the job invocation runs the request and that the
+    status lookup reports its result and the number of articles
+    published."""
+    articles = [{'webUrl': 'url', 'webTitle': 'title'}]
+    mock_retrieve_articles.return_value = articles
+    mock_publish_to_kinesis.return_value = ('Published 1', articles)
+    job_id = json.loads(lambda_handler(
+        _event(**{'async': 'true'}), {})['body'])['job_id']
+    payload = json.loads(lambda_client.invoke.call_args.kwargs['Payload'])
+
+    assert lambda_handler(payload, {}) == {
+        'job_id': job_id, 'status': 'succeeded'}
+
+    mock_retrieve_articles.assert_called_once()
+    response = lambda_handler(
+        {'queryStringParameters': {'job_id': job_id}}, {})
+    assert response['statusCode'] == 200
+    job = json.loads(response['body'])
+    assert job['status'] == 'succeeded'
+    assert job['progress'] == {'stage': 'done'}
+    assert job['result'] == 'Published 1'
+    assert job['articles_published_count'] == 1
+    assert 'articles_published' not in job
+
+
+@patch('src.lambda_handler.retrieve_articles',
+       side_effect=Exception('Guardian unavailable'))
+def test_job_invocation_records_failure(mock_retrieve_articles):
+    """Test that a failing job is recorded as failed
+    rather than raised, so Lambda does not retry it."""
+    store = MemoryJobStore()
+    job = new_job(['test'], 'test_stream')
+    store.create(job)
+    set_job_store(store)
+
+    result = lambda_handler(
+        {JOB_EVENT_KEY: job['job_id'], 'request': _event()}, {})
+
+    assert result['status'] == 'failed'
+    assert store.get(job['job_id'])['error'] == 'Guardian unavailable'
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published 0', []))
+@patch('src.lambda_handler.retrieve_articles', return_value=[])
+def test_job_invocation_delivered_twice_runs_once(
+        mock_retrieve_articles, mock_publish_to_kinesis, jobs_table):
+    """Test that a job invocation delivered again, e.g. retried by
+    Lambda, does not run the job or publish its articles again."""
+    store = DynamoDBJobStore(jobs_table)
+    set_job_store(store)
+    job = new_job(['test'], 'test_stream')
+    store.create(job)
+    event = {JOB_EVENT_KEY: job['job_id'], 'request': _event()}
+
+    assert lambda_handler(event, {})['status'] == 'succeeded'
+    assert lambda_handler(event, {}) == {
+        'job_id': job['job_id'], 'status': 'succeeded'}
+
+    mock_retrieve_articles.assert_called_once()
+    mock_publish_to_kinesis.assert_called_once()
+
+
+def test_job_stores_claim_a_job_once(jobs_table):
+    """Test that only the first claim of a pending job succeeds, and
+    that a job the store does not know is claimed."""
+    for store in (MemoryJobStore(), DynamoDBJobStore(jobs_table)):
+        job = new_job(['test'], 'test_stream')
+        store.create(job)
+
+        assert store.claim(job['job_id'])
+        assert not store.claim(job['job_id'])
+        assert store.get(job['job_id'])['status'] == 'running'
+        assert store.claim('unknown')
+        assert not store.claim('unknown')
+
+
+def test_status_lookup_of_unknown_job():
+    """Test that looking up an unknown job returns 404."""
+    response = lambda_handler(
+        {'queryStringParameters': {'job_id': 'unknown'}}, {})
+
+    assert response['statusCode'] == 404
+
+
+@patch('src.lambda_handler.publish_to_kinesis')
+@patch('src.lambda_handler.retrieve_articles')
+def test_job_with_many_articles_fits_in_dynamodb(
+        mock_retrieve_articles, mock_publish_to_kinesis, jobs_table):
+    """Test that a job publishing more articles than fit in one DynamoDB
+    item only stores their count, and succeeds."""
+    articles = [{'webUrl': f'url_{i}', 'webTitle': 'title',
+                 'contentPreview': 'x' * 1000} for i in range(500)]
+    mock_retrieve_articles.return_value = articles
+    mock_publish_to_kinesis.return_value = ('Published 500', articles)
+    store = DynamoDBJobStore(jobs_table)
+    set_job_store(store)
+    job = new_job(['test'], 'test_stream')
+    store.create(job)
+
+    result = lambda_handler(
+        {JOB_EVENT_KEY: job['job_id'], 'request': _event()}, {})
+
+    assert result['status'] == 'succeeded'
+    assert store.get(job['job_id'])['articles_published_count'] == 500
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published 0', []))
+@patch('src.lambda_handler.retrieve_articles', return_value=[])
+def test_job_outcome_that_cannot_be_recorded_is_not_raised(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """Test that failing to record a finished job does not raise, so
+    that Lambda does not retry the invocation and publish again."""
+    store = MemoryJobStore()
+    job = new_job(['test'], 'test_stream')
+    store.create(job)
+    set_job_store(store)
+    update = store.update
+
+    def fail_on_outcome(job_id, **fields):
+        if 'status' in fields and fields['status'] != 'running':
+            raise Exception('Item size has exceeded the maximum')
+        update(job_id, **fields)
+    store.update = fail_on_outcome
+
+    result = lambda_handler(
+        {JOB_EVENT_KEY: job['job_id'], 'request': _event()}, {})
+
+    assert result['status'] == 'succeeded'
+    mock_publish_to_kinesis.assert_called_once()
@@ -0,0 +1,26 @@
+from src.json_store import MemoryKeyedStore, JsonFileStore
+import json
+
+
+def test_keyed_stores_round_trip_values(tmp_path):
+    """Test that both stores return the last value set for a key,
+    and None for unknown keys."""
+    path = str(tmp_path / 'store.json')
+    for store in (MemoryKeyedStore(), JsonFileStore(path)):
+        store.set('a', {'date': '2024-05-01', 'urls': ['url']})
+        store.set('a', {'date': '2024-05-02', 'urls': []})
+
+        assert store.get('a') == {'date': '2024-05-02', 'urls': []}
+        assert store.get('b') is None
+
+
+def test_json_file_store_persists_values(tmp_path):
+    """Test that values are kept in the file, readable by a new store,
+    without a temporary file left behind."""
+    path = tmp_path / 'store.json'
+    JsonFileStore(str(path)).set('Émile', 'value')
+
+    assert JsonFileStore(str(path)).get('Émile') == 'value'
+    assert json.loads(path.read_text(encoding='utf-8')) == {
+        'Émile': 'value'}
+    assert [f.name for f in tmp_path.iterdir()] == ['store.json']
@@ -0,0 +1,193 @@
+import pytest
+from src.kinesis_consumer import (
+    KinesisConsumer, MemoryCheckpointStore, FileCheckpointStore,
+    decode_records)
+from src.publish_to_kinesis import publish_to_kinesis
+from src.clients import set_boto3_client
+from src.kpl_aggregation import KPL_MAGIC
+import boto3
+from botocore.exceptions import ClientError
+from unittest.mock import patch
+import threading
+import time
+
+
+def _articles(count, prefix='article'):
+    return [{
+        'webPublicationDate': f'2024-05-01T12:00:{i:02d}Z',
+        'webTitle': f'{prefix} {i}',
+        'webUrl': f'http://example.com/{prefix}/{i}',
+        'contentPreview': f'Preview of {prefix} {i}',
+    } for i in range(count)]
+
+
+def _consumer(**kwargs):
+    return KinesisConsumer('test_stream', stop_at_latest=True,
+                           poll_interval=0.01, **kwargs)
+
+
+@pytest.mark.parametrize('encoding,aggregate', [
+    ('json', False), ('compact_json', False), ('gzip_json', True)])
+def test_consumer_reads_every_shard(aws_kinesis_four_shards, encoding,
+                                    aggregate):
+    """Test that the articles published across all shards are read back,
+    whatever their encoding and whether they were aggregated."""
+    articles = _articles(20)
+    publish_to_kinesis('test_stream', 'test', articles,
+                       partition_strategy='url_hash', encoding=encoding,
+                       aggregate=aggregate)
+
+    batches = list(_consumer().iter_batches())
+
+    assert len({batch.shard_id for batch in batches}) > 1
+    read = [article for batch in batches for article in batch.articles]
+    assert sorted(read, key=lambda a: a['webUrl']) == sorted(
+        articles, key=lambda a: a['webUrl'])
+    assert all(batch.lag_seconds >= 0 for batch in batches)
+
+
+def test_consumer_keeps_shard_order(aws_kinesis_four_shards):
+    """Test that the articles of one shard are read in publish order."""
+    articles = _articles(10)
+    publish_to_kinesis('test_stream', 'test', articles, batched=True)
+
+    assert list(_consumer().iter_articles()) == articles
+
+
+def test_consumer_reads_parent_shard_before_children(aws_kinesis_four_shards):
+    """Test that after a shard is split, the records of the parent
+    are read before those of its children."""
+    aws_kinesis_four_shards.create_stream(
+        StreamName='split_stream', ShardCount=1)
+    publish_to_kinesis('split_stream', 'test', _articles(3, 'before'))
+    aws_kinesis_four_shards.split_shard(
+        StreamName='split_stream', ShardToSplit='shardId-000000000000',
+        NewStartingHashKey=str(2 ** 127))
+    publish_to_kinesis('split_stream', 'test', _articles(3, 'after'))
+
+    read = list(KinesisConsumer(
+        'split_stream', stop_at_latest=True,
+        poll_interval=0.01).iter_articles())
+
+    assert read == _articles(3, 'before') + _articles(3, 'after')
+
+
+def test_consumer_resumes_after_checkpoint(aws_kinesis_four_shards):
+    """Test that a new consumer sharing the checkpoint store only
+    reads the records published after the last processed batch."""
+    store = MemoryCheckpointStore()
+    publish_to_kinesis('test_stream', 'test', _articles(3, 'first'))
+    assert len(list(_consumer(checkpoint_store=store).iter_articles())) == 3
+
+    later = _articles(2, 'second')
+    publish_to_kinesis('test_stream', 'test', later)
+
+    assert list(_consumer(checkpoint_store=store).iter_articles()) == later
+
+
+def test_consumer_does_not_checkpoint_unprocessed_batch(
+        aws_kinesis_four_shards):
+    """Test that a batch is not checkpointed if the caller stops
+    before asking for the next one, so it is read again."""
+    store = MemoryCheckpointStore()
+    publish_to_kinesis('test_stream', 'test', _articles(3), batched=True)
+
+    for batch in _consumer(checkpoint_store=store).iter_batches():
+        break
+
+    assert store.get('test_stream', batch.shard_id) is None
+    assert len(list(_consumer(checkpoint_store=store).iter_articles())) == 3
+
+
+def test_stop_ends_iteration(aws_kinesis_four_shards):
+    """Test that stop called from another thread ends the iteration
+    of a consumer that would otherwise read until stopped."""
+    publish_to_kinesis('test_stream', 'test', _articles(3))
+    consumer = KinesisConsumer('test_stream', poll_interval=0.01)
+    read = []
+    reader = threading.Thread(
+        target=lambda: read.extend(consumer.iter_articles()), daemon=True)
+    reader.start()
+    deadline = time.monotonic() + 2
+    while len(read) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    consumer.stop()
+    reader.join(2)
+
+    assert not reader.is_alive()
+    assert len(read) == 3
+
+
+def test_latest_iterator_skips_existing_records(aws_kinesis_four_shards):
+    """Test that shards without a checkpoint can start at the tip."""
+    publish_to_kinesis('test_stream', 'test', _articles(3))
+
+    assert list(_consumer(iterator_type='LATEST').iter_articles()) == []
+
+
+def test_file_checkpoint_store_round_trips(tmp_path):
+    """Test that checkpoints are kept per stream and shard in a file."""
+    path = str(tmp_path / 'checkpoints.json')
+    FileCheckpointStore(path).set('stream', 'shard-1', '42')
+
+    store = FileCheckpointStore(path)
+    assert store.get('stream', 'shard-1') == '42'
+    assert store.get('stream', 'shard-2') is None
+
+
+def test_decode_records_skips_corrupt_records():
+    """Test that records that cannot be decoded are skipped."""
+    article = _articles(1)[0]
+    records = [
+        {'Data': b'\xa7\x09garbage', 'PartitionKey': 'a'},
+        {'Data': KPL_MAGIC + b'\x00' * 20, 'PartitionKey': 'a'},
+        {'Data': b'{"webTitle": "%s"}' % article['webTitle'].encode(),
+         'PartitionKey': 'a'},
+    ]
+
+    assert decode_records(records) == [{'webTitle': article['webTitle']}]
+
+
+@patch('src.kinesis_consumer.THROTTLE_BACKOFF_SECONDS', 0.01)
+def test_consumer_retries_throttled_reads(aws_kinesis_four_shards):
+    """Test that a throttled GetRecords call is retried."""
+    publish_to_kinesis('test_stream', 'test', _articles(2))
+    client = boto3.client('kinesis', region_name='eu-west-2')
+    get_records = client.get_records
+    throttled = []
+
+    def throttle_once(**kwargs):
+        if not throttled:
+            throttled.append(True)
+            raise ClientError(
+                {'Error': {'Code': 'ProvisionedThroughputExceededException',
+                           'Message': 'Rate exceeded'}}, 'GetRecords')
+        return get_records(**kwargs)
+
+    client.get_records = throttle_once
+    set_boto3_client('kinesis', client)
+
+    assert len(list(_consumer().iter_articles())) == 2
+    assert throttled
+
+
+def test_consumer_raises_worker_errors(aws_kinesis_four_shards):
+    """Test that an error that stops a worker is raised to the caller."""
+    client = boto3.client('kinesis', region_name='eu-west-2')
+
+    def fail(**kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDeniedException',
+                                     'Message': 'denied'}}, 'GetRecords')
+
+    client.get_records = fail
+    set_boto3_client('kinesis', client)
+
+    with pytest.raises(ClientError):
+        list(_consumer().iter_articles())
+
+
+def test_consumer_rejects_unknown_iterator_type():
+    """Test that only supported iterator types are accepted."""
+    with pytest.raises(ValueError):
+        KinesisConsumer('test_stream', iterator_type='AT_TIMESTAMP')
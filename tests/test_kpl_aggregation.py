@@ -0,0 +1,76 @@
+import pytest
+from src.kpl_aggregation import (
+    RecordAggregator, deaggregate, is_aggregated,
+    DeaggregationError, KPL_MAGIC)
+import hashlib
+
+
+def test_aggregated_record_round_trips():
+    """Test that user records are deaggregated back with their
+    partition keys, explicit hash keys and data, in order."""
+    aggregator = RecordAggregator()
+    assert aggregator.add('term-a', None, b'first')
+    assert aggregator.add('term-b', '1234', b'second')
+    assert aggregator.add('term-a', None, b'\x00' * 300)
+
+    data = aggregator.serialize()
+
+    assert is_aggregated(data)
+    assert deaggregate({'Data': data, 'PartitionKey': 'term-a'}) == [
+        {'Data': b'first', 'PartitionKey': 'term-a'},
+        {'Data': b'second', 'PartitionKey': 'term-b',
+         'ExplicitHashKey': '1234'},
+        {'Data': b'\x00' * 300, 'PartitionKey': 'term-a'},
+    ]
+
+
+def test_aggregated_record_matches_kpl_format():
+    """Test the magic bytes, protobuf body and MD5 checksum
+    of an aggregated record."""
+    aggregator = RecordAggregator()
+    aggregator.add('pk', None, b'hi')
+
+    data = aggregator.serialize()
+
+    body = b'\x0a\x02pk' + b'\x1a\x06' + b'\x08\x00\x1a\x02hi'
+    assert data == KPL_MAGIC + body + hashlib.md5(body).digest()
+
+
+def test_aggregator_respects_max_bytes():
+    """Test that a record is refused once the aggregated
+    record would exceed max_bytes, and that the size is exact."""
+    aggregator = RecordAggregator(max_bytes=1000)
+    added = 0
+    while aggregator.add('term', None, b'x' * 90):
+        added += 1
+
+    assert added == len(aggregator) > 1
+    assert len(aggregator.serialize()) <= 1000
+    assert len(aggregator.serialize()) + 94 > 1000
+
+
+def test_aggregator_always_accepts_first_record():
+    """Test that a record larger than max_bytes
+    still gets an aggregated record of its own."""
+    aggregator = RecordAggregator(max_bytes=10)
+
+    assert aggregator.add('term', None, b'x' * 100)
+    assert not aggregator.add('term', None, b'x')
+
+
+def test_deaggregate_passes_through_plain_records():
+    """Test that records that are not aggregated are returned as is."""
+    record = {'Data': b'{"webTitle": "title"}', 'PartitionKey': 'term'}
+
+    assert deaggregate(record) == [record]
+
+
+def test_deaggregate_rejects_bad_checksum():
+    """Test that a corrupted aggregated record is rejected."""
+    aggregator = RecordAggregator()
+    aggregator.add('term', None, b'data')
+    data = bytearray(aggregator.serialize())
+    data[-1] ^= 0xFF
+
+    with pytest.raises(DeaggregationError):
+        deaggregate({'Data': bytes(data), 'PartitionKey': 'term'})
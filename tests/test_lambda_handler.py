@@ -1,17 +1,9 @@
 from src.lambda_handler import lambda_handler
-import pytest
-from moto import mock_kinesis
-import boto3
-from unittest.mock import patch
-
-
-@pytest.fixture(scope="function")
-def aws_kinesis():
-    """Mock AWS Kinesis client with a created stream for testing."""
-    with mock_kinesis():
-        client = boto3.client("kinesis", region_name='eu-west-2')
-        client.create_stream(StreamName="test_stream", ShardCount=1)
-        yield client
+from src.watermarks import get_watermark_store
+from unittest.mock import patch, Mock
+import json
+import threading
+import time
 
 
 @patch('src.lambda_handler.retrieve_articles')
@@ -75,3 +67,343 @@ def test_lambda_handler_missing_kinesis_stream():
     response = lambda_handler(event, context)
     assert response['statusCode'] == 500
     assert 'error' in response['body']
+
+
+@patch('src.lambda_handler.iter_articles')
+def test_lambda_handler_pipeline_mode(mock_iter_articles, aws_kinesis):
+    """
+    Test Lambda handler streaming articles to Kinesis in pipeline mode.
+    """
+    article = {
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": "Sample Article 1",
+        "webUrl": "http://example.com/article1",
+        "contentPreview": "This is a preview of article 1."
+    }
+    mock_iter_articles.return_value = iter([article])
+
+    event = {
+        'queryStringParameters': {
+            'search_term': 'test_search',
+            'kinesis_stream': 'test_stream',
+            'pipeline': 'true',
+        }
+    }
+    response = lambda_handler(event, {})
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['articles_published'] == [article]
+
+
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_dedupe_skips_published_articles(
+        mock_retrieve_articles, aws_kinesis):
+    """
+    Test that with dedupe enabled, a second request for the same
+    articles does not publish them again.
+    """
+    article = {
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": "Sample Article 1",
+        "webUrl": "http://example.com/article1",
+        "contentPreview": "This is a preview of article 1."
+    }
+    mock_retrieve_articles.return_value = [article]
+    event = {
+        'queryStringParameters': {
+            'search_term': 'test_search',
+            'kinesis_stream': 'test_stream',
+            'dedupe': 'true',
+        }
+    }
+
+    first = json.loads(lambda_handler(event, {})['body'])
+    second = json.loads(lambda_handler(event, {})['body'])
+
+    assert first['articles_published'] == [article]
+    assert second['articles_published'] == []
+    assert mock_retrieve_articles.call_args.kwargs['seen_index'] is not None
+
+
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_incremental_polls_from_watermark(
+        mock_retrieve_articles, aws_kinesis):
+    """
+    Test that incremental mode first queries newest-first, then
+    oldest-first from the watermark left by the previous publish.
+    """
+    article = {
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": "Sample Article 1",
+        "webUrl": "http://example.com/article1",
+        "contentPreview": "This is a preview of article 1."
+    }
+    mock_retrieve_articles.return_value = [article]
+    event = {
+        'queryStringParameters': {
+            'search_term': 'test_search',
+            'kinesis_stream': 'test_stream',
+            'incremental': 'true',
+        }
+    }
+
+    lambda_handler(event, {})
+    first_kwargs = mock_retrieve_articles.call_args.kwargs
+    mock_retrieve_articles.return_value = []
+    lambda_handler(event, {})
+    second_kwargs = mock_retrieve_articles.call_args.kwargs
+
+    assert first_kwargs['order_by'] == 'newest'
+    assert first_kwargs['watermark'] is None
+    assert second_kwargs['from_date'] == '2024-05-01'
+    assert second_kwargs['order_by'] == 'oldest'
+    assert second_kwargs['watermark'] == {
+        'date': '2024-05-01T12:00:00Z',
+        'urls': ['http://example.com/article1']}
+
+
+@patch('src.lambda_handler.publish_to_kinesis')
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_incremental_keeps_watermark_on_failure(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """
+    Test that the watermark does not advance when publishing fails.
+    """
+    mock_retrieve_articles.return_value = [{
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": "Sample Article 1",
+        "webUrl": "http://example.com/article1",
+        "contentPreview": "This is a preview of article 1."
+    }]
+    mock_publish_to_kinesis.side_effect = Exception('Kinesis unavailable')
+    event = {
+        'queryStringParameters': {
+            'search_term': 'test_search',
+            'kinesis_stream': 'test_stream',
+            'incremental': 'true',
+        }
+    }
+
+    assert lambda_handler(event, {})['statusCode'] == 500
+    assert get_watermark_store().get('test_search') is None
+
+
+def _guardian_search(articles):
+    """Stand-in Guardian search honouring from-date and order-by."""
+    def search(url, params, **kwargs):
+        hits = sorted(
+            (article for article in articles
+             if not params['from-date']
+             or params['from-date'] <= article['webPublicationDate']),
+            key=lambda article: article['webPublicationDate'],
+            reverse=params['order-by'] == 'newest')
+        size = params['page-size']
+        start = (params['page'] - 1) * size
+        response = Mock()
+        response.status_code = 200
+        response.url = 'http://example.com'
+        response.json.return_value = {'response': {
+            'pages': max(1, -(-len(hits) // size)),
+            'results': hits[start:start + size]}}
+        return response
+    return search
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       side_effect=lambda stream, term, articles, **kwargs: (
+           'Published', articles))
+@patch('src.retrieve_articles.fetch_content_preview', return_value='preview')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_lambda_handler_incremental_catches_up_over_polls(
+        mock_get, mock_get_api_key, mock_fetch_content_preview,
+        mock_publish_to_kinesis):
+    """
+    Test that when more articles than max_results are published between
+    polls, each poll retrieves the oldest ones after the watermark, so
+    none are skipped.
+    """
+    articles = [{
+        'webPublicationDate': f'2024-05-02T12:{i:02d}:00Z',
+        'webTitle': f'title {i}',
+        'webUrl': f'http://example.com/u{i}',
+    } for i in range(1, 21)]
+    get_watermark_store().set('test_search', {
+        'date': '2024-05-01T12:00:00Z', 'urls': ['http://example.com/u0']})
+    mock_get.side_effect = _guardian_search(articles)
+    event = {
+        'queryStringParameters': {
+            'search_term': 'test_search',
+            'kinesis_stream': 'test_stream',
+            'incremental': 'true',
+            'max_results': '10',
+        }
+    }
+
+    polls = [json.loads(lambda_handler(event, {})['body'])
+             for _ in range(3)]
+
+    urls = [[article['webUrl'] for article in poll['articles_published']]
+            for poll in polls]
+    assert urls == [
+        [article['webUrl'] for article in articles[:10]],
+        [article['webUrl'] for article in articles[10:]],
+        []]
+    assert get_watermark_store().get('test_search') == {
+        'date': articles[-1]['webPublicationDate'],
+        'urls': [articles[-1]['webUrl']]}
+
+
+def _term_article(term):
+    return {
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": f"{term} article",
+        "webUrl": f"http://example.com/{term}",
+        "contentPreview": f"This is a preview of the {term} article."
+    }
+
+
+@patch('src.lambda_handler.get_api_key', return_value='test_api_key')
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_multiple_search_terms(
+        mock_retrieve_articles, mock_get_api_key, aws_kinesis):
+    """
+    Test that several search terms are retrieved and published together,
+    with one result per term and a failing term reported on its own.
+    """
+    def fake_retrieve(search_term, **kwargs):
+        if search_term == 'broken':
+            raise Exception('Guardian API error')
+        return [_term_article(search_term)]
+
+    mock_retrieve_articles.side_effect = fake_retrieve
+    event = {
+        'queryStringParameters': {
+            'search_term': 'python',
+            'kinesis_stream': 'test_stream',
+        },
+        'multiValueQueryStringParameters': {
+            'search_term': ['python', 'broken', 'rust'],
+        }
+    }
+
+    response = lambda_handler(event, {})
+    results = json.loads(response['body'])['results']
+
+    assert response['statusCode'] == 200
+    assert [result['search_term'] for result in results] == [
+        'python', 'broken', 'rust']
+    assert results[0]['articles_published'] == [_term_article('python')]
+    assert results[1]['error'] == 'Guardian API error'
+    assert results[2]['articles_published'] == [_term_article('rust')]
+    mock_get_api_key.assert_called_once()
+
+    shard_iterator = aws_kinesis.get_shard_iterator(
+        StreamName='test_stream',
+        ShardId='shardId-000000000000',
+        ShardIteratorType='TRIM_HORIZON'
+    )['ShardIterator']
+    records = aws_kinesis.get_records(ShardIterator=shard_iterator)['Records']
+    assert [record['PartitionKey'] for record in records] == [
+        'python', 'rust']
+
+
+@patch('src.lambda_handler.get_api_key', return_value='test_api_key')
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_slow_search_term_times_out(
+        mock_retrieve_articles, mock_get_api_key, aws_kinesis):
+    """
+    Test that a search term slower than term_timeout is reported
+    as timed out while the other terms are published.
+    """
+    release = threading.Event()
+
+    def fake_retrieve(search_term, **kwargs):
+        if search_term == 'slow':
+            release.wait(timeout=5)
+        return [_term_article(search_term)]
+
+    mock_retrieve_articles.side_effect = fake_retrieve
+    event = {
+        'queryStringParameters': {
+            'search_terms': 'fast,slow',
+            'kinesis_stream': 'test_stream',
+            'term_timeout': '0.2',
+        }
+    }
+
+    try:
+        results = json.loads(lambda_handler(event, {})['body'])['results']
+    finally:
+        release.set()
+
+    assert results[0]['articles_published'] == [_term_article('fast')]
+    assert 'Timed out' in results[1]['error']
+
+
+@patch('src.lambda_handler.get_api_key', return_value='test_api_key')
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_term_timeout_starts_with_each_term(
+        mock_retrieve_articles, mock_get_api_key, aws_kinesis):
+    """
+    Test that term_timeout is counted from when each term starts,
+    so terms queued behind others for a worker do not time out.
+    """
+    def fake_retrieve(search_term, deadline=None, **kwargs):
+        time.sleep(0.6)
+        assert not deadline.expired()
+        return [_term_article(search_term)]
+
+    mock_retrieve_articles.side_effect = fake_retrieve
+    event = {
+        'queryStringParameters': {
+            'search_terms': 'a,b,c',
+            'kinesis_stream': 'test_stream',
+            'max_concurrent_terms': '1',
+            'term_timeout': '1',
+        }
+    }
+
+    results = json.loads(lambda_handler(event, {})['body'])['results']
+
+    assert [result.get('articles_published') for result in results] == [
+        [_term_article(term)] for term in ('a', 'b', 'c')]
+
+
+@patch('src.lambda_handler.get_api_key', return_value='test_api_key')
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_timed_out_term_is_not_published(
+        mock_retrieve_articles, mock_get_api_key, aws_kinesis):
+    """
+    Test that a timed out term is given its own expired deadline and
+    that the articles it returns afterwards are not published.
+    """
+    finished = threading.Event()
+
+    def fake_retrieve(search_term, deadline=None, **kwargs):
+        if search_term == 'slow':
+            while not deadline.expired():
+                time.sleep(0.01)
+            time.sleep(0.2)
+            finished.set()
+        return [_term_article(search_term)]
+
+    mock_retrieve_articles.side_effect = fake_retrieve
+    event = {
+        'queryStringParameters': {
+            'search_terms': 'fast,slow',
+            'kinesis_stream': 'test_stream',
+            'term_timeout': '0.2',
+        }
+    }
+
+    results = json.loads(lambda_handler(event, {})['body'])['results']
+    assert finished.wait(timeout=5)
+
+    assert results[1]['error'] == 'Timed out after 0.2 seconds'
+    shard_iterator = aws_kinesis.get_shard_iterator(
+        StreamName='test_stream',
+        ShardId='shardId-000000000000',
+        ShardIteratorType='TRIM_HORIZON'
+    )['ShardIterator']
+    records = aws_kinesis.get_records(ShardIterator=shard_iterator)['Records']
+    assert [record['PartitionKey'] for record in records] == ['fast']
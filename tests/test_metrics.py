@@ -0,0 +1,135 @@
+import pytest
+from src.metrics import (
+    MetricsRecorder, get_metrics_recorder, set_metrics_recorder,
+    timer, timed, increment, flush_metrics, MAX_VALUES_PER_METRIC)
+from src.lambda_handler import lambda_handler
+from src.fetch_article_content import fetch_content_preview
+from unittest.mock import patch
+import io
+import requests_mock
+import json
+
+
+def _documents(output):
+    return [json.loads(line) for line in output.splitlines() if line]
+
+
+def test_recorder_writes_emf_document():
+    """Test that timings and counters are written as one
+    Embedded Metric Format document with their units."""
+    stream = io.StringIO()
+    recorder = MetricsRecorder(
+        'TestNamespace', {'FunctionName': 'test'}, stream=stream)
+    with recorder.timer('search'):
+        pass
+    recorder.add_value('search.duration', 5.0)
+    recorder.increment('preview_cache.hits')
+    recorder.increment('preview_cache.hits', 2)
+    recorder.increment('fetch_content_preview.bytes', 100, 'Bytes')
+
+    recorder.flush()
+
+    [document] = _documents(stream.getvalue())
+    directive = document['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'TestNamespace'
+    assert directive['Dimensions'] == [['FunctionName']]
+    assert {m['Name']: m['Unit'] for m in directive['Metrics']} == {
+        'search.duration': 'Milliseconds',
+        'preview_cache.hits': 'Count',
+        'fetch_content_preview.bytes': 'Bytes',
+    }
+    assert document['FunctionName'] == 'test'
+    assert len(document['search.duration']) == 2
+    assert document['search.duration'][1] == 5.0
+    assert document['preview_cache.hits'] == 3
+    assert document['fetch_content_preview.bytes'] == 100
+
+
+def test_recorder_splits_values_over_documents():
+    """Test that metrics with more values than EMF allows
+    are spread over several documents, and flushing resets them."""
+    stream = io.StringIO()
+    recorder = MetricsRecorder(stream=stream)
+    for value in range(MAX_VALUES_PER_METRIC + 5):
+        recorder.add_value('fetch_content_preview.duration', value)
+
+    recorder.flush()
+    recorder.flush()
+
+    documents = _documents(stream.getvalue())
+    assert [len(d['fetch_content_preview.duration'])
+            for d in documents] == [MAX_VALUES_PER_METRIC, 5]
+
+
+def test_metrics_disabled_by_default(capsys):
+    """Test that nothing is recorded or written unless enabled."""
+    assert get_metrics_recorder() is None
+
+    with timer('search'):
+        pass
+    increment('kinesis.records_put')
+    flush_metrics()
+
+    assert capsys.readouterr().out == ''
+
+
+def test_timed_records_failed_calls():
+    """Test that the timed decorator records calls that raise."""
+    stream = io.StringIO()
+    set_metrics_recorder(MetricsRecorder(stream=stream))
+
+    @timed('stage')
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        fail()
+    flush_metrics()
+
+    [document] = _documents(stream.getvalue())
+    assert 'stage.duration' in document
+
+
+def test_fetch_content_preview_counts_bytes_and_cache_hits():
+    """Test that fetching a page records the bytes read, and that
+    the preview cache records its misses and hits."""
+    stream = io.StringIO()
+    set_metrics_recorder(MetricsRecorder(stream=stream))
+    page = "<html><body><p>Guardian article content</p></body></html>"
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get("http://testexample.com/page", text=page)
+        fetch_content_preview("http://testexample.com/page")
+        fetch_content_preview("http://testexample.com/page")
+    flush_metrics()
+
+    [document] = _documents(stream.getvalue())
+    assert document['fetch_content_preview.bytes'] == len(page)
+    assert document['preview_cache.misses'] == 1
+    assert document['preview_cache.hits'] == 1
+    assert len(document['fetch_content_preview.duration']) == 2
+
+
+@patch('src.lambda_handler.retrieve_articles')
+def test_lambda_handler_emits_stage_metrics(
+        mock_retrieve_articles, aws_kinesis, monkeypatch, capsys):
+    """Test that an invocation with METRICS_ENABLED writes the
+    durations of its stages and the records put to the log."""
+    monkeypatch.setenv('METRICS_ENABLED', 'true')
+    mock_retrieve_articles.return_value = [{
+        "webPublicationDate": "2024-05-01T12:00:00Z",
+        "webTitle": "Sample Article 1",
+        "webUrl": "http://example.com/article1",
+        "contentPreview": "This is a preview of article 1."
+    }]
+    event = {'queryStringParameters': {
+        'search_term': 'test_search', 'kinesis_stream': 'test_stream'}}
+
+    response = lambda_handler(event, {})
+
+    assert response['statusCode'] == 200
+    [document] = [d for d in _documents(capsys.readouterr().out)
+                  if '_aws' in d]
+    assert document['kinesis.records_put'] == 1
+    assert document['lambda_handler.duration'] > 0
+    assert document['publish_to_kinesis.duration'] > 0
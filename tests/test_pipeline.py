@@ -0,0 +1,113 @@
+import pytest
+from src.pipeline import stream_to_kinesis
+from src.publish_to_kinesis import publish_to_kinesis
+from src.seen_index import SeenIndex
+from unittest.mock import patch
+import json
+import time
+
+articles = [
+    {
+        "webPublicationDate": f"2024-05-0{i}T12:00:00Z",
+        "webTitle": f"Sample Article {i}",
+        "webUrl": f"http://example.com/article{i}",
+        "contentPreview": f"This is a preview of article {i}."
+    }
+    for i in range(1, 6)
+]
+
+
+def test_stream_to_kinesis_publishes_all_articles(aws_kinesis):
+    """Test that every article from the generator is published
+    in order, in micro-batches of at most batch_size."""
+    with patch('src.pipeline.publish_to_kinesis',
+               wraps=publish_to_kinesis) as mock_publish:
+        output, published = stream_to_kinesis(
+            iter(articles), "test_stream", "test-search", batch_size=2)
+
+    assert output == (
+        "Successfully added all 5 records to Kinesis stream: test_stream")
+    assert published == articles
+    assert [len(call.args[2]) for call in mock_publish.call_args_list] == [
+        2, 2, 1]
+
+    shard_iterator = aws_kinesis.get_shard_iterator(
+        StreamName="test_stream",
+        ShardId='shardId-000000000000',
+        ShardIteratorType='TRIM_HORIZON'
+    )['ShardIterator']
+    records = aws_kinesis.get_records(ShardIterator=shard_iterator)['Records']
+    assert [json.loads(record['Data']) for record in records] == articles
+
+
+@patch('src.pipeline.publish_to_kinesis')
+def test_stream_to_kinesis_flushes_on_interval(mock_publish):
+    """Test that a partial batch is published once flush_interval
+    has passed, while later articles are still being retrieved."""
+    mock_publish.side_effect = lambda stream, key, batch, **kwargs: (
+        'ok', list(batch))
+    flushed_before_second = []
+
+    def slow_articles():
+        yield articles[0]
+        time.sleep(0.2)
+        flushed_before_second.append(mock_publish.call_count)
+        yield articles[1]
+
+    output, published = stream_to_kinesis(
+        slow_articles(), "test_stream", "test-search",
+        batch_size=10, flush_interval=0.05)
+
+    assert flushed_before_second == [1]
+    assert published == articles[:2]
+    assert mock_publish.call_count == 2
+
+
+@patch('src.pipeline.publish_to_kinesis')
+def test_stream_to_kinesis_reports_partial_publishing(mock_publish):
+    """Test that the result message counts articles across batches."""
+    mock_publish.side_effect = lambda stream, key, batch, **kwargs: (
+        'partial', list(batch[:1]))
+
+    output, published = stream_to_kinesis(
+        iter(articles), "test_stream", "test-search", batch_size=2)
+
+    assert published == [articles[0], articles[2], articles[4]]
+    assert output == (
+        "Only added 3 out of 5 records to Kinesis stream: test_stream")
+
+
+@patch('src.pipeline.publish_to_kinesis')
+def test_stream_to_kinesis_raises_retrieval_errors(mock_publish):
+    """Test that an error while retrieving is raised after the
+    articles retrieved before it were published."""
+    mock_publish.side_effect = lambda stream, key, batch, **kwargs: (
+        'ok', list(batch))
+
+    def failing_articles():
+        yield articles[0]
+        raise ValueError('Retrieval failed')
+
+    with pytest.raises(ValueError):
+        stream_to_kinesis(
+            failing_articles(), "test_stream", "test-search", batch_size=10)
+
+    mock_publish.assert_called_once()
+    assert mock_publish.call_args.args[2] == [articles[0]]
+
+
+@patch('src.pipeline.publish_to_kinesis')
+def test_stream_to_kinesis_skips_seen_articles(mock_publish):
+    """Test that articles in the seen index are not published
+    and that published articles are added to it."""
+    mock_publish.side_effect = lambda stream, key, batch, **kwargs: (
+        'ok', list(batch))
+    seen_index = SeenIndex()
+    seen_index.mark([articles[0]])
+
+    output, published = stream_to_kinesis(
+        iter(articles + [articles[1]]), "test_stream", "test-search",
+        seen_index=seen_index)
+
+    assert published == articles[1:]
+    assert all(seen_index.seen(article) for article in articles)
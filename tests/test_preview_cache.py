@@ -0,0 +1,121 @@
+from src.preview_cache import PreviewCache
+from unittest.mock import patch
+
+
+def test_preview_cache_returns_stored_entry():
+    """Test that a stored preview is returned with its validators."""
+    cache = PreviewCache()
+    cache.put('http://a', 'preview a', etag='"abc"',
+              last_modified='Wed, 01 May 2024 12:00:00 GMT')
+
+    entry = cache.get('http://a')
+    assert entry['preview'] == 'preview a'
+    assert entry['etag'] == '"abc"'
+    assert entry['last_modified'] == 'Wed, 01 May 2024 12:00:00 GMT'
+    assert cache.get('http://b') is None
+
+
+def test_preview_cache_evicts_least_recently_used_by_size():
+    """Test that entries are evicted in LRU order
+    once the total size exceeds max_bytes."""
+    cache = PreviewCache(max_bytes=30)
+    cache.put('a', 'x' * 9)
+    cache.put('b', 'x' * 9)
+    cache.put('c', 'x' * 9)
+    cache.get('a')
+    cache.put('d', 'x' * 9)
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+    assert cache.get('d') is not None
+
+
+def test_preview_cache_entries_expire_after_fresh_ttl():
+    """Test that entries are only fresh within fresh_ttl."""
+    cache = PreviewCache(fresh_ttl=10)
+    with patch('src.preview_cache.time.time', return_value=100):
+        cache.put('a', 'preview')
+    entry = cache.get('a')
+    with patch('src.preview_cache.time.time', return_value=105):
+        assert cache.is_fresh(entry)
+    with patch('src.preview_cache.time.time', return_value=111):
+        assert not cache.is_fresh(entry)
+
+
+def test_preview_cache_remembers_failures_for_negative_ttl():
+    """Test that failed URLs are remembered until the negative TTL."""
+    cache = PreviewCache(negative_ttl=10)
+    with patch('src.preview_cache.time.time', return_value=100):
+        cache.put_failure('a')
+        assert cache.has_failed('a')
+        assert not cache.has_failed('b')
+    with patch('src.preview_cache.time.time', return_value=111):
+        assert not cache.has_failed('a')
+
+
+def test_put_failure_skips_urls_with_fresh_entries():
+    """Test that a failure is not remembered for a URL that was
+    cached since, so a late failing request cannot hide it."""
+    cache = PreviewCache()
+    cache.put('a', 'preview')
+
+    cache.put_failure('a')
+
+    assert not cache.has_failed('a')
+
+
+def test_preview_cache_disk_tier_survives_new_instance(tmp_path):
+    """Test that entries written to the disk tier
+    are found by a new cache instance."""
+    PreviewCache(disk_dir=str(tmp_path)).put('http://a', 'preview', etag='e')
+
+    entry = PreviewCache(disk_dir=str(tmp_path)).get('http://a')
+    assert entry['preview'] == 'preview'
+    assert entry['etag'] == 'e'
+
+
+def test_preview_cache_disk_tier_is_bounded(tmp_path):
+    """Test that the disk tier removes files once it
+    grows past max_disk_bytes."""
+    cache = PreviewCache(disk_dir=str(tmp_path), max_disk_bytes=300)
+    for i in range(10):
+        cache.put(f'http://{i}', 'x' * 50)
+
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 300
+    assert PreviewCache(disk_dir=str(tmp_path)).get('http://9') is not None
+
+
+def test_preview_cache_disk_tier_evicts_least_recently_used(tmp_path):
+    """Test that the disk tier evicts the least recently used entry
+    rather than the oldest write, and that the order is kept for a
+    new cache instance."""
+    cache = PreviewCache(disk_dir=str(tmp_path), max_disk_bytes=500)
+    for url in ('http://a', 'http://b', 'http://c'):
+        cache.put(url, 'x' * 50)
+    cache.get('http://a')
+
+    cache.put('http://d', 'x' * 50)
+
+    fresh = PreviewCache(disk_dir=str(tmp_path), max_bytes=0,
+                         max_disk_bytes=500)
+    assert fresh.get('http://a') is not None
+    assert fresh.get('http://b') is None
+    fresh.get('http://c')
+    fresh.put('http://e', 'x' * 50)
+    assert PreviewCache(disk_dir=str(tmp_path)).get('http://d') is None
+
+
+def test_preview_cache_disk_writes_do_not_scan_directory(tmp_path):
+    """Test that the disk tier is only listed when the cache is
+    created, not on every write."""
+    cache = PreviewCache(disk_dir=str(tmp_path), max_disk_bytes=300)
+
+    with patch('src.preview_cache.os.scandir') as mock_scandir, \
+            patch('src.preview_cache.os.listdir') as mock_listdir:
+        for i in range(10):
+            cache.put(f'http://{i}', 'x' * 50)
+
+    mock_scandir.assert_not_called()
+    mock_listdir.assert_not_called()
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 300
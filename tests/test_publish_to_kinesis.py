@@ -1,11 +1,12 @@
 import pytest
-from src.publish_to_kinesis import publish_to_kinesis
+from src.publish_to_kinesis import publish_to_kinesis, publish_records
+from src.record_encoding import decode_record
+from src.kpl_aggregation import deaggregate
 from moto import mock_kinesis
 import boto3
 from botocore.exceptions import (
     NoCredentialsError, PartialCredentialsError, ClientError)
-from unittest.mock import patch
-import os
+from unittest.mock import patch, Mock
 import json
 
 articles = [
@@ -24,25 +25,6 @@ articles = [
 ]
 
 
-@pytest.fixture(scope="function")
-def aws_credentials():
-    """Mocked AWS Credentials for moto."""
-    os.environ['AWS_ACCESS_KEY_ID'] = 'test'
-    os.environ['AWS_SECRET_ACCESS_KEY'] = 'test'
-    os.environ['AWS_SECURITY_TOKEN'] = 'test'
-    os.environ['AWS_SESSION_TOKEN'] = 'test'
-    os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
-
-
-@pytest.fixture(scope="function")
-def aws_kinesis(aws_credentials):
-    """Mock AWS Kinesis client with a created stream for testing."""
-    with mock_kinesis():
-        client = boto3.client("kinesis", region_name='eu-west-2')
-        client.create_stream(StreamName="test_stream", ShardCount=1)
-        yield client
-
-
 def test_publish_to_kinesis_adds_all_articles_to_stream(aws_kinesis):
     """
     Test that the publish_to_kinesis function
@@ -113,3 +95,293 @@ def test_publish_to_kinesis_no_credentials_error(mock_boto_client):
     mock_boto_client.side_effect = NoCredentialsError()
     with pytest.raises(NoCredentialsError):
         publish_to_kinesis("test_stream", "test_search", articles)
+
+
+def _read_stream(client, stream_name):
+    shard_iterator = client.get_shard_iterator(
+        StreamName=stream_name,
+        ShardId='shardId-000000000000',
+        ShardIteratorType='TRIM_HORIZON'
+    )['ShardIterator']
+    return client.get_records(ShardIterator=shard_iterator)['Records']
+
+
+def test_publish_to_kinesis_batched_adds_all_articles(aws_kinesis):
+    """Test that batched mode publishes all articles with PutRecords."""
+    stream_name = "test_stream"
+    output, published = publish_to_kinesis(
+        stream_name, "test-search", articles, batched=True)
+
+    assert output == (
+        f"Successfully added all {len(articles)} records "
+        f"to Kinesis stream: {stream_name}"
+    )
+    assert published == articles
+    records = _read_stream(aws_kinesis, stream_name)
+    assert [json.loads(record['Data']) for record in records] == articles
+
+
+def test_publish_to_kinesis_batched_splits_large_batches(aws_kinesis):
+    """Test that batched mode splits the articles into
+    PutRecords calls of at most 500 records."""
+    many_articles = [
+        dict(articles[0], webUrl=f"http://example.com/{i}")
+        for i in range(501)
+    ]
+    with patch.object(
+            aws_kinesis, 'put_records',
+            wraps=aws_kinesis.put_records) as put_records, \
+            patch('boto3.client', return_value=aws_kinesis):
+        output, published = publish_to_kinesis(
+            "test_stream", "test-search", many_articles, batched=True)
+
+    assert [len(call.kwargs['Records'])
+            for call in put_records.call_args_list] == [500, 1]
+    assert published == many_articles
+    assert output.startswith("Successfully added all 501")
+
+
+@patch('src.publish_to_kinesis.time.sleep')
+@patch('boto3.client')
+def test_publish_to_kinesis_batched_retries_only_failed_records(
+        mock_boto_client, mock_sleep):
+    """Test that batched mode resends only the records
+    PutRecords reported as failed."""
+    mock_client = Mock()
+    mock_client.put_records.side_effect = [
+        {'FailedRecordCount': 1, 'Records': [
+            {'ErrorCode': 'ProvisionedThroughputExceededException',
+             'ErrorMessage': 'Rate exceeded'},
+            {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'},
+        ]},
+        {'FailedRecordCount': 0, 'Records': [
+            {'SequenceNumber': '2', 'ShardId': 'shardId-000000000000'},
+        ]},
+    ]
+    mock_boto_client.return_value = mock_client
+
+    output, published = publish_to_kinesis(
+        "test_stream", "test_search", articles, batched=True)
+
+    second_call = mock_client.put_records.call_args_list[1].kwargs
+    assert len(second_call['Records']) == 1
+    assert json.loads(second_call['Records'][0]['Data']) == articles[0]
+    assert mock_sleep.call_count == 1
+    assert published == articles
+    assert output.startswith("Successfully added all 2")
+
+
+@patch('src.publish_to_kinesis.time.sleep')
+@patch('boto3.client')
+def test_publish_to_kinesis_batched_reports_partial_failure(
+        mock_boto_client, mock_sleep):
+    """Test that batched mode reports the records that
+    still failed after all retries."""
+    mock_client = Mock()
+    mock_client.put_records.side_effect = lambda **kwargs: {
+        'FailedRecordCount': 1,
+        'Records': [
+            {'ErrorCode': 'InternalFailure', 'ErrorMessage': 'Failure'}
+            if json.loads(record['Data']) == articles[1]
+            else {'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'}
+            for record in kwargs['Records']
+        ]
+    }
+    mock_boto_client.return_value = mock_client
+
+    output, published = publish_to_kinesis(
+        "test_stream", "test_search", articles, batched=True, max_retries=2)
+
+    assert mock_client.put_records.call_count == 3
+    assert published == [articles[0]]
+    assert output == (
+        "Only added 1 out of 2 records to Kinesis stream: test_stream")
+
+
+def test_publish_records_uses_each_partition_key(aws_kinesis):
+    """Test that publish_records publishes each article
+    with its own partition key."""
+    published = publish_records(
+        "test_stream", [("term-1", articles[0]), ("term-2", articles[1])])
+
+    assert published == [0, 1]
+    records = _read_stream(aws_kinesis, "test_stream")
+    assert [record['PartitionKey'] for record in records] == [
+        "term-1", "term-2"]
+
+
+def _records_per_shard(client, stream_name):
+    counts = {}
+    for shard in client.list_shards(StreamName=stream_name)['Shards']:
+        shard_iterator = client.get_shard_iterator(
+            StreamName=stream_name,
+            ShardId=shard['ShardId'],
+            ShardIteratorType='TRIM_HORIZON'
+        )['ShardIterator']
+        records = client.get_records(ShardIterator=shard_iterator)['Records']
+        counts[shard['ShardId']] = [json.loads(r['Data']) for r in records]
+    return counts
+
+
+many_articles = [
+    dict(articles[0], webUrl=f"http://example.com/article{i}")
+    for i in range(40)
+]
+
+
+@pytest.mark.parametrize('batched', [True, False])
+def test_publish_to_kinesis_term_strategy_uses_one_shard(
+        aws_kinesis_four_shards, batched):
+    """Test that the term strategy keeps all of a term's
+    articles on one shard, in order."""
+    publish_to_kinesis("test_stream", "test-search", many_articles,
+                       batched=batched, partition_strategy='term')
+
+    per_shard = _records_per_shard(aws_kinesis_four_shards, "test_stream")
+    assert sorted(len(records) for records in per_shard.values()) == [
+        0, 0, 0, 40]
+    assert max(per_shard.values(), key=len) == many_articles
+
+
+def test_publish_to_kinesis_round_robin_strategy_balances_shards(
+        aws_kinesis_four_shards):
+    """Test that the round robin strategy spreads
+    articles evenly over the open shards."""
+    publish_to_kinesis("test_stream", "test-search", many_articles,
+                       batched=True, partition_strategy='round_robin')
+
+    per_shard = _records_per_shard(aws_kinesis_four_shards, "test_stream")
+    assert [len(records) for records in per_shard.values()] == [
+        10, 10, 10, 10]
+
+
+@pytest.mark.parametrize('strategy', ['url_hash', 'explicit_hash'])
+def test_publish_to_kinesis_hash_strategies_spread_articles(
+        aws_kinesis_four_shards, strategy):
+    """Test that the hash strategies use every shard and always
+    send the same URL to the same shard."""
+    publish_to_kinesis("test_stream", "test-search", many_articles,
+                       batched=True, partition_strategy=strategy)
+    publish_to_kinesis("test_stream", "test-search", many_articles[:1],
+                       batched=True, partition_strategy=strategy)
+
+    per_shard = _records_per_shard(aws_kinesis_four_shards, "test_stream")
+    assert all(records for records in per_shard.values())
+    assert sum(len(records) for records in per_shard.values()) == 41
+    assert any(records.count(many_articles[0]) == 2
+               for records in per_shard.values())
+
+
+@patch('boto3.client')
+def test_publish_to_kinesis_term_strategy_orders_records(mock_boto_client):
+    """Test that unbatched records of a term are chained
+    with SequenceNumberForOrdering."""
+    mock_client = Mock()
+    mock_client.put_record.side_effect = [
+        {'ResponseMetadata': {'HTTPStatusCode': 200},
+         'SequenceNumber': str(i)}
+        for i in range(len(articles))
+    ]
+    mock_boto_client.return_value = mock_client
+
+    publish_to_kinesis("test_stream", "test_search", articles)
+
+    calls = mock_client.put_record.call_args_list
+    assert 'SequenceNumberForOrdering' not in calls[0].kwargs
+    assert calls[1].kwargs['SequenceNumberForOrdering'] == '0'
+
+
+def test_publish_to_kinesis_invalid_partition_strategy(aws_kinesis):
+    """Test that an unknown partition strategy is rejected."""
+    with pytest.raises(ValueError):
+        publish_to_kinesis("test_stream", "test_search", articles,
+                           partition_strategy='unknown')
+
+
+@pytest.mark.parametrize('batched', [True, False])
+def test_publish_to_kinesis_with_compressed_encoding(aws_kinesis, batched):
+    """Test that records published with a compressed encoding
+    decode back to the articles."""
+    publish_to_kinesis("test_stream", "test-search", articles,
+                       batched=batched, encoding='gzip_json')
+
+    records = _read_stream(aws_kinesis, "test_stream")
+    assert [decode_record(record['Data']) for record in records] == articles
+
+
+def _deaggregated_articles(client, stream_name):
+    per_shard = {}
+    for shard in client.list_shards(StreamName=stream_name)['Shards']:
+        shard_iterator = client.get_shard_iterator(
+            StreamName=stream_name,
+            ShardId=shard['ShardId'],
+            ShardIteratorType='TRIM_HORIZON'
+        )['ShardIterator']
+        records = client.get_records(ShardIterator=shard_iterator)['Records']
+        per_shard[shard['ShardId']] = (
+            len(records),
+            [decode_record(user_record['Data'])
+             for record in records for user_record in deaggregate(record)])
+    return per_shard
+
+
+def test_publish_to_kinesis_aggregate_packs_articles(aws_kinesis_four_shards):
+    """Test that aggregation packs a term's articles into one record
+    that deaggregates back to the articles, in order."""
+    output, published = publish_to_kinesis(
+        "test_stream", "test-search", many_articles,
+        aggregate=True, encoding='compact_json')
+
+    assert published == many_articles
+    assert output == (
+        "Successfully added all 40 records to Kinesis stream: test_stream")
+    per_shard = _deaggregated_articles(aws_kinesis_four_shards, "test_stream")
+    assert [(1, many_articles)] == [
+        value for value in per_shard.values() if value[0]]
+
+
+@pytest.mark.parametrize('strategy', ['url_hash', 'explicit_hash'])
+def test_publish_to_kinesis_aggregate_keeps_shard_placement(
+        aws_kinesis_four_shards, strategy):
+    """Test that aggregated articles land on the same shards
+    as when they are published one record each."""
+    publish_to_kinesis("test_stream", "test-search", many_articles,
+                       batched=True, partition_strategy=strategy)
+    expected = _records_per_shard(aws_kinesis_four_shards, "test_stream")
+
+    with mock_kinesis():
+        client = boto3.client("kinesis", region_name='eu-west-2')
+        client.create_stream(StreamName="test_stream", ShardCount=4)
+        publish_to_kinesis("test_stream", "test-search", many_articles,
+                           aggregate=True, partition_strategy=strategy)
+        per_shard = _deaggregated_articles(client, "test_stream")
+
+    assert {shard: articles for shard, (_, articles)
+            in per_shard.items()} == expected
+    assert all(count <= 1 for count, _ in per_shard.values())
+
+
+@patch('src.publish_to_kinesis.time.sleep')
+@patch('boto3.client')
+def test_publish_records_aggregate_reports_every_packed_article(
+        mock_boto_client, mock_sleep):
+    """Test that an aggregated record that fails to publish
+    counts all the articles packed in it as unpublished."""
+    mock_client = Mock()
+    mock_client.put_records.return_value = {
+        'FailedRecordCount': 1,
+        'Records': [{'SequenceNumber': '1', 'ShardId': 'shardId-0'},
+                    {'ErrorCode': 'ProvisionedThroughputExceededException',
+                     'ErrorMessage': 'Rate exceeded'}],
+    }
+    mock_boto_client.return_value = mock_client
+    entries = [('term-a', many_articles[0]), ('term-b', many_articles[1]),
+               ('term-a', many_articles[2]), ('term-b', many_articles[3])]
+
+    published = publish_records("test_stream", entries, max_retries=0,
+                                aggregate=True)
+
+    assert published == [0, 2]
+    records = mock_client.put_records.call_args.kwargs['Records']
+    assert [record['PartitionKey'] for record in records] == [
+        'term-a', 'term-b']
@@ -0,0 +1,182 @@
+from src.query_cache import QueryCache, get_query_cache
+from src.lambda_handler import lambda_handler
+import pytest
+from unittest.mock import patch, Mock
+import json
+import threading
+import time
+
+
+def test_query_cache_reuses_articles_within_ttl():
+    """Test that a cached query is returned until its TTL expires."""
+    cache = QueryCache(ttl=0.05)
+    cache.put('key', [{'webUrl': 'url'}])
+
+    assert cache.get('key') == [{'webUrl': 'url'}]
+    time.sleep(0.06)
+    assert cache.get('key') is None
+
+
+def test_query_cache_evicts_least_recently_used():
+    """Test that the cache keeps at most max_entries queries,
+    evicting the least recently used one."""
+    cache = QueryCache(max_entries=2)
+    cache.put('a', [])
+    cache.put('b', [])
+    cache.get('a')
+    cache.put('c', [])
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == []
+
+
+def test_get_or_fetch_coalesces_identical_queries():
+    """Test that concurrent identical queries share a single fetch."""
+    cache = QueryCache()
+    started = threading.Event()
+    release = threading.Event()
+    fetch = Mock(side_effect=lambda: (
+        started.set(), release.wait(2), [{'webUrl': 'url'}])[-1])
+    results = []
+
+    def query():
+        results.append(cache.get_or_fetch('key', fetch))
+
+    leader = threading.Thread(target=query)
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=query) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert fetch.call_count == 1
+    assert sorted(cached for _, cached in results) == [
+        False, True, True, True]
+    assert all(articles == [{'webUrl': 'url'}] for articles, _ in results)
+
+
+def test_get_or_fetch_does_not_cache_errors():
+    """Test that a failed fetch is raised and fetched again next time."""
+    cache = QueryCache()
+    fetch = Mock(side_effect=[Exception('failed'), [{'webUrl': 'url'}]])
+
+    with pytest.raises(Exception):
+        cache.get_or_fetch('key', fetch)
+
+    assert cache.get_or_fetch('key', fetch) == ([{'webUrl': 'url'}], False)
+
+
+def test_get_or_fetch_skips_uncacheable_results():
+    """Test that articles rejected by cacheable are not cached."""
+    cache = QueryCache()
+
+    cache.get_or_fetch('key', lambda: [], cacheable=lambda articles: False)
+
+    assert cache.get('key') is None
+
+
+def test_query_cache_disabled_with_zero_ttl(monkeypatch):
+    """Test that QUERY_CACHE_TTL_SECONDS=0 disables the cache."""
+    monkeypatch.setenv('QUERY_CACHE_TTL_SECONDS', '0')
+
+    assert get_query_cache() is None
+
+
+def _event(**params):
+    return {'queryStringParameters': {
+        'search_term': 'test', 'kinesis_stream': 'test_stream', **params}}
+
+
+ARTICLES = [{'webUrl': 'url', 'webTitle': 'title'}]
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', ARTICLES))
+@patch('src.lambda_handler.retrieve_articles', return_value=ARTICLES)
+def test_repeated_request_republishes_cached_articles(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """Test that an identical request is answered from the query cache
+    and, by default, publishes the cached articles again."""
+    lambda_handler(_event(), {})
+    response = lambda_handler(_event(), {})
+
+    body = json.loads(response['body'])
+    assert mock_retrieve_articles.call_count == 1
+    assert mock_publish_to_kinesis.call_count == 2
+    assert body['cached'] is True
+    assert body['articles_published'] == ARTICLES
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', []))
+@patch('src.lambda_handler.retrieve_articles')
+def test_articles_with_missing_previews_are_not_cached(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """Test that articles whose preview could not be fetched are not
+    cached, so that the next identical request fetches them again."""
+    mock_retrieve_articles.side_effect = [
+        [{'webUrl': 'url',
+          'contentPreview': 'Content preview not available...'}],
+        [{'webUrl': 'url', 'contentPreview': 'preview...'}],
+        [{'webUrl': 'url', 'contentPreview': 'preview...'}]]
+
+    for _ in range(3):
+        lambda_handler(_event(), {})
+
+    assert mock_retrieve_articles.call_count == 2
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', ARTICLES))
+@patch('src.lambda_handler.retrieve_articles', return_value=ARTICLES)
+def test_cache_hit_can_return_without_publishing(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """Test that on_cache_hit=return only returns the cached articles."""
+    lambda_handler(_event(), {})
+    response = lambda_handler(_event(on_cache_hit='return'), {})
+
+    body = json.loads(response['body'])
+    assert mock_publish_to_kinesis.call_count == 1
+    assert body['articles_published'] == []
+    assert body['articles'] == ARTICLES
+
+
+@patch('src.lambda_handler.publish_records', return_value=iter([]))
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', ARTICLES))
+@patch('src.lambda_handler.get_api_key', return_value='test_api_key')
+@patch('src.lambda_handler.retrieve_articles', return_value=ARTICLES)
+def test_cache_hit_of_one_of_several_terms(
+        mock_retrieve_articles, mock_get_api_key, mock_publish_to_kinesis,
+        mock_publish_records):
+    """Test that with several terms, only the terms that missed the
+    cache are published when on_cache_hit=return."""
+    lambda_handler(_event(), {})
+    response = lambda_handler(_event(
+        search_terms='test,other', on_cache_hit='return'), {})
+
+    results = json.loads(response['body'])['results']
+    assert results[0]['cached'] is True
+    assert results[0]['articles'] == ARTICLES
+    assert 'cached' not in results[1]
+    entries = mock_publish_records.call_args.args[1]
+    assert [term for term, _ in entries] == ['other']
+
+
+@patch('src.lambda_handler.publish_to_kinesis',
+       return_value=('Published', ARTICLES))
+@patch('src.lambda_handler.retrieve_articles', return_value=ARTICLES)
+def test_cache_can_be_bypassed(
+        mock_retrieve_articles, mock_publish_to_kinesis):
+    """Test that cache=false and incremental requests always retrieve."""
+    lambda_handler(_event(), {})
+    lambda_handler(_event(cache='false'), {})
+    lambda_handler(_event(incremental='true'), {})
+    lambda_handler(_event(incremental='true'), {})
+
+    assert mock_retrieve_articles.call_count == 4
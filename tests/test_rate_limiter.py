@@ -0,0 +1,181 @@
+import pytest
+from src.rate_limiter import (
+    RateLimiter, send_with_backoff, retry_after_seconds,
+    get_rate_limiter, set_rate_limiter)
+from src.retrieve_articles import _search_page, APIRequestError
+from src.fetch_article_content import fetch_content_preview, FetchPageError
+from src.preview_cache import get_preview_cache
+from unittest.mock import patch, Mock
+import email.utils
+import requests_mock
+import threading
+import time
+
+
+def _response(status_code, headers=None):
+    return Mock(status_code=status_code, headers=headers or {})
+
+
+def test_token_bucket_allows_burst_then_limits_rate():
+    """Test that burst requests go through at once and the
+    next ones wait for tokens at the configured rate."""
+    limiter = RateLimiter(rate=20, burst=3, max_concurrency=10)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release()
+    burst_elapsed = time.monotonic() - start
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+
+    assert burst_elapsed < 0.02
+    assert time.monotonic() - start >= 0.09
+
+
+def test_concurrency_limit_blocks_until_release():
+    """Test that requests over the concurrency limit
+    wait for one in flight to complete."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_aimd_adjusts_concurrency_limit():
+    """Test that throttling halves the concurrency limit and
+    successes grow it back additively, within its bounds."""
+    limiter = RateLimiter(rate=1000, burst=100, max_concurrency=8)
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.concurrency_limit == 1
+
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release()
+    assert 2 < limiter.concurrency_limit < 4
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.concurrency_limit == 8
+
+
+def test_retry_after_seconds_reads_seconds_and_dates():
+    """Test that Retry-After is read in both of its formats."""
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+
+    assert retry_after_seconds(_response(429, {'Retry-After': '2'})) == 2
+    assert 28 <= retry_after_seconds(
+        _response(429, {'Retry-After': date})) <= 30
+    assert retry_after_seconds(_response(429)) is None
+    assert retry_after_seconds(
+        _response(429, {'Retry-After': 'soon'})) is None
+
+
+@patch('src.rate_limiter.time.sleep')
+def test_send_with_backoff_honors_retry_after(mock_sleep):
+    """Test that a throttled request is resent after the Retry-After
+    delay, and that the limiter is paused meanwhile."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=4)
+    send = Mock(side_effect=[_response(429, {'Retry-After': '0.2'}),
+                             _response(200)])
+    start = time.monotonic()
+
+    response = send_with_backoff(limiter, send)
+
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.2
+    mock_sleep.assert_not_called()
+    assert limiter.concurrency_limit < 4
+
+
+@patch('src.rate_limiter.time.sleep')
+def test_send_with_backoff_uses_jittered_exponential_backoff(mock_sleep):
+    """Test the backoff without Retry-After, and that the last
+    throttled response is returned once retries are used up."""
+    limiter = RateLimiter(rate=1000, burst=10, max_concurrency=4)
+    send = Mock(return_value=_response(503))
+
+    response = send_with_backoff(limiter, send, max_retries=2)
+
+    assert response.status_code == 503
+    assert send.call_count == 3
+    first, second = [call.args[0] for call in mock_sleep.call_args_list]
+    assert 0.5 <= first <= 1.0
+    assert 1.0 <= second <= 2.0
+    assert limiter.in_flight == 0
+
+
+def test_get_rate_limiter_reads_environment(monkeypatch):
+    """Test that the limits of a service can be configured."""
+    monkeypatch.setenv('SEARCH_RATE_LIMIT', '2.5')
+    monkeypatch.setenv('SEARCH_MAX_CONCURRENCY', '3')
+
+    limiter = get_rate_limiter('search')
+
+    assert (limiter.rate, limiter.max_concurrency) == (2.5, 3)
+    assert get_rate_limiter('search') is limiter
+
+
+@patch('src.rate_limiter.time.sleep')
+@patch('src.retrieve_articles.get_api_key', return_value='key')
+@patch('requests.Session.get')
+def test_search_retries_throttled_requests(mock_get, mock_api_key,
+                                           mock_sleep):
+    """Test that a throttled search is retried rather than
+    failing the whole retrieval."""
+    ok = Mock(status_code=200, url='http://x?api-key=key')
+    ok.json.return_value = {'response': {'results': [], 'pages': 1}}
+    mock_get.side_effect = [_response(429, {'Retry-After': '0.01'}), ok]
+
+    assert _search_page({'q': 'test'}, 1, 10, 'page') == {
+        'results': [], 'pages': 1}
+    assert mock_get.call_count == 2
+
+
+@patch('src.rate_limiter.time.sleep')
+@patch('src.retrieve_articles.get_api_key', return_value='key')
+@patch('requests.Session.get')
+def test_search_raises_when_still_throttled(mock_get, mock_api_key,
+                                            mock_sleep):
+    """Test that a search still throttled after the retries raises
+    APIRequestError, even without a JSON body."""
+    throttled = _response(429)
+    throttled.url = 'http://x?api-key=key'
+    throttled.json.side_effect = ValueError('not JSON')
+    mock_get.return_value = throttled
+
+    with pytest.raises(APIRequestError, match='Error 429'):
+        _search_page({'q': 'test'}, 1, 10, 'page')
+
+
+@patch('src.rate_limiter.time.sleep')
+def test_fetch_content_preview_retries_throttled_pages(mock_sleep):
+    """Test that a throttled page is retried, and that a page still
+    throttled is not negatively cached."""
+    set_rate_limiter('pages', RateLimiter(
+        rate=1000, burst=10, max_concurrency=4))
+    url = "http://testexample.com/page"
+
+    with requests_mock.Mocker() as mocker:
+        mocker.get(url, [{'status_code': 429},
+                         {'text': '<p>Guardian article content</p>'}])
+        assert fetch_content_preview(
+            url).strip() == 'Guardian article content'
+
+        get_preview_cache().clear()
+        mocker.get(url, status_code=429)
+        with pytest.raises(FetchPageError):
+            fetch_content_preview(url)
+        assert not get_preview_cache().has_failed(url)
@@ -0,0 +1,67 @@
+import pytest
+from src.record_encoding import (
+    encode_article, decode_record, record_encoding,
+    RecordDecodeError, ENCODINGS)
+import json
+
+article = {
+    "webPublicationDate": "2024-05-01T12:00:00Z",
+    "webTitle": "Sample Article — naïve café",
+    "webUrl": "http://example.com/article1",
+    "contentPreview": "This is a preview of article 1. " * 30
+}
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_encode_article_round_trips(encoding):
+    """Test that every encoding decodes back to the same article."""
+    if encoding == 'zstd_json':
+        pytest.importorskip('zstandard')
+    if encoding == 'msgpack':
+        pytest.importorskip('msgpack')
+
+    data = encode_article(article, encoding)
+
+    assert record_encoding(data) == encoding
+    assert decode_record(data) == article
+
+
+def test_json_encoding_matches_original_format():
+    """Test that the default encoding is the original indented
+    JSON, with no header."""
+    data = encode_article(article)
+
+    assert data == json.dumps(
+        article, indent=4, ensure_ascii=False).encode('utf-8')
+
+
+def test_compact_and_compressed_encodings_are_smaller():
+    """Test that the compact and compressed encodings
+    shrink the record compared to indented JSON."""
+    original = len(encode_article(article, 'json'))
+    compact = len(encode_article(article, 'compact_json'))
+    compressed = len(encode_article(article, 'gzip_json'))
+
+    assert compact < original
+    assert compressed < compact
+
+
+def test_encoded_records_carry_format_header():
+    """Test that headed encodings start with the magic and format bytes."""
+    data = encode_article(article, 'gzip_json')
+
+    assert data[:2] == bytes((0xA7, 2))
+
+
+def test_encode_article_rejects_unknown_encoding():
+    """Test that an unknown encoding is rejected."""
+    with pytest.raises(ValueError):
+        encode_article(article, 'xml')
+
+
+def test_decode_record_rejects_corrupt_data():
+    """Test that corrupt or unknown records raise RecordDecodeError."""
+    with pytest.raises(RecordDecodeError):
+        decode_record(bytes((0xA7, 2)) + b'not gzip')
+    with pytest.raises(RecordDecodeError):
+        decode_record(bytes((0xA7, 99)) + b'{}')
@@ -1,19 +1,11 @@
 import pytest
-from src.retrieve_api_key import retrieve_api_key
+from src.retrieve_api_key import (
+    retrieve_api_key, get_api_key, invalidate_api_key)
 from moto import mock_secretsmanager
 import boto3
 from botocore.exceptions import (ClientError)
-import os
-
-
-@pytest.fixture(scope="function")
-def aws_credentials():
-    """Mocked AWS Credentials for moto."""
-    os.environ['AWS_ACCESS_KEY_ID'] = 'test'
-    os.environ['AWS_SECRET_ACCESS_KEY'] = 'test'
-    os.environ['AWS_SECURITY_TOKEN'] = 'test'
-    os.environ['AWS_SESSION_TOKEN'] = 'test'
-    os.environ['AWS_DEFAULT_REGION'] = 'eu-west-2'
+import time
+from unittest.mock import patch
 
 
 @pytest.fixture(scope="function")
@@ -77,3 +69,65 @@ def test_retrieve_api_key_raises_value_error_on_param_validation_error(
 
     with pytest.raises(ValueError):
         retrieve_api_key(2)
+
+
+def test_get_api_key_serves_cached_key_within_ttl(secrets_client):
+    """Check that get_api_key only calls Secrets Manager
+    once while the cached key is fresh."""
+    secrets_client.create_secret(
+        Name="guardian/api-key",
+        SecretString="abc123"
+    )
+    with patch('src.retrieve_api_key.retrieve_api_key',
+               wraps=retrieve_api_key) as mock_retrieve:
+        assert get_api_key("guardian/api-key", ttl=60) == "abc123"
+        assert get_api_key("guardian/api-key", ttl=60) == "abc123"
+
+    assert mock_retrieve.call_count == 1
+
+
+@patch('src.retrieve_api_key.time.monotonic')
+@patch('src.retrieve_api_key.retrieve_api_key')
+def test_get_api_key_serves_stale_key_while_refreshing(
+        mock_retrieve, mock_monotonic):
+    """Check that an expired key within the stale window is
+    returned immediately while it is refreshed in the background."""
+    mock_retrieve.side_effect = ["old-key", "new-key"]
+    mock_monotonic.return_value = 0
+    assert get_api_key("guardian/api-key", ttl=10, stale_ttl=10) == "old-key"
+
+    mock_monotonic.return_value = 15
+    assert get_api_key("guardian/api-key", ttl=10, stale_ttl=10) == "old-key"
+
+    for _ in range(100):
+        key = get_api_key("guardian/api-key", ttl=10, stale_ttl=10)
+        if key == "new-key":
+            break
+        time.sleep(0.01)
+    assert key == "new-key"
+    assert mock_retrieve.call_count == 2
+
+
+@patch('src.retrieve_api_key.time.monotonic')
+@patch('src.retrieve_api_key.retrieve_api_key')
+def test_get_api_key_refetches_after_stale_window(
+        mock_retrieve, mock_monotonic):
+    """Check that a key older than ttl + stale_ttl is
+    retrieved again before being returned."""
+    mock_retrieve.side_effect = ["old-key", "new-key"]
+    mock_monotonic.return_value = 0
+    get_api_key("guardian/api-key", ttl=10, stale_ttl=10)
+
+    mock_monotonic.return_value = 25
+    assert get_api_key("guardian/api-key", ttl=10, stale_ttl=10) == "new-key"
+
+
+@patch('src.retrieve_api_key.retrieve_api_key')
+def test_invalidate_api_key_forces_refetch(mock_retrieve):
+    """Check that an invalidated key is retrieved again."""
+    mock_retrieve.side_effect = ["old-key", "new-key"]
+    assert get_api_key("guardian/api-key", ttl=60) == "old-key"
+
+    invalidate_api_key("guardian/api-key")
+
+    assert get_api_key("guardian/api-key", ttl=60) == "new-key"
@@ -1,21 +1,25 @@
 import unittest
 from unittest.mock import patch, Mock
-from src.retrieve_articles import retrieve_articles, APIRequestError
+from src.seen_index import SeenIndex
+from src.retrieve_articles import (
+    retrieve_articles, iter_articles, APIRequestError)
 import pytest
 import requests
+import threading
+import time
 
 
 class TestRetrieveArticles(unittest.TestCase):
     """Unit tests for the retrieve_articles function."""
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
-    def test_successful_request(self, mock_retrieve_api_key, mock_get):
+    def test_successful_request(self, mock_get_api_key, mock_get):
         """
         Test retrieve_articles function for a successful API request.
 
-        This test mocks the requests.get call and the retrieve_api_key
+        This test mocks the HTTP session's get call and the get_api_key
         function to simulate a successful response from the Guardian API.
         It checks that the function correctly processes the response and
         returns the expected list of articles.
@@ -49,17 +53,17 @@ class TestRetrieveArticles(unittest.TestCase):
             articles[0]['contentPreview'],
             'test_content_preview...')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
     def test_unsuccessful_requests_4xx_5xx_errors(
-            self, mock_retrieve_api_key, mock_get):
+            self, mock_get_api_key, mock_get):
         """
         Test retrieve_articles function for unsuccessful
         API requests resulting in 4xx or 5xx errors.
 
-        This test mocks the requests.get call and
-        the retrieve_api_key function to simulate
+        This test mocks the HTTP session's get call and
+        the get_api_key function to simulate
         an unsuccessful response from the Guardian API.
         It checks that the function raises
         an APIRequestError in response to a 404 status code.
@@ -76,11 +80,11 @@ class TestRetrieveArticles(unittest.TestCase):
         with pytest.raises(APIRequestError):
             retrieve_articles('test_search_term', 'test_date')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
     def test_successful_request_multiple_articles(
-            self, mock_retrieve_api_key, mock_get):
+            self, mock_get_api_key, mock_get):
         """Test retrieve_articles for a successful
         API request with multiple articles."""
         mock_response = Mock()
@@ -103,10 +107,10 @@ class TestRetrieveArticles(unittest.TestCase):
         with patch(
             'src.retrieve_articles.fetch_content_preview'
         ) as mock_fetch_content_preview:
-            mock_fetch_content_preview.side_effect = [
-                'test_content_preview_1',
-                'test_content_preview_2'
-            ]
+            mock_fetch_content_preview.side_effect = {
+                'test_url_1': 'test_content_preview_1',
+                'test_url_2': 'test_content_preview_2'
+            }.get
 
             articles = retrieve_articles('TEST', '2024-05-01')
 
@@ -124,10 +128,10 @@ class TestRetrieveArticles(unittest.TestCase):
             articles[1]['contentPreview'],
             'test_content_preview_2...')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='dummy_api_key')
-    def test_empty_results(self, mock_retrieve_api_key, mock_get):
+    def test_empty_results(self, mock_get_api_key, mock_get):
         """Test retrieve_articles when the API returns no articles."""
         mock_response = Mock()
         mock_response.status_code = 200
@@ -143,10 +147,10 @@ class TestRetrieveArticles(unittest.TestCase):
 
         self.assertEqual(len(articles), 0)
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
-    def test_invalid_api_key(self, mock_retrieve_api_key, mock_get):
+    def test_invalid_api_key(self, mock_get_api_key, mock_get):
         """Test retrieve_articles with an invalid API key."""
         mock_response = Mock()
         mock_response.status_code = 403
@@ -161,10 +165,10 @@ class TestRetrieveArticles(unittest.TestCase):
         with self.assertRaises(APIRequestError):
             retrieve_articles('TEST')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
-    def test_invalid_date_format(self, mock_retrieve_api_key, mock_get):
+    def test_invalid_date_format(self, mock_get_api_key, mock_get):
         """Test retrieve_articles with an invalid date format."""
         mock_response = Mock()
         mock_response.status_code = 400
@@ -179,26 +183,414 @@ class TestRetrieveArticles(unittest.TestCase):
         with self.assertRaises(APIRequestError):
             retrieve_articles('TEST', 'invalid-date-format')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
-    def test_network_error(self, mock_retrieve_api_key, mock_get):
+    def test_network_error(self, mock_get_api_key, mock_get):
         """Test retrieve_articles with a network error.
-        By mocking requests.get to raise a ConnectionError."""
+        By mocking the HTTP session's get to raise a ConnectionError."""
 
         mock_get.side_effect = requests.exceptions.ConnectionError
 
         with self.assertRaises(APIRequestError):
             retrieve_articles('TEST', '2024-05-01')
 
-    @patch('src.retrieve_articles.requests.get')
-    @patch('src.retrieve_articles.retrieve_api_key',
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
            return_value='test_api_key')
-    def test_general_exception_handling(self, mock_retrieve_api_key, mock_get):
+    def test_general_exception_handling(self, mock_get_api_key, mock_get):
         """Test retrieve_articles for general exception handling.
-        By mocking requests.get to raise a general exception.
+        By mocking the HTTP session's get to raise a general exception.
         """
         mock_get.side_effect = Exception('Unexpected error')
 
         with self.assertRaises(Exception):
             retrieve_articles('TEST')
+
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
+           return_value='test_api_key')
+    def test_concurrent_previews_keep_result_order(
+            self, mock_get_api_key, mock_get):
+        """Test that previews fetched concurrently are returned
+        in the same order as the API results, with a fallback
+        message for any article whose page could not be fetched."""
+        results = [
+            {'webUrl': f'test_url_{i}',
+             'webPublicationDate': f'test_date_{i}',
+             'webTitle': f'test_title_{i}'}
+            for i in range(10)
+        ]
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {'response': {'results': results}}
+        mock_response.url = 'http://example.com'
+        mock_get.return_value = mock_response
+
+        def fake_fetch(url):
+            index = int(url.rsplit('_', 1)[1])
+            # Make earlier articles finish last
+            time.sleep((10 - index) * 0.005)
+            if index == 3:
+                raise Exception('Page unavailable')
+            return f'preview_{index}'
+
+        with patch(
+            'src.retrieve_articles.fetch_content_preview',
+            side_effect=fake_fetch
+        ):
+            articles = retrieve_articles('TEST', max_workers=4)
+
+        self.assertEqual(
+            [article['webUrl'] for article in articles],
+            [f'test_url_{i}' for i in range(10)])
+        for i, article in enumerate(articles):
+            if i == 3:
+                self.assertEqual(
+                    article['contentPreview'],
+                    'Content preview not available...')
+            else:
+                self.assertEqual(article['contentPreview'], f'preview_{i}...')
+
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
+           return_value='test_api_key')
+    def test_invalid_max_workers(self, mock_get_api_key, mock_get):
+        """Test retrieve_articles rejects a worker count below one."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            'response': {
+                'results': [
+                    {'webUrl': 'test_url',
+                     'webPublicationDate': 'test_date',
+                     'webTitle': 'test_title'}
+                ]
+            }
+        }
+        mock_response.url = 'http://example.com'
+        mock_get.return_value = mock_response
+
+        with self.assertRaises(APIRequestError):
+            retrieve_articles('TEST', max_workers=0)
+
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.invalidate_api_key')
+    @patch('src.retrieve_articles.get_api_key')
+    def test_rejected_api_key_is_invalidated_and_retried(
+            self, mock_get_api_key, mock_invalidate, mock_get):
+        """Test that a 401 response invalidates the cached API key
+        and retries once with the key retrieved afterwards."""
+        mock_get_api_key.side_effect = ['stale_key', 'rotated_key']
+        rejected = Mock()
+        rejected.status_code = 401
+        accepted = Mock()
+        accepted.status_code = 200
+        accepted.json.return_value = {'response': {'results': []}}
+        accepted.url = 'http://example.com'
+        mock_get.side_effect = [rejected, accepted]
+
+        articles = retrieve_articles('TEST')
+
+        self.assertEqual(articles, [])
+        mock_invalidate.assert_called_once_with('guardian/api-key')
+        self.assertEqual(
+            mock_get.call_args_list[1].kwargs['params']['api-key'],
+            'rotated_key')
+
+    @patch('requests.Session.get')
+    @patch('src.retrieve_articles.get_api_key',
+           return_value='test_api_key')
+    def test_api_preview_source_uses_search_fields(
+            self, mock_get_api_key, mock_get):
+        """Test that the 'api' preview source builds previews from
+        the search response and only scrapes hits without fields."""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            'response': {
+                'results': [
+                    {'webUrl': 'test_url_1',
+                     'webPublicationDate': 'test_date_1',
+                     'webTitle': 'test_title_1',
+                     'fields': {'bodyText': 'Body text. ' * 200,
+                                'trailText': 'Trail'}},
+                    {'webUrl': 'test_url_2',
+                     'webPublicationDate': 'test_date_2',
+                     'webTitle': 'test_title_2',
+                     'fields': {'bodyText': '',
+                                'trailText': '<strong>Trail</strong> &amp; '
+                                             'text'}},
+                    {'webUrl': 'test_url_3',
+                     'webPublicationDate': 'test_date_3',
+                     'webTitle': 'test_title_3'}
+                ]
+            }
+        }
+        mock_response.url = 'http://example.com'
+        mock_get.return_value = mock_response
+
+        with patch(
+            'src.retrieve_articles.fetch_content_preview',
+            return_value='scraped_preview'
+        ) as mock_fetch_content_preview:
+            articles = retrieve_articles('TEST', preview_source='api')
+
+        self.assertEqual(
+            mock_get.call_args.kwargs['params']['show-fields'],
+            'bodyText,trailText')
+        mock_fetch_content_preview.assert_called_once_with('test_url_3')
+        self.assertEqual(
+            articles[0]['contentPreview'],
+            ('Body text. ' * 200)[:1000] + '...')
+        self.assertEqual(articles[1]['contentPreview'], 'Trail & text...')
+        self.assertEqual(articles[2]['contentPreview'], 'scraped_preview...')
+
+    def test_invalid_preview_source(self):
+        """Test retrieve_articles rejects an unknown preview source."""
+        with self.assertRaises(ValueError):
+            retrieve_articles('TEST', preview_source='unknown')
+
+
+def _search_page_response(page, pages, page_size=2):
+    response = Mock()
+    response.status_code = 200
+    response.url = 'http://example.com'
+    response.json.return_value = {
+        'response': {
+            'currentPage': page,
+            'pages': pages,
+            'results': [
+                {'webUrl': f'url_{page}_{i}',
+                 'webPublicationDate': f'date_{page}_{i}',
+                 'webTitle': f'title_{page}_{i}'}
+                for i in range(page_size)
+            ]
+        }
+    }
+    return response
+
+
+@patch('src.retrieve_articles.fetch_content_preview',
+       side_effect=lambda url: f'preview_{url}')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_pages_until_max_results(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that retrieve_articles reads further pages until it has
+    max_results articles, and only fetches previews for those."""
+    mock_get.side_effect = (
+        lambda url, params, **kwargs: _search_page_response(
+            params['page'], pages=5))
+
+    articles = retrieve_articles('TEST', page_size=2, max_results=5)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_0', 'url_1_1', 'url_2_0', 'url_2_1', 'url_3_0']
+    assert [call.kwargs['params']['page']
+            for call in mock_get.call_args_list] == [1, 2, 3]
+    assert all(call.kwargs['params']['page-size'] == 2
+               for call in mock_get.call_args_list)
+    assert mock_fetch_content_preview.call_count == 5
+
+
+@patch('src.retrieve_articles.fetch_content_preview',
+       side_effect=lambda url: f'preview_{url}')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_iter_articles_reads_all_pages(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that iter_articles yields the articles of every
+    page in order when max_results is not set."""
+    mock_get.side_effect = (
+        lambda url, params, **kwargs: _search_page_response(
+            params['page'], pages=3))
+
+    articles = iter_articles('TEST', page_size=2)
+    first = next(articles)
+    rest = list(articles)
+
+    assert first['webUrl'] == 'url_1_0'
+    assert [article['webUrl'] for article in rest] == [
+        'url_1_1', 'url_2_0', 'url_2_1', 'url_3_0', 'url_3_1']
+    assert mock_get.call_count == 3
+
+
+@patch('src.retrieve_articles.fetch_content_preview',
+       return_value='preview')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_iter_articles_prefetches_next_page(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that the next page is requested before the
+    articles of the current page have all been consumed."""
+    next_page_requested = threading.Event()
+
+    def fake_get(url, params, **kwargs):
+        if params['page'] == 2:
+            next_page_requested.set()
+        return _search_page_response(params['page'], pages=2)
+
+    mock_get.side_effect = fake_get
+
+    articles = iter_articles('TEST', page_size=2)
+    next(articles)
+
+    assert next_page_requested.wait(timeout=1)
+    assert len(list(articles)) == 3
+
+
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_iter_articles_raises_api_error_on_later_page(
+        mock_get, mock_get_api_key):
+    """Test that an error on a later page raises an
+    APIRequestError after the earlier articles were yielded."""
+    error_response = Mock()
+    error_response.status_code = 500
+    error_response.url = 'http://example.com'
+    error_response.json.return_value = {'response': {'message': 'Error'}}
+    mock_get.side_effect = [_search_page_response(1, pages=2),
+                            error_response]
+
+    articles = iter_articles('TEST', page_size=2)
+    with patch('src.retrieve_articles.fetch_content_preview',
+               return_value='preview'):
+        assert next(articles)['webUrl'] == 'url_1_0'
+        assert next(articles)['webUrl'] == 'url_1_1'
+        with pytest.raises(APIRequestError):
+            next(articles)
+
+
+def test_iter_articles_rejects_invalid_page_size():
+    """Test that page sizes outside 1-200 are rejected."""
+    with pytest.raises(ValueError):
+        iter_articles('TEST', page_size=201)
+
+
+@patch('src.retrieve_articles.fetch_content_preview',
+       side_effect=lambda url: f'preview_{url}')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_skips_seen_articles(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that articles already published with the same preview are
+    skipped, and replaced from later pages."""
+    mock_get.side_effect = (
+        lambda url, params, **kwargs: _search_page_response(
+            params['page'], pages=3))
+    seen_index = SeenIndex()
+    seen_index.mark([{'webUrl': 'url_1_0',
+                      'contentPreview': 'preview_url_1_0...'}])
+
+    articles = retrieve_articles(
+        'TEST', page_size=2, max_results=2, seen_index=seen_index)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_1', 'url_2_0']
+    assert [call.args[0] for call in
+            mock_fetch_content_preview.call_args_list] == [
+        'url_1_0', 'url_1_1', 'url_2_0']
+
+
+@patch('src.retrieve_articles.fetch_content_preview',
+       side_effect=lambda url: f'preview_{url}')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_keeps_changed_seen_articles(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that an article published before with a different preview,
+    e.g. after it was updated, is retrieved again."""
+    mock_get.return_value = _search_page_response(1, pages=1)
+    seen_index = SeenIndex()
+    seen_index.mark([{'webUrl': 'url_1_0',
+                      'contentPreview': 'preview before the update...'}])
+
+    articles = retrieve_articles('TEST', seen_index=seen_index)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_0', 'url_1_1']
+
+
+@patch('src.retrieve_articles.fetch_content_preview')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_skips_seen_inline_previews_before_fetching(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that with preview_source='api', hits whose inline preview
+    was already published are skipped, and changed ones kept."""
+    page = _search_page_response(1, pages=1, page_size=3)
+    for i, result in enumerate(
+            page.json.return_value['response']['results']):
+        result['fields'] = {'bodyText': f'body {i}'}
+    mock_get.return_value = page
+    seen_index = SeenIndex()
+    seen_index.mark([
+        {'webUrl': 'url_1_0', 'contentPreview': 'body 0...'},
+        {'webUrl': 'url_1_1', 'contentPreview': 'old body 1...'}])
+
+    articles = retrieve_articles(
+        'TEST', preview_source='api', seen_index=seen_index)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_1', 'url_1_2']
+    mock_fetch_content_preview.assert_not_called()
+
+
+@patch('src.retrieve_articles.fetch_content_preview', return_value='preview')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_stops_at_watermark(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that with a watermark, articles at or before it are skipped
+    and no further pages are requested once it is reached."""
+    page = _search_page_response(1, pages=5, page_size=4)
+    results = page.json.return_value['response']['results']
+    for result, date in zip(results, ['2024-05-03', '2024-05-02',
+                                      '2024-05-02', '2024-05-01']):
+        result['webPublicationDate'] = date
+    mock_get.return_value = page
+    watermark = {'date': '2024-05-02', 'urls': ['url_1_2']}
+
+    articles = retrieve_articles(
+        'TEST', max_results=None, order_by='newest', watermark=watermark)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_0', 'url_1_1']
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.kwargs['params']['order-by'] == 'newest'
+
+
+@patch('src.retrieve_articles.fetch_content_preview', return_value='preview')
+@patch('src.retrieve_articles.get_api_key', return_value='test_api_key')
+@patch('requests.Session.get')
+def test_retrieve_articles_skips_watermark_oldest_first(
+        mock_get, mock_get_api_key, mock_fetch_content_preview):
+    """Test that oldest first, articles up to the watermark are skipped
+    without fetching their previews, and later pages are still read."""
+    def search(url, params, **kwargs):
+        page = _search_page_response(params['page'], pages=2, page_size=3)
+        results = page.json.return_value['response']['results']
+        for i, result in enumerate(results):
+            result['webPublicationDate'] = f'2024-05-0{params["page"]}-{i}'
+        return page
+    mock_get.side_effect = search
+    watermark = {'date': '2024-05-01-1', 'urls': ['url_1_1']}
+
+    articles = retrieve_articles(
+        'TEST', from_date='2024-05-01', to_date='2024-05-31',
+        max_results=None, order_by='oldest', watermark=watermark)
+
+    assert [article['webUrl'] for article in articles] == [
+        'url_1_2', 'url_2_0', 'url_2_1', 'url_2_2']
+    assert mock_fetch_content_preview.call_count == 4
+    params = mock_get.call_args.kwargs['params']
+    assert params['to-date'] == '2024-05-31'
+    assert params['order-by'] == 'oldest'
+
+
+def test_retrieve_articles_watermark_requires_date_order():
+    """Test that a watermark cannot be used with relevance ordering."""
+    with pytest.raises(ValueError):
+        retrieve_articles('TEST', watermark={'date': '2024-05-01',
+                                             'urls': []})
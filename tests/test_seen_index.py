@@ -0,0 +1,85 @@
+import pytest
+from src.seen_index import (
+    BloomFilter, MemorySeenStore, SqliteSeenStore, SeenIndex)
+from unittest.mock import patch
+
+article = {
+    "webPublicationDate": "2024-05-01T12:00:00Z",
+    "webTitle": "Sample Article 1",
+    "webUrl": "http://example.com/article1",
+    "contentPreview": "This is a preview of article 1."
+}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    """Each seen store backend."""
+    if request.param == 'memory':
+        return MemorySeenStore()
+    return SqliteSeenStore(str(tmp_path / 'seen.db'))
+
+
+def test_bloom_filter_has_no_false_negatives():
+    """Test that every added key is reported as present."""
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [f'http://example.com/{i}' for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    false_positives = sum(
+        f'http://other.com/{i}' in bloom for i in range(1000))
+    assert false_positives < 50
+
+
+def test_seen_index_marks_articles_as_seen(store):
+    """Test that a marked article is seen, by URL and by preview."""
+    index = SeenIndex(store)
+    assert not index.seen(article)
+    assert not index.seen_url(article['webUrl'])
+
+    index.mark([article])
+
+    assert index.seen(article)
+    assert index.seen_url(article['webUrl'])
+
+
+def test_seen_index_treats_changed_preview_as_new(store):
+    """Test that an article whose preview changed is not a duplicate."""
+    index = SeenIndex(store)
+    index.mark([article])
+
+    updated = dict(article, contentPreview='Updated preview.')
+    assert not index.seen(updated)
+    assert index.filter_unseen([article, updated, updated]) == [updated]
+
+
+def test_seen_index_expires_records_after_ttl(store):
+    """Test that records older than the TTL are ignored."""
+    index = SeenIndex(store, ttl=60)
+    with patch('src.seen_index.time.time', return_value=1000):
+        index.mark([article])
+    with patch('src.seen_index.time.time', return_value=1059):
+        assert index.seen(article)
+    with patch('src.seen_index.time.time', return_value=1061):
+        assert not index.seen(article)
+
+
+def test_seen_index_reloads_persistent_store(tmp_path):
+    """Test that a new index over the same SQLite file
+    knows about the articles marked by an earlier one."""
+    path = str(tmp_path / 'seen.db')
+    SeenIndex(SqliteSeenStore(path)).mark([article])
+
+    assert SeenIndex(SqliteSeenStore(path)).seen(article)
+
+
+def test_seen_index_purges_expired_records_on_load(tmp_path):
+    """Test that expired records are deleted when the index is created."""
+    path = str(tmp_path / 'seen.db')
+    store = SqliteSeenStore(path)
+    store.put_many([(article['webUrl'], 'hash', 0)])
+
+    SeenIndex(store, ttl=60)
+
+    assert store.get(article['webUrl']) is None
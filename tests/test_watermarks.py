@@ -0,0 +1,111 @@
+from src.watermarks import (
+    MemoryWatermarkStore, FileWatermarkStore, DynamoDBWatermarkStore,
+    advance_watermark, is_before_watermark, get_watermark_store)
+from moto import mock_dynamodb
+import boto3
+import pytest
+
+
+def _article(date, url):
+    return {'webPublicationDate': date, 'webUrl': url}
+
+
+def test_advance_watermark_moves_to_latest_published_article():
+    """Test that the watermark moves to the newest article
+    when every retrieved article was published."""
+    articles = [_article('2024-05-03T10:00:00Z', 'c'),
+                _article('2024-05-02T10:00:00Z', 'b')]
+
+    watermark = advance_watermark(None, articles, articles)
+
+    assert watermark == {'date': '2024-05-03T10:00:00Z', 'urls': ['c']}
+
+
+def test_advance_watermark_stops_before_unpublished_article():
+    """Test that the watermark does not move past an
+    article that failed to publish."""
+    articles = [_article('2024-05-03T10:00:00Z', 'c'),
+                _article('2024-05-02T10:00:00Z', 'b'),
+                _article('2024-05-01T10:00:00Z', 'a')]
+
+    watermark = advance_watermark(
+        None, articles, [articles[0], articles[2]])
+
+    assert watermark == {'date': '2024-05-01T10:00:00Z', 'urls': ['a']}
+
+
+def test_advance_watermark_keeps_urls_with_the_same_date():
+    """Test that articles sharing the watermark date are remembered,
+    so only the unpublished ones are retrieved again."""
+    current = {'date': '2024-05-01T10:00:00Z', 'urls': ['a']}
+    articles = [_article('2024-05-01T10:00:00Z', 'b')]
+
+    watermark = advance_watermark(current, articles, articles)
+
+    assert watermark == {'date': '2024-05-01T10:00:00Z', 'urls': ['a', 'b']}
+    assert is_before_watermark(articles[0], watermark)
+    assert not is_before_watermark(
+        _article('2024-05-01T10:00:00Z', 'c'), watermark)
+    assert is_before_watermark(
+        _article('2024-04-30T10:00:00Z', 'z'), watermark)
+
+
+def test_advance_watermark_unchanged_when_nothing_published():
+    """Test that the watermark stays put when nothing was published."""
+    current = {'date': '2024-05-01T10:00:00Z', 'urls': ['a']}
+    articles = [_article('2024-05-02T10:00:00Z', 'b')]
+
+    assert advance_watermark(current, articles, []) == current
+
+
+def test_watermark_stores_round_trip(tmp_path):
+    """Test that both stores return the watermark that was set,
+    and that the file store persists it."""
+    watermark = {'date': '2024-05-01T10:00:00Z', 'urls': ['a']}
+    path = str(tmp_path / 'watermarks.json')
+    for store in (MemoryWatermarkStore(), FileWatermarkStore(path)):
+        assert store.get('python') is None
+        store.set('python', watermark)
+        assert store.get('python') == watermark
+
+    assert FileWatermarkStore(path).get('python') == watermark
+
+
+@pytest.fixture(scope="function")
+def watermarks_table(aws_credentials):
+    """Mock DynamoDB with a created watermarks table for testing."""
+    with mock_dynamodb():
+        client = boto3.client('dynamodb', region_name='eu-west-2')
+        client.create_table(
+            TableName='watermarks',
+            KeySchema=[{'AttributeName': 'search_term', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'search_term', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        yield 'watermarks'
+
+
+def test_dynamodb_watermark_store_round_trip(watermarks_table):
+    """Test that the DynamoDB store keeps the last watermark set for a
+    search term, readable by another instance of the store."""
+    store = DynamoDBWatermarkStore(watermarks_table)
+    assert store.get('Émile') is None
+
+    store.set('Émile', {'date': '2024-05-01T10:00:00Z', 'urls': ['a']})
+    store.set('Émile', {'date': '2024-05-02T10:00:00Z', 'urls': ['b']})
+
+    assert DynamoDBWatermarkStore(watermarks_table).get('Émile') == {
+        'date': '2024-05-02T10:00:00Z', 'urls': ['b']}
+
+
+def test_get_watermark_store_prefers_the_dynamodb_table(
+        monkeypatch, tmp_path):
+    """Test that WATERMARKS_TABLE selects the DynamoDB store,
+    even when WATERMARK_PATH is set."""
+    monkeypatch.setenv('WATERMARKS_TABLE', 'watermarks')
+    monkeypatch.setenv('WATERMARK_PATH', str(tmp_path / 'watermarks.json'))
+
+    store = get_watermark_store()
+
+    assert isinstance(store, DynamoDBWatermarkStore)
+    assert store.table_name == 'watermarks'